@@ -13,13 +13,26 @@ from torch.nn import functional as F
 from torch.utils.tensorboard import SummaryWriter
 from transformers import (
     T5ForConditionalGeneration, 
-    T5Config,
-    AdamW,
+    AutoTokenizer,
+    Adafactor,
     get_cosine_with_hard_restarts_schedule_with_warmup
 )
+from transformers.generation.logits_process import RepetitionPenaltyLogitsProcessor
+from transformers.models.t5.modeling_t5 import T5Attention
+from torch.optim import AdamW    # transformers no longer exports its own AdamW
 import time
 from datetime import datetime
 import math
+import os
+import sys
+
+# The right-sized vocabularies and the checkpoint helpers are defined once, in the bo_translate package at the repository root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+from bo_translate.t5 import (
+    right_size_vocabularies, convert_full_vocab_state_dict, quantize_dynamic_int8, save_quantized_model, load_quantized_model, 
+    save_inference_checkpoint, load_inference_checkpoint
+)
 
 device = torch.device(
     'cuda:0' if torch.cuda.is_available() else 'cpu'
@@ -272,18 +285,51 @@ class Timer:
 #### Section 4: Training routine
 # --------------------------
 
+def compute_loss(model, batch, hparams): 
+    '''
+    Cross entropy of a batch from MyBatchIterator with teacher forcing. Shared by the train and eval loops. 
+    With hparams['bf16'] the forward pass runs under bf16 autocast: matmuls run in bf16 while the weights, 
+    gradients and optimizer state stay fp32 (bf16 has the fp32 exponent range, so no loss scaling is needed). 
+    '''
+    # Get the token ids and attention masks in each batch 
+    src_ids = batch['src_ids']
+    src_mask = batch['src_mask']
+    tgt_ids = batch['tgt_ids']
+    tgt_mask = batch['tgt_mask']
+    
+    decoder_input_ids = tgt_ids[:, :-1]    # Remove the last column, intended EOS
+    labels = tgt_ids[:, 1:]    # Remove the first column (BOS should not be used for computing loss)
+    
+    with torch.autocast(device_type = device.type, dtype = torch.bfloat16, enabled = hparams['bf16']): 
+        return model.forward(
+            input_ids = src_ids, 
+            attention_mask = src_mask, 
+            decoder_input_ids = decoder_input_ids, 
+            # decoder_attention_mask = tgt_mask,  # According to T5 doc, decoder attention mask is generated automatically so I won't define it myself. 
+            labels = labels.masked_fill(labels == tgt_pad_id, -100)    # -100 means not to compute loss at this token. # See T5 doc for more info 
+        ).loss
+
+
 def train(train_iter, val_iter, model, optimizer, scheduler, hparams): 
+    '''
+    Train for hparams['num_epochs'] epochs, validating after each epoch. 
+    Return a dict with the per-epoch `train_losses` and `val_losses`, and the per-step 
+    `step_losses`, `step_seconds` (forward + backward + optimizer) and `step_tokens` (target tokens) of the training batches. 
+    '''
     train_losses = []    # For storing averages losses durinig each train epoch
     val_losses = []      # For storing averages losses during each val epoch
+    step_losses, step_seconds, step_tokens = [], [], []    # For throughput and loss-curve comparisons 
     train_step_counter = 0    
     val_step_counter = 0
     tb_refresh_rate = 60    # Flush tensorboard log every ~ seconds
     msg_refresh_rate = 10    # Flush message log every ~ seconds 
     best_epoch = 0
+    output_dir = hparams['output_dir']    # Where logs and checkpoints are written 
+    os.makedirs(output_dir, exist_ok = True)
     
-    msg_writer = open('message.log', 'w')    # For logging training progress 
-    tb_writer = SummaryWriter(flush_secs = tb_refresh_rate)    # Tensorboard writer 
-    sample_writer = open('sample.log', 'w', encoding = 'utf-8')    # For logging example sentences 
+    msg_writer = open(os.path.join(output_dir, 'message.log'), 'w')    # For logging training progress 
+    tb_writer = SummaryWriter(log_dir = os.path.join(output_dir, 'runs', datetime.now().strftime('%b%d_%H-%M-%S')), flush_secs = tb_refresh_rate)    # Tensorboard writer 
+    sample_writer = open(os.path.join(output_dir, 'sample.log'), 'w', encoding = 'utf-8')    # For logging example sentences 
     
 
     for epoch in range(hparams['num_epochs']): 
@@ -302,28 +348,17 @@ def train(train_iter, val_iter, model, optimizer, scheduler, hparams):
         myTimer = Timer(len(train_iter))    # For estimating remaining time for training each epoch
         
         for idx, batch in enumerate(train_iter): 
-            # Get the token ids and attention masks in each batch 
-            src_ids = batch['src_ids']
-            src_mask = batch['src_mask']
-            tgt_ids = batch['tgt_ids']
-            tgt_mask = batch['tgt_mask']
-            
-            decoder_input_ids = tgt_ids[:, :-1]    # Remove the last column, intended EOS
-            labels = tgt_ids[:, 1:]    # Remove the first column (BOS should not be used for computing loss)
-            
             # Forward, backprop, optimizer, scheduler 
+            step_start = time.time()
             optimizer.zero_grad()
-            loss = T5model.forward(
-                input_ids = src_ids, 
-                attention_mask = src_mask, 
-                decoder_input_ids = decoder_input_ids, 
-                # decoder_attention_mask = tgt_mask,  # According to T5 doc, decoder attention mask is generated automatically so I won't define it myself. 
-                labels = labels.masked_fill(labels == tgt_pad_id, -100)    # -100 means not to compute loss at this token. # See T5 doc for more info 
-            ).loss
+            loss = compute_loss(model, batch, hparams)
             loss.backward()    # Backward propagation
             optimizer.step()   # Step the optimizer
             scheduler.step()   # Step the scheduler 
-            train_loss += loss.item() / src_ids.size(0)    # Increment by the loss in the current batch for computing averages later 
+            train_loss += loss.item() / batch['src_ids'].size(0)    # Increment by the loss in the current batch for computing averages later 
+            step_seconds.append(time.time() - step_start)    # loss.item() waits for the step to finish 
+            step_losses.append(loss.item() / batch['src_ids'].size(0))
+            step_tokens.append((batch['tgt_ids'][:, 1:] != tgt_pad_id).sum().item())
             
             # Tensorboard logging
                 # Which epoch are we at 
@@ -366,24 +401,9 @@ def train(train_iter, val_iter, model, optimizer, scheduler, hparams):
         
         with torch.no_grad(): 
             for idx, batch in enumerate(val_iter): 
-                # Get the token ids and attention masks in each batch 
-                src_ids = batch['src_ids']
-                src_mask = batch['src_mask']
-                tgt_ids = batch['tgt_ids']
-                tgt_mask = batch['tgt_mask']
-
-                decoder_input_ids = tgt_ids[:, :-1]    # Remove the last column, intended EOS
-                labels = tgt_ids[:, 1:]    # Remove the first column (BOS should not be used for computing loss)
-                
                 # Forward & compute cross-validation loss 
-                loss = T5model.forward(
-                    input_ids = src_ids, 
-                    attention_mask = src_mask, 
-                    decoder_input_ids = decoder_input_ids, 
-                    # decoder_attention_mask = tgt_mask,  # According to T5 doc, decoder attention mask is generated automatically so I won't define it myself. 
-                    labels = labels.masked_fill(labels == tgt_pad_id, -100)    # -100 means not to compute loss at this token 
-                ).loss
-                val_loss += loss.item() / src_ids.size(0)    # Increment by the loss in the current batch for computing averages later
+                loss = compute_loss(model, batch, hparams)
+                val_loss += loss.item() / batch['src_ids'].size(0)    # Increment by the loss in the current batch for computing averages later
                 
                 # Tensorboard logging 
                     # Which epoch are we at 
@@ -424,12 +444,12 @@ def train(train_iter, val_iter, model, optimizer, scheduler, hparams):
         if val_loss / len(val_iter) < min(val_losses, default = 1e9): 
             best_epoch = epoch
             print(f'Saving best state_dict...')
-            torch.save(model.state_dict(), 'checkpoint_best_epoch.pt')
+            torch.save(checkpoint_contents(model, hparams), os.path.join(output_dir, 'checkpoint_best_epoch.pt'))
 
         # Save checkpoint models
         if epoch in hparams['checkpoint_at']: 
             print(f'Saving checkpoint state_dict...')
-            torch.save(model.state_dict(), f'checkpoint_epoch={epoch}.pt')
+            torch.save(checkpoint_contents(model, hparams), os.path.join(output_dir, f'checkpoint_epoch={epoch}.pt'))
             
         train_losses.append(train_loss / len(train_iter))
         val_losses.append(val_loss / len(val_iter))
@@ -450,10 +470,15 @@ def train(train_iter, val_iter, model, optimizer, scheduler, hparams):
         
     # Wrap up the training routine 
     msg_writer.write(f'Best epoch idx = {best_epoch}')
-    torch.save(model.state_dict(), 'checkpoint_final_epoch.pt')
+    torch.save(checkpoint_contents(model, hparams), os.path.join(output_dir, 'checkpoint_final_epoch.pt'))
     msg_writer.close()
     tb_writer.close()
     sample_writer.close()
+    
+    return dict(
+        train_losses = train_losses, val_losses = val_losses, 
+        step_losses = step_losses, step_seconds = step_seconds, step_tokens = step_tokens, 
+    )
 
 
 
@@ -462,11 +487,21 @@ def train(train_iter, val_iter, model, optimizer, scheduler, hparams):
 # Note: for T5 specifically, the start-sequence token is <pad> instead of <s>
 '''
 
-def generate_translation(model, src_text): 
+def generate_translation(model, src_text, num_beams = 4, draft = None, num_draft_tokens = 4): 
+    '''
+    With a `draft` model (a MyTransformer from Transformer_From_Scratch, see speculative_greedy_ids()), greedy search 
+    is run speculatively: same translation as num_beams = 1, fewer T5 decoder passes. 
+    '''
     model.eval()
     
     src_ids = srcTokenizer.encode(src_text)
-    src_ids = torch.LongTensor(src_ids).unsqueeze(0).to(device)
+    src_ids = torch.LongTensor(src_ids).unsqueeze(0).to(model.device)
+    
+    if draft is not None: 
+        if num_beams != 1: 
+            raise ValueError('speculative decoding reproduces greedy search, pass num_beams = 1 with a draft model')
+        ids, _ = speculative_greedy_ids(model, draft, src_ids, hparams['max_length'], num_draft_tokens)
+        return tgtTokenizer.decode(ids)
     
     outs = model.generate(
         src_ids, 
@@ -474,19 +509,94 @@ def generate_translation(model, src_text):
         bos_token_id = None, 
         eos_token_id = tgt_eos_id, 
         pad_token_id = tgt_pad_id,
-        num_beams = 4,    # Use "beam search" algorithm with 4 beams
+        num_beams = num_beams,    # Use "beam search" algorithm with 4 beams by default
         repetition_penalty = 2.5, 
         length_penalty = 0.6, 
         early_stopping = True, 
     )
     
-    # If any token id beyond vocab size, make it pad so that decoding will not report error 
-    outs = outs.masked_fill(outs >= tgtTokenizer.get_piece_size(), tgt_pad_id)
-    
     pred_text = tgtTokenizer.decode(outs[0].tolist())
     return pred_text
-    
-    
+
+
+'''
+# Speculative greedy decoding with a small draft model 
+# The transformer from scratch decodes into the same en.model vocabulary, so it can cheaply guess the next few tokens 
+# and T5 checks all of them in a single decoder pass. T5 keeps the guesses that match its own greedy choice, plus one 
+# token of its own, so the translation is exactly that of generate_translation(num_beams = 1) with fewer T5 passes. 
+'''
+
+def crop_decoder_cache(cache, length): 
+    '''
+    Keep the first `length` positions of T5's decoder self-attention cache; the cross-attention cache never changes. 
+    A negative crop() drops that many positions in transformers 4.x and 5.x alike (a positive one is deprecated in 5.x). 
+    '''
+    if isinstance(cache, tuple):    # legacy format, per layer (self key, self value, cross key, cross value) 
+        return tuple((layer[0][:, :, :length], layer[1][:, :, :length]) + tuple(layer[2:]) for layer in cache)
+    excess = cache.get_seq_length() - length
+    if excess > 0:    # crop(0) would empty the cache in 4.x 
+        cache.crop(-excess)
+    return cache
+
+
+def draft_greedy_tokens(draft, memory, ids, num_tokens, penalty): 
+    '''
+    The next `num_tokens` tokens after the T5 decoder ids `ids` (<pad> first) as the draft decodes them greedily, 
+    stopping after </s>. The draft starts from <s> instead of <pad> and gets the same repetition penalty as T5, 
+    so its guesses follow T5's choices more often. 
+    '''
+    guesses = []
+    for _ in range(num_tokens): 
+        tgt = torch.LongTensor([[tgt_bos_id] + ids[1:] + guesses]).to(memory.device)
+        np_mask = torch.triu(torch.ones(tgt.size(1), tgt.size(1), dtype = torch.bool, device = memory.device), diagonal = 1)
+        hidden = draft.decoder(draft.pos_encoder(draft.target_embedding(tgt)), memory, tgt_mask = np_mask)
+        logits = draft.out(hidden[:, -1]).float()    # MyTransformer.decode() would project every position onto the vocabulary 
+        guesses.append(penalty(torch.LongTensor([ids + guesses]).to(memory.device), logits).argmax(dim = -1).item())
+        if guesses[-1] == tgt_eos_id: 
+            break 
+    return guesses
+
+
+def speculative_greedy_ids(model, draft, src_ids, max_length = 100, num_draft_tokens = 4, repetition_penalty = 2.5): 
+    '''
+    Greedy search of T5 (`model`) for one sentence (src_ids: 1 * len(src)), sped up by a draft model with the same 
+    source and target vocabularies, e.g. a MyTransformer. Each round the draft guesses up to num_draft_tokens tokens, 
+    T5 scores them in one pass over its kv cache, and the longest prefix matching T5's own repetition-penalized argmax 
+    is kept together with T5's token after it. The cache is then cropped back to the kept tokens. 
+    Return the ids as generate() would (the <pad> decoder start first, </s> last unless max_length was reached) and 
+    counts: drafted and accepted guesses and T5 decoder passes. 
+    '''
+    penalty = RepetitionPenaltyLogitsProcessor(repetition_penalty)
+    stats = dict(drafted = 0, accepted = 0, target_passes = 0)
+    ids = [model.config.decoder_start_token_id]
+    cache, cached = None, 0    # T5 decoder kv cache and the number of positions in it 
+    with torch.inference_mode(): 
+        encoder_outputs = model.get_encoder()(input_ids = src_ids)
+        memory = draft.encode(src_ids)
+        while len(ids) < max_length and ids[-1] != tgt_eos_id: 
+            guesses = draft_greedy_tokens(draft, memory, ids, min(num_draft_tokens, max_length - len(ids) - 1), penalty)
+            outputs = model(
+                encoder_outputs = encoder_outputs, 
+                decoder_input_ids = torch.LongTensor([ids[cached:] + guesses]).to(src_ids.device), 
+                past_key_values = cache, 
+                use_cache = True, 
+            )
+            logits = outputs.logits[0, -(len(guesses) + 1):].float()    # T5's prediction after ids and after each guess 
+            stats['drafted'] += len(guesses)
+            stats['target_passes'] += 1
+            for j in range(len(guesses) + 1): 
+                choice = penalty(torch.LongTensor([ids]).to(src_ids.device), logits[j : j + 1]).argmax(dim = -1).item()
+                ids.append(choice)
+                if j == len(guesses) or choice != guesses[j]: 
+                    break 
+                stats['accepted'] += 1
+                if choice == tgt_eos_id or len(ids) >= max_length: 
+                    break 
+            cached = len(ids) - 1    # every kept token but the last was an input of this pass 
+            cache = crop_decoder_cache(outputs.past_key_values, cached)
+    return ids, stats
+
+
 
 # --------------------------
 #### Section 5: Instantiate and train! 
@@ -499,6 +609,7 @@ def generate_translation(model, src_text):
     # Instantiate optimizer and scheduler 
     # Instantiate the batch iterator 
     # Start training 
+# Other scripts (e.g. T5_benchmark.py) import this file for the helpers and `hparams`, so the training run only starts when T5.py is run directly 
 '''
 
 
@@ -517,63 +628,213 @@ hparams = dict(
     adam_betas = (0.9, 0.98), 
     # adam_eps = 1e-9, 
     max_length = 100,    # max length of sequence to be generated 
+    output_dir = '.',    # Where logs and checkpoints are written 
+    bf16 = False,    # bf16 autocast for the forward pass, weights stay fp32. Needs a CPU with native bf16 (AVX512-BF16/AMX) or an Ampere+ GPU to be faster 
+    gradient_checkpointing = False,    # Recompute block activations in backward: much less activation memory for a larger train_batch_size, slower steps. See `python T5_benchmark.py checkpointing` 
+    optimizer = 'adamw',    # 'adamw', or 'adafactor' for factored second moments and no first moment: the optimizer state shrinks from 2x the weights to a small fraction. See `python T5_benchmark.py optimizer` 
+    base_checkpoint = None,    # state_dict to start from, e.g. T5_checkpoint_best_epoch=44.pt. None --> the pretrained t5-small 
+    lora_rank = 0,    # > 0 freezes the base weights and trains rank-r adapters in the attention projections instead. See `python T5_benchmark.py lora` 
+    lora_alpha = 16,    # The adapter update is scaled by lora_alpha / lora_rank 
+    lora_train_embeddings = True,    # With LoRA, also train the right-sized embeddings. Needed on t5-small, whose Tibetan rows are new 
 )
 
-T5model = T5ForConditionalGeneration.from_pretrained(
-    't5-small', 
-    return_dict = True, 
-    # bos_token_id = tgt_pad_id,    # T5 starts generation with <pad> token, so I delete this line to avoid disruption
-    eos_token_id = tgt_eos_id, 
-    pad_token_id = tgt_pad_id, 
-    decoder_start_token_id = tgt_pad_id,   # If I don't add this line, then all predictions start with <unk>
-    dropout_rate = hparams['dropout'], 
-    max_length = hparams['max_length'], 
-).to(device)
-
-optimizer_grouped_parameters = [
-    {
-        # parameters with weight decay 
-        'params': [param for name, param in T5model.named_parameters() if ('bias' not in name and 'layer_norm.weight' not in name)], 
-        'weight_decay': hparams['weight_decay'], 
-    }, 
-    {
-        # parameters without weight decay
-        'params': [param for name, param in T5model.named_parameters() if ('bias' in name or 'layer_norm.weight' in name)], 
-        'weight_decay': 0.0, 
-    }
-]
-
-optimizer = AdamW(
-    optimizer_grouped_parameters, 
-    lr = hparams['target_lr'], 
-    betas = hparams['adam_betas'],
-)
+def pretrained_vocabulary_rows(tokenizer): 
+    '''
+    For each piece of our SentencePiece `tokenizer`, the row of the same piece in t5-small's vocabulary, or -1 if it has none. 
+    t5-small names its special tokens like ours (<pad>, </s>, <unk>), so those carry over too. Most English pieces are found, 
+    Tibetan pieces are not. 
+    '''
+    t5_vocab = AutoTokenizer.from_pretrained('t5-small').get_vocab()
+    return [t5_vocab.get(tokenizer.id_to_piece(i), -1) for i in range(tokenizer.get_piece_size())]
 
-# The scheduler first warm up to the target learning rate and then decay according to a cosine function
-scheduler = get_cosine_with_hard_restarts_schedule_with_warmup(
-    optimizer, 
-    num_warmup_steps = hparams['warmup_steps'], 
-    num_training_steps = hparams['num_epochs'] * math.ceil(len(srcTextsAll) / hparams['train_batch_size']), 
-    num_cycles = 3
-)
 
-train_mbi = MyBatchIterator(
-    srcTextsAll, tgtTextsAll, srcTokenizer, tgtTokenizer,
-    start_idx = 0, 
-    end_idx = int(hparams['train_percentage'] * len(srcTextsAll)), 
-    batch_size = hparams['train_batch_size'], 
-    src_pad_id = src_pad_id, tgt_pad_id = tgt_pad_id, 
-    tgt_bos_id = tgt_pad_id, tgt_eos_id = tgt_eos_id
-    # Note: set tgt_bos_id to <pad> because T5 model requires shifting target texts by a <pad> token at the beginning 
-)
+def build_model(hparams, state_dict = None): 
+    '''
+    t5-small set up for our tokenizers, with the embeddings and LM head right-sized to our vocabularies. 
+    Our pieces start from t5-small's embedding of the same piece where it has one. 
+    Pass `state_dict` to load a fine-tuned checkpoint (e.g. T5_checkpoint_best_epoch=44.pt) instead of the pretrained weights. 
+    '''
+    model = T5ForConditionalGeneration.from_pretrained(
+        't5-small', 
+        return_dict = True, 
+        # bos_token_id = tgt_pad_id,    # T5 starts generation with <pad> token, so I delete this line to avoid disruption
+        eos_token_id = tgt_eos_id, 
+        pad_token_id = tgt_pad_id, 
+        decoder_start_token_id = tgt_pad_id,   # If I don't add this line, then all predictions start with <unk>
+        dropout_rate = hparams['dropout'], 
+        max_length = hparams['max_length'], 
+    )
+    if state_dict is None: 
+        right_size_vocabularies(model, pretrained_vocabulary_rows(srcTokenizer), pretrained_vocabulary_rows(tgtTokenizer))
+    else: 
+        right_size_vocabularies(model, range(srcTokenizer.get_piece_size()), range(tgtTokenizer.get_piece_size()))
+        model.load_state_dict(convert_full_vocab_state_dict(state_dict, srcTokenizer.get_piece_size(), tgtTokenizer.get_piece_size()))
+    return model.to(device)
+
+
+'''
+# Low-rank adapters (LoRA, Hu et al., 2021): with hparams['lora_rank'] > 0 the base weights are frozen and the q, k, v and o 
+# projections of every attention block learn a low-rank update B @ A instead. AdamW keeps moments only for what trains, 
+# and train() saves only that. merge_lora_adapters() folds the updates into the weights, which gives back a plain T5 that 
+# generates at the cost of the base model. 
+'''
+
+class LoRALinear(nn.Module): 
+    '''
+    A frozen nn.Linear plus a trainable low-rank update: base(x) + (alpha / rank) * x A^T B^T. A (rank * in_features) is 
+    initialized like nn.Linear and B (out_features * rank) with zeros, so training starts from the base model exactly. 
+    '''
+    def __init__(self, base, rank, alpha): 
+        super(LoRALinear, self).__init__()
+        self.base = base
+        self.lora_A = nn.Parameter(torch.empty(rank, base.in_features, device = base.weight.device))
+        self.lora_B = nn.Parameter(torch.zeros(base.out_features, rank, device = base.weight.device))
+        nn.init.kaiming_uniform_(self.lora_A, a = math.sqrt(5))
+        self.scaling = alpha / rank
+    
+    def forward(self, x): 
+        return self.base(x) + (x @ self.lora_A.t() @ self.lora_B.t()) * self.scaling
+    
+    def merged(self): 
+        '''The base nn.Linear with the update added to its weight. '''
+        with torch.no_grad(): 
+            self.base.weight += (self.lora_B @ self.lora_A).to(self.base.weight.dtype) * self.scaling
+        return self.base
+
+
+def add_lora_adapters(model, hparams): 
+    '''
+    Freeze `model` and wrap the q, k, v and o projections of every attention block in a LoRALinear of hparams['lora_rank']. 
+    With hparams['lora_train_embeddings'] the encoder embedding and the shared decoder embedding (tied to the LM head) train too. 
+    '''
+    model.requires_grad_(False)
+    for module in list(model.modules()): 
+        if isinstance(module, T5Attention): 
+            for name in ['q', 'k', 'v', 'o']: 
+                setattr(module, name, LoRALinear(getattr(module, name), hparams['lora_rank'], hparams['lora_alpha']))
+    if hparams['lora_train_embeddings']: 
+        model.shared.requires_grad_(True)
+        model.encoder.embed_tokens.requires_grad_(True)
+    return model
+
+
+def merge_lora_adapters(model): 
+    '''Fold every LoRALinear into its base weight, in place. Return the model, now a plain T5 with no adapter overhead. '''
+    for module in list(model.modules()): 
+        for name, child in list(module.named_children()): 
+            if isinstance(child, LoRALinear): 
+                setattr(module, name, child.merged())
+    return model
+
+
+def checkpoint_contents(model, hparams): 
+    '''
+    What train() saves: the state_dict, or with LoRA only the trained tensors (adapters, and the embeddings when they train) 
+    together with the LoRA hparams, which load_lora_checkpoint() needs to rebuild the model. 
+    '''
+    if not hparams['lora_rank']: 
+        return model.state_dict()
+    trained = {name for name, param in model.named_parameters() if param.requires_grad}
+    return dict(
+        lora = {key: hparams[key] for key in ['base_checkpoint', 'lora_rank', 'lora_alpha', 'lora_train_embeddings']}, 
+        state_dict = {name: tensor for name, tensor in model.state_dict().items() if name in trained}, 
+    )
+
+
+def build_base_model(hparams): 
+    '''build_model() from hparams['base_checkpoint'], or from the pretrained t5-small without one. '''
+    if hparams['base_checkpoint'] is None: 
+        return build_model(hparams)
+    return build_model(hparams, state_dict = torch.load(hparams['base_checkpoint'], map_location = 'cpu'))
+
+
+def load_lora_checkpoint(path, merge = True): 
+    '''
+    Rebuild the model from a checkpoint that train() saved with LoRA: the base model with the saved adapters and embeddings, 
+    merged into a plain T5 unless merge = False. The base checkpoint (or t5-small) has to be at hand. 
+    '''
+    checkpoint = torch.load(path, map_location = 'cpu')
+    lora_hparams = dict(hparams, **checkpoint['lora'])
+    model = add_lora_adapters(build_base_model(lora_hparams), lora_hparams)
+    unexpected = model.load_state_dict(checkpoint['state_dict'], strict = False).unexpected_keys
+    if unexpected: 
+        raise ValueError(f'{path} does not fit the adapters of its LoRA hparams, unexpected keys: {unexpected[:5]}')
+    return merge_lora_adapters(model).eval() if merge else model.eval()
+
+
+def build_training(hparams): 
+    '''Instantiate the model, optimizer, scheduler and batch iterators for `hparams`. '''
+    model = build_base_model(hparams)
+    if hparams['lora_rank']: 
+        if hparams['base_checkpoint'] is None and not hparams['lora_train_embeddings']: 
+            raise ValueError('LoRA on t5-small needs lora_train_embeddings, because the Tibetan embedding rows are new')
+        add_lora_adapters(model, hparams)
+    if hparams['gradient_checkpointing']: 
+        # Recompute each T5 block's activations in backward instead of storing them (the kv cache is off while training anyway) 
+        model.gradient_checkpointing_enable(gradient_checkpointing_kwargs = {'use_reentrant': False})
+    
+    optimizer_grouped_parameters = [
+        {
+            # parameters with weight decay 
+            'params': [param for name, param in model.named_parameters() if param.requires_grad and ('bias' not in name and 'layer_norm.weight' not in name)], 
+            'weight_decay': hparams['weight_decay'], 
+        }, 
+        {
+            # parameters without weight decay
+            'params': [param for name, param in model.named_parameters() if param.requires_grad and ('bias' in name or 'layer_norm.weight' in name)], 
+            'weight_decay': 0.0, 
+        }
+    ]
+    
+    if hparams['optimizer'] == 'adafactor': 
+        # Factored second moments (Shazeer & Stern, 2018), with the learning rate from the scheduler instead of Adafactor's relative step size 
+        optimizer = Adafactor(
+            optimizer_grouped_parameters, 
+            lr = hparams['target_lr'], 
+            scale_parameter = False, 
+            relative_step = False, 
+            warmup_init = False, 
+        )
+    elif hparams['optimizer'] == 'adamw': 
+        optimizer = AdamW(
+            optimizer_grouped_parameters, 
+            lr = hparams['target_lr'], 
+            betas = hparams['adam_betas'],
+            eps = 1e-6,    # the default of the transformers AdamW this used to be 
+        )
+    else: 
+        raise ValueError(f"hparams['optimizer'] must be 'adamw' or 'adafactor', not {hparams['optimizer']!r}")
+    
+    train_mbi = MyBatchIterator(
+        srcTextsAll, tgtTextsAll, srcTokenizer, tgtTokenizer,
+        start_idx = 0, 
+        end_idx = int(hparams['train_percentage'] * len(srcTextsAll)), 
+        batch_size = hparams['train_batch_size'], 
+        src_pad_id = src_pad_id, tgt_pad_id = tgt_pad_id, 
+        tgt_bos_id = tgt_pad_id, tgt_eos_id = tgt_eos_id
+        # Note: set tgt_bos_id to <pad> because T5 model requires shifting target texts by a <pad> token at the beginning 
+    )
+    
+    val_mbi = MyBatchIterator(
+        srcTextsAll, tgtTextsAll, srcTokenizer, tgtTokenizer,
+        start_idx = int(hparams['train_percentage'] * len(srcTextsAll)),
+        end_idx = int((hparams['train_percentage'] + hparams['val_percentage']) * len(srcTextsAll)), 
+        batch_size = hparams['val_batch_size'], 
+        src_pad_id = src_pad_id, tgt_pad_id = tgt_pad_id, 
+        tgt_bos_id = tgt_pad_id, tgt_eos_id = tgt_eos_id
+    )
+    
+    # The scheduler first warm up to the target learning rate and then decay according to a cosine function
+    scheduler = get_cosine_with_hard_restarts_schedule_with_warmup(
+        optimizer, 
+        num_warmup_steps = hparams['warmup_steps'], 
+        num_training_steps = hparams['num_epochs'] * len(train_mbi), 
+        num_cycles = 3
+    )
+    
+    return model, optimizer, scheduler, train_mbi, val_mbi
 
-val_mbi = MyBatchIterator(
-    srcTextsAll, tgtTextsAll, srcTokenizer, tgtTokenizer,
-    start_idx = int(hparams['train_percentage'] * len(srcTextsAll)),
-    end_idx = int((hparams['train_percentage'] + hparams['val_percentage']) * len(srcTextsAll)), 
-    batch_size = hparams['val_batch_size'], 
-    src_pad_id = src_pad_id, tgt_pad_id = tgt_pad_id, 
-    tgt_bos_id = tgt_pad_id, tgt_eos_id = tgt_eos_id
-)
 
-train(iter(train_mbi), iter(val_mbi), T5model, optimizer, scheduler, hparams)
+if __name__ == '__main__': 
+    T5model, optimizer, scheduler, train_mbi, val_mbi = build_training(hparams)
+    train(iter(train_mbi), iter(val_mbi), T5model, optimizer, scheduler, hparams)
@@ -0,0 +1,638 @@
+# =======================================
+##### Benchmarks for the fine-tuned T5 transformer
+# =======================================
+
+'''
+# Run from this folder, e.g.
+#   python T5_benchmark.py quantize --checkpoint T5_checkpoint_best_epoch=44.pt --output T5_checkpoint_int8.pt
+#   python T5_benchmark.py bf16 --num-epochs 1 --train-percentage 0.05
+#   python T5_benchmark.py checkpointing --memory-budget-mb 8000
+#   python T5_benchmark.py optimizer --num-epochs 1 --train-percentage 0.05
+#   python T5_benchmark.py coldstart --checkpoint T5_checkpoint_best_epoch=44.pt --output T5_inference.safetensors
+#   python T5_benchmark.py lora --ranks 8 16 --base-checkpoint T5_checkpoint_best_epoch=44.pt
+#   python T5_benchmark.py speculative --checkpoint T5_inference.safetensors --draft ../Transformer_From_Scratch/Scratch_inference.safetensors
+#   python T5_benchmark.py speculative-parity --eval-size 10
+#   python T5_benchmark.py onnx --checkpoint T5_inference.safetensors
+# Importing T5.py loads the corpus and tokenizers, but does not start a training run.
+# Every benchmark prints a table and writes the raw numbers to a json file in --output-dir.
+'''
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+# The reporting helpers of the bo_translate package and the benchmark helpers of benchmarks/ are shared from the repository root
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(SCRIPT_DIR)
+sys.path.insert(0, REPO_ROOT)
+from bo_translate.reporting import corpus_bleu, percentile, print_table
+from benchmarks.common import (
+    test_split, train_batch_iterator, first_train_batch, short_run_hparams, step_stats, moving_average, train_step,
+    weights_megabytes, optimizer_state_megabytes, saved_activation_megabytes, peak_train_step_megabytes, largest_fitting_batch,
+    launch_and_time, onnx_logit_difference, write_json
+)
+
+from T5 import (
+    srcTextsAll, tgtTextsAll, srcTokenizer, tgtTokenizer, srcTokenizerPath, tgtTokenizerPath, hparams, device, src_pad_id, tgt_pad_id, tgt_eos_id,
+    MyBatchIterator,
+    build_model, build_training, train, compute_loss, generate_translation, speculative_greedy_ids,
+    quantize_dynamic_int8, save_quantized_model, load_quantized_model, save_inference_checkpoint, load_inference_checkpoint,
+    checkpoint_contents, load_lora_checkpoint
+)
+
+# The MyBatchIterator arguments of T5.build_training() other than the range and batch size
+BATCH_OPTIONS = dict(
+    srcTexts = srcTextsAll, tgtTexts = tgtTextsAll, srcTokenizer = srcTokenizer, tgtTokenizer = tgtTokenizer,
+    src_pad_id = src_pad_id, tgt_pad_id = tgt_pad_id, tgt_bos_id = tgt_pad_id, tgt_eos_id = tgt_eos_id
+)
+
+
+
+# --------------------------
+#### Helpers
+# --------------------------
+
+def val_split(size):
+    '''The first `size` sentence pairs of the validation split of T5.hparams. '''
+    start = int(hparams['train_percentage'] * len(srcTextsAll))
+    return srcTextsAll[start:start + size], tgtTextsAll[start:start + size]
+
+
+def translate_and_time(translate, src_texts):
+    '''Translate one sentence at a time with `translate(src_text) -> tgt_text`. Return the translations and per-sentence latencies in seconds. '''
+    translate(src_texts[0])    # Warm up, so one-off allocations are not timed
+    hypotheses, latencies = [], []
+    for text in src_texts:
+        start = time.perf_counter()
+        hypotheses.append(translate(text))
+        latencies.append(time.perf_counter() - start)
+    return hypotheses, latencies
+
+
+
+# --------------------------
+#### Benchmark: dynamic int8 quantization
+# --------------------------
+
+'''
+# Quantize a fine-tuned fp32 checkpoint with T5.quantize_dynamic_int8(), save the artifact to --output,
+# then reload it the way T5_get_results.py does and compare it with fp32 on the held-out split.
+'''
+
+def benchmark_quantize(args):
+    test_src, test_tgt = test_split(srcTextsAll, tgtTextsAll, hparams, args.eval_size)
+
+    fp32_model = build_model(hparams, state_dict = torch.load(args.checkpoint, map_location = 'cpu')).to('cpu')
+    fp32_model.eval()
+    save_quantized_model(quantize_dynamic_int8(fp32_model), args.output)
+    print('Quantized model saved to', args.output)
+    int8_model = load_quantized_model(args.output)
+
+    results = []
+    for name, model in [('fp32', fp32_model), ('int8', int8_model)]:
+        hyps, latencies = translate_and_time(lambda text: generate_translation(model, text, num_beams = args.num_beams), test_src)
+        results.append(dict(
+            model = name,
+            weights_MB = weights_megabytes(model),
+            bleu = round(corpus_bleu(hyps, test_tgt), 2),
+            p50_ms = round(percentile(latencies, 50) * 1000, 1),
+            p90_ms = round(percentile(latencies, 90) * 1000, 1),
+        ))
+
+    print(f'\nHeld-out sentences: {len(test_src)}, beams: {args.num_beams}, CPU threads: {torch.get_num_threads()}')
+    print_table(results, list(results[0].keys()))
+    write_json(args, 'quantize_benchmark.json', results)
+
+
+
+# --------------------------
+#### Benchmark: bf16 autocast fine-tuning
+# --------------------------
+
+'''
+# Fine-tune the same short run twice from the same seed, in fp32 and with hparams['bf16'] = True.
+# Reports step time, tokens/sec and activation memory, then checks that the bf16 loss curve tracks fp32:
+# the smoothed per-step train loss and the per-epoch val loss must stay within --tolerance (relative).
+'''
+
+def benchmark_bf16(args):
+    results, histories = [], {}
+
+    for name, bf16 in [('fp32', False), ('bf16', True)]:
+        run_hparams = short_run_hparams(hparams, args, f'bf16_{name}', bf16 = bf16)
+        torch.manual_seed(args.seed)
+        model, optim, scheduler, train_mbi, val_mbi = build_training(run_hparams)
+        activation_MB = saved_activation_megabytes(compute_loss, model, next(iter(train_mbi)), run_hparams)
+        print(f'Fine-tuning {name} for {args.num_epochs} epoch(s)...')
+        histories[name] = train(iter(train_mbi), iter(val_mbi), model, optim, scheduler, run_hparams)
+        results.append(dict(
+            precision = name,
+            **step_stats(histories[name]),
+            activation_MB = activation_MB,
+            train_loss = round(histories[name]['train_losses'][-1], 3),
+            val_loss = round(histories[name]['val_losses'][-1], 3),
+        ))
+        del model, optim
+
+    fp32_curve = moving_average(histories['fp32']['step_losses'], args.window)
+    bf16_curve = moving_average(histories['bf16']['step_losses'], args.window)
+    curve_diff = max(abs(b - f) / f for f, b in zip(fp32_curve, bf16_curve))
+    val_diff = max(abs(b - f) / f for f, b in zip(histories['fp32']['val_losses'], histories['bf16']['val_losses']))
+    parity = dict(
+        max_rel_diff_train_curve = round(curve_diff, 4),
+        max_rel_diff_val_loss = round(val_diff, 4),
+        passed = curve_diff <= args.tolerance and val_diff <= args.tolerance,
+    )
+
+    print(f'\nTrain steps: {len(fp32_curve)}, CPU threads: {torch.get_num_threads()}')
+    print_table(results, list(results[0].keys()))
+    print(f"Loss-curve parity ({args.window}-step moving average, tolerance {args.tolerance}): {'PASS' if parity['passed'] else 'FAIL'}. "
+          f"Max relative difference: train curve {parity['max_rel_diff_train_curve']}, val loss {parity['max_rel_diff_val_loss']}")
+    write_json(args, 'bf16_benchmark.json', dict(results = results, parity = parity, step_losses = {name: h['step_losses'] for name, h in histories.items()}))
+
+
+
+# --------------------------
+#### Benchmark: memory-light optimizer state
+# --------------------------
+
+'''
+# Fine-tune the same short run with hparams['optimizer'] = 'adamw' and 'adafactor', both under the cosine-with-restarts
+# scheduler of T5.build_training(), and compare the optimizer state memory, step time and convergence. Adafactor's
+# state is a row and a column vector per matrix instead of two full copies of the weights. Convergence counts as matching
+# when the final --window-step moving average of the train loss and the final val loss agree within --tolerance.
+'''
+
+def benchmark_optimizer(args):
+    results, histories = [], {}
+
+    for name in ['adamw', 'adafactor']:
+        run_hparams = short_run_hparams(hparams, args, f'optimizer_{name}', optimizer = name)
+        torch.manual_seed(args.seed)
+        model, optimizer, scheduler, train_mbi, val_mbi = build_training(run_hparams)
+        print(f'Fine-tuning with {name} for {args.num_epochs} epoch(s)...')
+        histories[name] = train(iter(train_mbi), iter(val_mbi), model, optimizer, scheduler, run_hparams)
+        results.append(dict(
+            optimizer = name,
+            weights_MB = round(sum(p.numel() * p.element_size() for p in model.parameters()) / 2**20, 1),
+            state_MB = optimizer_state_megabytes(optimizer),
+            **step_stats(histories[name]),
+            train_loss = round(moving_average(histories[name]['step_losses'], args.window)[-1], 3),
+            val_loss = round(histories[name]['val_losses'][-1], 3),
+        ))
+        del model, optimizer
+
+    adamw, adafactor = results
+    convergence = dict(
+        rel_diff_train_loss = round(abs(adafactor['train_loss'] - adamw['train_loss']) / adamw['train_loss'], 4),
+        rel_diff_val_loss = round(abs(adafactor['val_loss'] - adamw['val_loss']) / adamw['val_loss'], 4),
+    )
+    convergence['passed'] = max(convergence.values()) <= args.tolerance
+
+    print(f"\nTrain steps: {len(histories['adamw']['step_losses'])}, device: {device}, CPU threads: {torch.get_num_threads()}")
+    print_table(results, list(results[0].keys()))
+    print(f"Convergence (final {args.window}-step moving average train loss and val loss, tolerance {args.tolerance}): {'PASS' if convergence['passed'] else 'FAIL'}. "
+          f"Relative difference: train {convergence['rel_diff_train_loss']}, val {convergence['rel_diff_val_loss']}")
+    write_json(args, 'optimizer_benchmark.json', dict(results = results, convergence = convergence, step_losses = {name: h['step_losses'] for name, h in histories.items()}))
+
+
+
+# --------------------------
+#### Benchmark: gradient checkpointing
+# --------------------------
+
+'''
+# For hparams['gradient_checkpointing'] off and on: the largest train batch whose training step fits in
+# --memory-budget-mb (peak memory of one step on the first N training pairs; estimated on CPU, measured on GPU,
+# where running out of memory also counts as not fitting), and tokens/sec over --steps steps at --batch-size and
+# at that largest batch.
+'''
+
+def benchmark_checkpointing(args):
+    limit = min(args.max_batch_size, int(hparams['train_percentage'] * len(srcTextsAll)))
+    results = []
+
+    for checkpointing in [False, True]:
+        run_hparams = dict(hparams, gradient_checkpointing = checkpointing)
+        torch.manual_seed(args.seed)
+        model, optimizer, _, _, _ = build_training(run_hparams)
+        peaks = {}
+
+        def fits(size):
+            try:
+                peaks[size] = peak_train_step_megabytes(compute_loss, model, optimizer, first_train_batch(MyBatchIterator, BATCH_OPTIONS, size), run_hparams)
+            except torch.cuda.OutOfMemoryError:
+                torch.cuda.empty_cache()
+                return False
+            return peaks[size] <= args.memory_budget_mb
+
+        largest = largest_fitting_batch(fits, limit)
+        print(f'gradient_checkpointing = {checkpointing}: largest batch within {args.memory_budget_mb} MB is {largest}')
+
+        for batch_size in sorted({args.batch_size, largest} - {0}):
+            history = dict(step_seconds = [], step_tokens = [])
+            for step, batch in zip(range(args.steps + 1), train_batch_iterator(MyBatchIterator, BATCH_OPTIONS, batch_size, limit)):
+                start = time.perf_counter()
+                train_step(compute_loss, model, optimizer, batch, run_hparams)
+                if step > 0:    # The first step allocates the AdamW state, don't time it
+                    history['step_seconds'].append(time.perf_counter() - start)
+                    history['step_tokens'].append((batch['tgt_ids'][:, 1:] != tgt_pad_id).sum().item())
+            results.append(dict(
+                checkpointing = checkpointing,
+                batch_size = batch_size,
+                largest_batch = largest,
+                peak_MB = peaks[batch_size] if batch_size in peaks else peak_train_step_megabytes(compute_loss, model, optimizer, first_train_batch(MyBatchIterator, BATCH_OPTIONS, batch_size), run_hparams),
+                **step_stats(history),
+            ))
+        del model, optimizer
+
+    print(f"\nMemory budget: {args.memory_budget_mb} MB ({'measured' if device.type == 'cuda' else 'estimated'}), "
+          f'timed steps: {args.steps}, device: {device}, CPU threads: {torch.get_num_threads()}')
+    print_table(results, list(results[0].keys()))
+    write_json(args, 'checkpointing_benchmark.json', results)
+
+
+
+# --------------------------
+#### Benchmark: cold start with inference checkpoints
+# --------------------------
+
+'''
+# Export --checkpoint as inference checkpoints (T5.save_inference_checkpoint(): one safetensors file with the config,
+# weights and tokenizer paths) in fp32 to --output and in bf16 next to it. Then launch T5_get_results.py in fresh processes
+# with the original checkpoint and with each export, and time from process launch until the model is loaded and until
+# the first translation is printed (median of --repeats launches). bf16 files are cast back to fp32 on load.
+# The original checkpoint goes through from_pretrained('t5-small'), so that launch needs the pretrained weights.
+'''
+
+def benchmark_coldstart(args):
+    bf16_output = args.output.replace('.safetensors', '_bf16.safetensors')
+    model = build_model(hparams, state_dict = torch.load(args.checkpoint, map_location = 'cpu')).to('cpu')
+    save_inference_checkpoint(model, args.output, (srcTokenizerPath, tgtTokenizerPath), dtype = torch.float32)
+    save_inference_checkpoint(model, bf16_output, (srcTokenizerPath, tgtTokenizerPath), dtype = torch.bfloat16)
+    print('Inference checkpoints saved to', args.output, 'and', bf16_output)
+    del model
+
+    results = []
+    for name, path in [('original', args.checkpoint), ('safetensors fp32', args.output), ('safetensors bf16', bf16_output)]:
+        launches = [launch_and_time([sys.executable, '-u', 'T5_get_results.py', path], ['Model loading', 'Translated 1/'], SCRIPT_DIR) for _ in range(args.repeats)]
+        results.append(dict(
+            checkpoint = name,
+            file_MB = round(os.path.getsize(path) / 2**20, 1),
+            model_loaded_s = round(percentile([launch['Model loading'] for launch in launches], 50), 2),
+            first_translation_s = round(percentile([launch['Translated 1/'] for launch in launches], 50), 2),
+        ))
+
+    print(f'\nLaunches per checkpoint: {args.repeats}, device: {device}')
+    print_table(results, list(results[0].keys()))
+    write_json(args, 'coldstart_benchmark.json', results)
+
+
+
+# --------------------------
+#### Benchmark: low-rank adapters
+# --------------------------
+
+'''
+# Full fine-tuning against LoRA (hparams['lora_rank']) at each of --ranks, with the embeddings trained and, given a
+# --base-checkpoint whose embeddings are already fine-tuned, without. For each: trainable parameters, the memory of the
+# AdamW state, median step time over --steps training steps and the size of the checkpoint train() saves. The LoRA
+# checkpoint is then reloaded and merged with T5.load_lora_checkpoint(), and the merged model must give the same logits as
+# the adapted one it was saved from. Generation latency on the validation split shows that merging removes the adapter cost.
+'''
+
+def benchmark_lora(args):
+    val_src, _ = val_split(args.eval_size)
+    limit = int(hparams['train_percentage'] * len(srcTextsAll))
+    configs = [('full', dict())]
+    for rank in args.ranks:
+        configs.append((f'lora r={rank} + embeddings', dict(lora_rank = rank, lora_train_embeddings = True)))
+        if args.base_checkpoint:
+            configs.append((f'lora r={rank}', dict(lora_rank = rank, lora_train_embeddings = False)))
+    os.makedirs(os.path.join(args.output_dir, 'lora'), exist_ok = True)
+
+    results = []
+    for name, overrides in configs:
+        run_hparams = dict(hparams, base_checkpoint = args.base_checkpoint, **overrides)
+        torch.manual_seed(args.seed)
+        model, optimizer, _, _, _ = build_training(run_hparams)
+        step_seconds = []
+        for step, batch in zip(range(args.steps + 1), train_batch_iterator(MyBatchIterator, BATCH_OPTIONS, args.batch_size, limit)):
+            start = time.perf_counter()
+            train_step(compute_loss, model, optimizer, batch, run_hparams)
+            if step > 0:    # The first step allocates the AdamW state, don't time it
+                step_seconds.append(time.perf_counter() - start)
+
+        path = os.path.join(args.output_dir, 'lora', name.replace(' ', '_').replace('=', '').replace('+_', '') + '.pt')
+        torch.save(checkpoint_contents(model, run_hparams), path)
+        row = dict(
+            model = name,
+            trainable_M = round(sum(p.numel() for p in model.parameters() if p.requires_grad) / 1e6, 2),
+            optimizer_MB = optimizer_state_megabytes(optimizer),
+            step_p50_ms = round(percentile(step_seconds, 50) * 1000, 1),
+            checkpoint_MB = round(os.path.getsize(path) / 2**20, 2),
+            merged_max_diff = None,
+            p50_ms = None,
+            adapted_p50_ms = None,
+        )
+        del optimizer
+        model.eval()
+        if run_hparams['lora_rank']:
+            merged = load_lora_checkpoint(path).to(device)
+            batch = first_train_batch(MyBatchIterator, BATCH_OPTIONS, args.batch_size)
+            with torch.no_grad():
+                logits = [m(input_ids = batch['src_ids'], attention_mask = batch['src_mask'], decoder_input_ids = batch['tgt_ids'][:, :-1]).logits for m in [model, merged]]
+            row['merged_max_diff'] = float(f'{(logits[0] - logits[1]).abs().max().item():.2g}')
+            _, adapted_latencies = translate_and_time(lambda text: generate_translation(model, text), val_src)
+            _, latencies = translate_and_time(lambda text: generate_translation(merged, text), val_src)
+            row['adapted_p50_ms'] = round(percentile(adapted_latencies, 50) * 1000, 1)
+            del merged
+        else:
+            _, latencies = translate_and_time(lambda text: generate_translation(model, text), val_src)
+        row['p50_ms'] = round(percentile(latencies, 50) * 1000, 1)
+        results.append(row)
+        print(results[-1], flush = True)
+        del model
+
+    print(f'\nBatch size: {args.batch_size}, timed steps: {args.steps}, validation sentences: {len(val_src)}, device: {device}, CPU threads: {torch.get_num_threads()}')
+    print('p50_ms: generation latency of the (merged) model, adapted_p50_ms: with the adapters unmerged')
+    print_table(results, list(results[0].keys()))
+    write_json(args, 'lora_benchmark.json', results)
+
+
+
+# --------------------------
+#### Benchmark: speculative decoding with a draft model
+# --------------------------
+
+'''
+# Greedy T5 on the validation split, plain (generate_translation(num_beams = 1)) and speculative with a MyTransformer
+# inference checkpoint as the draft (T5.speculative_greedy_ids()) for each --num-draft-tokens. Checks that every
+# speculative translation is identical to the plain one and reports the acceptance rate (accepted / drafted guesses),
+# tokens per T5 decoder pass, latency and the speedup over plain greedy. The draft is loaded with bo_translate, which
+# rebuilds MyTransformer from the checkpoint without importing Scratch.py. A shallower draft (e.g. trained with
+# `python Scratch_benchmark.py depth`) guesses faster but is accepted less often.
+'''
+
+def load_t5(path):
+    '''An inference checkpoint (*.safetensors) or a fine-tuned state_dict (*.pt). '''
+    if path.endswith('.safetensors'):
+        return load_inference_checkpoint(path, device)[0]
+    return build_model(hparams, state_dict = torch.load(path, map_location = 'cpu')).eval()
+
+
+def load_draft(path):
+    '''A MyTransformer inference checkpoint, loaded through the bo_translate package at the repository root. '''
+    # Imported here because only the speculative benchmarks need the Scratch model
+    from bo_translate.scratch import load_inference_checkpoint as load_scratch_checkpoint
+    return load_scratch_checkpoint(path, device)[0]
+
+
+def benchmark_speculative(args):
+    val_src, _ = val_split(args.eval_size)
+    model = load_t5(args.checkpoint)
+    draft = load_draft(args.draft)
+    print(f'Draft: {sum(p.numel() for p in draft.parameters()) / 1e6:.1f}M parameters, T5: {sum(p.numel() for p in model.parameters()) / 1e6:.1f}M')
+
+    greedy_hyps, greedy_latencies = translate_and_time(lambda text: generate_translation(model, text, num_beams = 1), val_src)
+    results = [dict(
+        decoding = 'greedy', num_draft_tokens = 0, identical = len(val_src), acceptance_rate = None, tokens_per_t5_pass = 1.0,
+        p50_ms = round(percentile(greedy_latencies, 50) * 1000, 1), mean_ms = round(1000 * sum(greedy_latencies) / len(val_src), 1), speedup = 1.0,
+    )]
+    for num_draft_tokens in args.num_draft_tokens:
+        totals = dict(drafted = 0, accepted = 0, target_passes = 0, tokens = 0)
+        def translate(text):
+            src_ids = torch.LongTensor([srcTokenizer.encode(text)]).to(device)
+            ids, stats = speculative_greedy_ids(model, draft, src_ids, hparams['max_length'], num_draft_tokens)
+            for key, value in stats.items():
+                totals[key] += value
+            totals['tokens'] += len(ids) - 1
+            return tgtTokenizer.decode(ids)
+        hyps, latencies = translate_and_time(translate, val_src)
+        results.append(dict(
+            decoding = 'speculative', num_draft_tokens = num_draft_tokens,
+            identical = sum(hyp == greedy_hyp for hyp, greedy_hyp in zip(hyps, greedy_hyps)),
+            acceptance_rate = round(totals['accepted'] / totals['drafted'], 3) if totals['drafted'] else None,
+            tokens_per_t5_pass = round(totals['tokens'] / totals['target_passes'], 2),
+            p50_ms = round(percentile(latencies, 50) * 1000, 1), mean_ms = round(1000 * sum(latencies) / len(val_src), 1),
+            speedup = round(sum(greedy_latencies) / sum(latencies), 2),
+        ))
+        print(results[-1], flush = True)
+
+    print(f'\nValidation sentences: {len(val_src)}, device: {device}, CPU threads: {torch.get_num_threads()}')
+    print_table(results, list(results[0].keys()))
+    if any(row['identical'] != len(val_src) for row in results):
+        print('WARNING: some speculative translations differ from greedy T5')
+    write_json(args, 'speculative_benchmark.json', results)
+
+
+'''
+# The equality check alone, quick enough to run after any change to T5.py: the first --eval-size sentences of the
+# held-out split, which neither training nor the speculative benchmark's validation sentences touch, translated with
+# generate_translation(num_beams = 1) and with the draft for each --num-draft-tokens. Compares the token ids, not only
+# the decoded text, and exits with status 1 on the first difference.
+'''
+
+def benchmark_speculative_parity(args):
+    test_src, _ = test_split(srcTextsAll, tgtTextsAll, hparams, args.eval_size)
+    model = load_t5(args.checkpoint)
+    draft = load_draft(args.draft)
+    results = []
+    for i, text in enumerate(test_src):
+        src_ids = torch.LongTensor([srcTokenizer.encode(text)]).to(device)
+        with torch.inference_mode():    # the same generate() call as generate_translation(), which only returns the text
+            greedy_ids = model.generate(
+                src_ids, max_length = hparams['max_length'], bos_token_id = None, eos_token_id = tgt_eos_id, pad_token_id = tgt_pad_id,
+                num_beams = 1, repetition_penalty = 2.5, length_penalty = 0.6, early_stopping = True,
+            )[0].tolist()
+        greedy_text = generate_translation(model, text, num_beams = 1)
+        for num_draft_tokens in args.num_draft_tokens:
+            ids, stats = speculative_greedy_ids(model, draft, src_ids, hparams['max_length'], num_draft_tokens)
+            results.append(dict(
+                sentence = i, num_draft_tokens = num_draft_tokens, tokens = len(ids) - 1, accepted = stats['accepted'],
+                ids_equal = ids == greedy_ids, text_equal = tgtTokenizer.decode(ids) == greedy_text,
+            ))
+            if not (results[-1]['ids_equal'] and results[-1]['text_equal']):
+                write_json(args, 'speculative_parity.json', results)
+                sys.exit(f'Speculative decoding differs from generate_translation(num_beams = 1) on held-out sentence {i} '
+                         f'with --num-draft-tokens {num_draft_tokens}:\n  greedy      {greedy_ids}\n  speculative {ids}')
+
+    print(f'\nHeld-out sentences: {len(test_src)}, device: {device}')
+    print_table(results, list(results[0].keys()))
+    print(f'PASS: all {len(results)} speculative translations equal generate_translation(num_beams = 1), token for token')
+    write_json(args, 'speculative_parity.json', results)
+
+
+
+# --------------------------
+#### Benchmark: ONNX Runtime decoding
+# --------------------------
+
+'''
+# Export an inference checkpoint with bo_translate.onnx_export and translate the held-out split on the CPU with eager
+# PyTorch (generate_translation(), i.e. generate() with its kv cache) and with bo_translate.onnx_runtime: one sentence at
+# a time greedily and with beam search, then --batch-size sentences at a time greedily through the translators.
+# Parity: every ONNX greedy translation must equal generate_translation(num_beams = 1), and the logits of the decoder
+# step graph must stay within --tolerance of T5's along the ONNX greedy output. ONNX beam search ranks hypotheses like
+# the transformer from scratch rather than like generate(), so beam translations may differ; beam_identical counts them.
+'''
+
+def eager_logits(model, src_ids, decoder_ids):
+    '''Logits of T5 for every decoder id (the start token first), as a numpy array to compare with the ONNX decoder steps. '''
+    with torch.inference_mode():
+        return model(input_ids = torch.LongTensor([src_ids]), decoder_input_ids = torch.LongTensor([decoder_ids])).logits[0].float().numpy()
+
+
+def benchmark_onnx(args):
+    # Imported here because only this benchmark needs them
+    from bo_translate import load_translator, translate_window
+    from bo_translate.onnx_export import export_onnx
+    from bo_translate import onnx_runtime
+
+    test_src, test_tgt = test_split(srcTextsAll, tgtTextsAll, hparams, args.eval_size)
+    export_dir = args.export_dir or os.path.join(args.output_dir, 'onnx')
+    start = time.perf_counter()
+    export_onnx(args.checkpoint, export_dir)
+    export_secs = time.perf_counter() - start
+    onnx_MB = sum(os.path.getsize(os.path.join(export_dir, name)) for name in ['encoder.onnx', 'decoder.onnx']) / 2**20
+    print(f'Exported to {export_dir} in {export_secs:.1f} s ({onnx_MB:.1f} MB)')
+
+    model = load_inference_checkpoint(args.checkpoint, 'cpu')[0]
+    onnx_translator = onnx_runtime.Translator(export_dir, 'cpu', threads = torch.get_num_threads())
+    translators = [
+        ('PyTorch eager', lambda text, num_beams: generate_translation(model, text, num_beams = num_beams), load_translator(args.checkpoint, 'cpu')),
+        ('ONNX Runtime', lambda text, num_beams: onnx_translator.translate([text], num_beams = num_beams, max_len = hparams['max_length'])[0], onnx_translator),
+    ]
+
+    results, hypotheses = [], {}
+    for name, translate, translator in translators:
+        greedy_hyps, greedy_latencies = translate_and_time(lambda text: translate(text, 1), test_src)
+        beam_hyps, beam_latencies = translate_and_time(lambda text: translate(text, args.num_beams), test_src)
+        translate_window(translator, test_src[:args.batch_size], args.batch_size, dict(num_beams = 1))    # Warm up
+        start = time.perf_counter()
+        translate_window(translator, test_src, args.batch_size, dict(num_beams = 1))
+        batch_secs = time.perf_counter() - start
+        hypotheses[name] = greedy_hyps, beam_hyps
+        results.append(dict(
+            backend = name,
+            greedy_bleu = round(corpus_bleu(greedy_hyps, test_tgt), 2),
+            greedy_p50_ms = round(percentile(greedy_latencies, 50) * 1000, 1),
+            greedy_p90_ms = round(percentile(greedy_latencies, 90) * 1000, 1),
+            beam_bleu = round(corpus_bleu(beam_hyps, test_tgt), 2),
+            beam_p50_ms = round(percentile(beam_latencies, 50) * 1000, 1),
+            beam_p90_ms = round(percentile(beam_latencies, 90) * 1000, 1),
+            batched_sentences_per_sec = round(len(test_src) / batch_secs, 2),
+            greedy_identical = sum(hyp == ref for hyp, ref in zip(greedy_hyps, hypotheses['PyTorch eager'][0])),
+            beam_identical = sum(hyp == ref for hyp, ref in zip(beam_hyps, hypotheses['PyTorch eager'][1])),
+        ))
+        print(results[-1], flush = True)
+
+    differences = []
+    for text in test_src:
+        src_ids = srcTokenizer.encode(text)
+        generated = onnx_runtime.greedy_decode_batch(onnx_translator.model, [src_ids], src_pad_id, onnx_translator.start_id, tgt_eos_id, repetition_penalty = onnx_translator.repetition_penalty)[0][0]
+        decoder_ids = [onnx_translator.start_id] + generated
+        differences.append(onnx_logit_difference(eager_logits(model, src_ids, decoder_ids), onnx_translator.model, src_ids, decoder_ids))
+    parity = dict(
+        greedy_identical = results[1]['greedy_identical'],
+        max_logit_difference = max(differences),
+        passed = results[1]['greedy_identical'] == len(test_src) and max(differences) <= args.tolerance,
+    )
+
+    print(f'\nHeld-out sentences: {len(test_src)}, beams: {args.num_beams}, batch size: {args.batch_size}, CPU threads: {torch.get_num_threads()}')
+    print_table(results, list(results[0].keys()))
+    print(f"Parity with generate_translation(num_beams = 1) (logit tolerance {args.tolerance}): {'PASS' if parity['passed'] else 'FAIL'}. "
+          f"Identical greedy translations: {parity['greedy_identical']}/{len(test_src)}, max logit difference: {parity['max_logit_difference']:.2e}")
+    write_json(args, 'onnx_benchmark.json', dict(results = results, parity = parity, export_s = round(export_secs, 1), onnx_MB = round(onnx_MB, 1)))
+
+
+
+# --------------------------
+#### Command line
+# --------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmarks for the fine-tuned T5 transformer')
+    parser.add_argument('--output-dir', default = 'benchmark', help = 'where logs, checkpoints and json results go')
+    parser.add_argument('--threads', type = int, default = None, help = 'torch intra-op threads for CPU timing')
+    parser.add_argument('--seed', type = int, default = 0)
+    subparsers = parser.add_subparsers(dest = 'benchmark', required = True)
+
+    quantize = subparsers.add_parser('quantize', help = 'save a dynamic int8 model and compare it with fp32')
+    quantize.add_argument('--checkpoint', default = 'T5_checkpoint_best_epoch=44.pt', help = 'fp32 state_dict to quantize')
+    quantize.add_argument('--output', default = 'T5_checkpoint_int8.pt')
+    quantize.add_argument('--eval-size', type = int, default = 200)
+    quantize.add_argument('--num-beams', type = int, default = 4)
+    quantize.set_defaults(run = benchmark_quantize)
+
+    bf16 = subparsers.add_parser('bf16', help = 'fp32 vs. bf16 autocast fine-tuning: throughput, memory and loss-curve parity')
+    bf16.add_argument('--num-epochs', type = int, default = 1)
+    bf16.add_argument('--train-percentage', type = float, default = 0.05)
+    bf16.add_argument('--warmup-steps', type = int, default = 500)
+    bf16.add_argument('--window', type = int, default = 50, help = 'moving-average window for the train loss curves')
+    bf16.add_argument('--tolerance', type = float, default = 0.05, help = 'max relative loss difference for the parity check')
+    bf16.set_defaults(run = benchmark_bf16)
+
+    optimizer = subparsers.add_parser('optimizer', help = 'AdamW vs. Adafactor fine-tuning: optimizer state memory, step time and convergence')
+    optimizer.add_argument('--num-epochs', type = int, default = 1)
+    optimizer.add_argument('--train-percentage', type = float, default = 0.05)
+    optimizer.add_argument('--warmup-steps', type = int, default = 500)
+    optimizer.add_argument('--window', type = int, default = 50, help = 'moving-average window for the final train loss')
+    optimizer.add_argument('--tolerance', type = float, default = 0.05, help = 'max relative loss difference for the convergence check')
+    optimizer.set_defaults(run = benchmark_optimizer)
+
+    checkpointing = subparsers.add_parser('checkpointing', help = 'largest batch that fits and tokens/sec with gradient checkpointing off and on')
+    checkpointing.add_argument('--memory-budget-mb', type = float, default = 8000, help = 'memory a training step may use, e.g. the GPU memory')
+    checkpointing.add_argument('--max-batch-size', type = int, default = 1024)
+    checkpointing.add_argument('--batch-size', type = int, default = hparams['train_batch_size'], help = 'common batch size for the tokens/sec comparison')
+    checkpointing.add_argument('--steps', type = int, default = 20, help = 'timed training steps per batch size')
+    checkpointing.set_defaults(run = benchmark_checkpointing)
+
+    coldstart = subparsers.add_parser('coldstart', help = 'export inference checkpoints and time T5_get_results.py from launch to first translation')
+    coldstart.add_argument('--checkpoint', default = 'T5_checkpoint_best_epoch=44.pt', help = 'state_dict saved by T5.train()')
+    coldstart.add_argument('--output', default = 'T5_inference.safetensors', help = 'fp32 inference checkpoint, the bf16 one goes next to it')
+    coldstart.add_argument('--repeats', type = int, default = 5, help = 'launches per checkpoint')
+    coldstart.set_defaults(run = benchmark_coldstart)
+
+    lora = subparsers.add_parser('lora', help = 'full fine-tuning vs. low-rank adapters: step time, optimizer memory, checkpoint size and merge parity')
+    lora.add_argument('--ranks', type = int, nargs = '+', default = [8, 16])
+    lora.add_argument('--base-checkpoint', default = None, help = 'fine-tuned state_dict to start from, adds adapter-only rows; default: t5-small')
+    lora.add_argument('--batch-size', type = int, default = hparams['train_batch_size'])
+    lora.add_argument('--steps', type = int, default = 20, help = 'timed training steps per model')
+    lora.add_argument('--eval-size', type = int, default = 20, help = 'validation sentences for the generation latency')
+    lora.set_defaults(run = benchmark_lora)
+
+    speculative = subparsers.add_parser('speculative', help = 'speculative greedy decoding with a MyTransformer draft: parity, acceptance rate and speedup')
+    speculative.add_argument('--checkpoint', default = 'T5_inference.safetensors', help = 'T5 inference checkpoint or fine-tuned state_dict')
+    speculative.add_argument('--draft', default = '../Transformer_From_Scratch/Scratch_inference.safetensors', help = 'MyTransformer inference checkpoint')
+    speculative.add_argument('--num-draft-tokens', type = int, nargs = '+', default = [2, 4, 6], help = 'guesses per T5 pass')
+    speculative.add_argument('--eval-size', type = int, default = 200)
+    speculative.set_defaults(run = benchmark_speculative)
+
+    speculative_parity = subparsers.add_parser('speculative-parity', help = 'check that speculative greedy decoding equals generate_translation(num_beams = 1) on held-out sentences')
+    speculative_parity.add_argument('--checkpoint', default = 'T5_inference.safetensors', help = 'T5 inference checkpoint or fine-tuned state_dict')
+    speculative_parity.add_argument('--draft', default = '../Transformer_From_Scratch/Scratch_inference.safetensors', help = 'MyTransformer inference checkpoint')
+    speculative_parity.add_argument('--num-draft-tokens', type = int, nargs = '+', default = [1, 2, 4, 6], help = 'guesses per T5 pass')
+    speculative_parity.add_argument('--eval-size', type = int, default = 10)
+    speculative_parity.set_defaults(run = benchmark_speculative_parity)
+
+    onnx = subparsers.add_parser('onnx', help = 'export to ONNX and compare onnxruntime decoding with eager PyTorch on CPU: parity and latency')
+    onnx.add_argument('--checkpoint', default = 'T5_inference.safetensors', help = 'inference checkpoint, see the coldstart benchmark')
+    onnx.add_argument('--export-dir', default = None, help = 'where the ONNX graphs go, default <output-dir>/onnx')
+    onnx.add_argument('--eval-size', type = int, default = 200)
+    onnx.add_argument('--num-beams', type = int, default = 4)
+    onnx.add_argument('--batch-size', type = int, default = 32, help = 'sentences per batch for the batched greedy throughput')
+    onnx.add_argument('--tolerance', type = float, default = 1e-3, help = 'max absolute logit difference for the parity check')
+    onnx.set_defaults(run = benchmark_onnx)
+
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,13 @@
 import sentencepiece as spm
-import pandas as pd
 import torch
-from torch import nn, Tensor
-from torch.nn import functional as F
-from torch.utils.tensorboard import SummaryWriter
-from transformers import (
-    T5ForConditionalGeneration, 
-    T5Config,
-    AdamW,
-    get_cosine_with_hard_restarts_schedule_with_warmup
-)
-import time
-from datetime import datetime
-import math
+from transformers import T5ForConditionalGeneration
+import itertools
+import os
+import sys
+
+# The right-sized vocabularies and the loaders are defined once, in the bo_translate package at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bo_translate.t5 import right_size_vocabularies, convert_full_vocab_state_dict, load_quantized_model, load_inference_checkpoint
 
 device = torch.device(
     'cuda:0' if torch.cuda.is_available() else 'cpu'
@@ -27,29 +22,32 @@ tgtTokenizerPath = '../preProcessing/en.model'
 
 sampleOutPath = './T5_sample_results.txt'
 
+# Checkpoint to load, the first command line argument overrides it, e.g. python T5_get_results.py T5_checkpoint_best_epoch=44.pt
+#   *.safetensors: inference checkpoint written by `python T5_benchmark.py coldstart` (or T5.save_inference_checkpoint()). 
+#                  It bundles config, weights and tokenizer paths, is memory-mapped and needs neither the hub nor t5-small. 
+#   *.pt: state_dict saved by T5.train(), loaded on top of the pretrained t5-small. 
+# Without an argument: T5_inference.safetensors once `python T5_benchmark.py coldstart` has written it, else the state_dict of the best epoch. 
+if len(sys.argv) > 1: 
+    checkpointPath = sys.argv[1]
+elif os.path.exists('T5_inference.safetensors'): 
+    checkpointPath = 'T5_inference.safetensors'
+else: 
+    checkpointPath = 'T5_checkpoint_best_epoch=44.pt'
 
 
-## Load data
-
-srcFile = open(srcDataPath, 'r', encoding = 'utf-8')
-tgtFile = open(tgtDataPath, 'r', encoding = 'utf-8')
-
-dataMatrix = []
-
-while True: 
-    srcLine = srcFile.readline().strip()
-    tgtLine = tgtFile.readline().strip()
-    if not srcLine or not tgtLine: 
-        break 
-    dataMatrix.append([srcLine, tgtLine])
-  
-# Create pandas dataframe for showing examples in jupyter notebook
-df = pd.DataFrame(dataMatrix, columns = ['src', 'tgt'])
-
-# Store source and target texts as lists 
-srcTextsAll = df['src'].tolist()
-tgtTextsAll = df['tgt'].tolist()
+## Load the trained model with the lowest validation loss 
+# Set useQuantized = True to load the dynamic int8 artifact written by `python T5_benchmark.py quantize` instead (CPU only)
+useQuantized = False
+quantizedPath = 'T5_checkpoint_int8.pt'
+# Set useBf16 = True to generate under bf16 autocast (weights stay fp32). Not combined with useQuantized
+useBf16 = False
 
+print('Loading model...')
+T5model = None
+if useQuantized: 
+    T5model = load_quantized_model(quantizedPath)
+elif checkpointPath.endswith('.safetensors'): 
+    T5model, srcTokenizerPath, tgtTokenizerPath = load_inference_checkpoint(checkpointPath, device)
 
 ## Tokenizers 
 srcTokenizer = spm.SentencePieceProcessor(model_file=srcTokenizerPath)
@@ -57,20 +55,21 @@ tgtTokenizer = spm.SentencePieceProcessor(model_file=tgtTokenizerPath)
 tgt_eos_id = tgtTokenizer.piece_to_id('</s>')
 tgt_pad_id = tgtTokenizer.piece_to_id('<pad>')
 
-
-## Load the trained model with the lowest validation loss 
-print('Loading model...')
-state_dict = torch.load('T5_checkpoint_best_epoch=44.pt', map_location = device)
-T5model = T5ForConditionalGeneration.from_pretrained(
-    't5-small', 
-    return_dict = True, 
-    eos_token_id = tgt_eos_id, 
-    pad_token_id = tgt_pad_id, 
-    decoder_start_token_id = tgt_pad_id,   # If I don't add this line, then all predictions start with <unk>
-    dropout_rate = 0.2, 
-    max_length = 100, 
-    state_dict = state_dict
-).to(device)
+if T5model is None: 
+    # A training state_dict, loaded on top of the pretrained t5-small 
+    state_dict = torch.load(checkpointPath, map_location = device)
+    T5model = T5ForConditionalGeneration.from_pretrained(
+        't5-small', 
+        return_dict = True, 
+        eos_token_id = tgt_eos_id, 
+        pad_token_id = tgt_pad_id, 
+        decoder_start_token_id = tgt_pad_id,   # If I don't add this line, then all predictions start with <unk>
+        dropout_rate = 0.2, 
+        max_length = 100, 
+    )
+    right_size_vocabularies(T5model, range(srcTokenizer.get_piece_size()), range(tgtTokenizer.get_piece_size()))
+    T5model.load_state_dict(convert_full_vocab_state_dict(state_dict, srcTokenizer.get_piece_size(), tgtTokenizer.get_piece_size()))
+    T5model = T5model.to(device)
 print('Model loading is complete')
 
 ## Function for generating translation 
@@ -78,7 +77,7 @@ def generate_translation(model, src_text):
     model.eval()
     
     src_ids = srcTokenizer.encode(src_text)
-    src_ids = torch.LongTensor(src_ids).unsqueeze(0).to(device)
+    src_ids = torch.LongTensor(src_ids).unsqueeze(0).to(model.device)
     
     outs = model.generate(
         src_ids, 
@@ -87,9 +86,6 @@ def generate_translation(model, src_text):
         length_penalty = 0.6, 
         early_stopping = True, 
     )
-    
-    # If any token beyond vocab size, make it pad
-    outs = outs.masked_fill(outs >= tgtTokenizer.get_piece_size(), tgt_pad_id)
     ids = outs[0].tolist()
     
     pred_text = tgtTokenizer.decode(ids)
@@ -97,11 +93,21 @@ def generate_translation(model, src_text):
 
 
 ## Pick selected examples, generate translation, and compare 
+# These six sentences show translation quality only. For latency, run python -m bo_translate.latency from the repository root 
 selected = [0, 1, 2, 13, 24, 41]
+
+# Only read the corpus up to the last selected line, not the whole training set 
+with open(srcDataPath, 'r', encoding = 'utf-8') as srcFile, open(tgtDataPath, 'r', encoding = 'utf-8') as tgtFile: 
+    lines = list(itertools.islice(zip(srcFile, tgtFile), max(selected) + 1))
+srcTextsAll = [srcLine.strip() for srcLine, tgtLine in lines]
+tgtTextsAll = [tgtLine.strip() for srcLine, tgtLine in lines]
+
 sample_writer = open(sampleOutPath, 'w', encoding='utf-8')
 print('Generating translations for selected sentences...')
-for idx in selected: 
-    translated_sentence = generate_translation(T5model, srcTextsAll[idx])
+for i, idx in enumerate(selected): 
+    with torch.autocast(device_type = T5model.device.type, dtype = torch.bfloat16, enabled = useBf16): 
+        translated_sentence = generate_translation(T5model, srcTextsAll[idx])
+    print(f'Translated {i + 1}/{len(selected)}')
     sample_writer.write(f'Origianl source text: {srcTextsAll[idx]}\n\n')
     sample_writer.write(f'Original target text: {tgtTextsAll[idx]}\n\n')
     sample_writer.write(f'Predicted target text: {translated_sentence}\n\n')
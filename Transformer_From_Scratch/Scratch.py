@@ -6,17 +6,26 @@
 # Import models and set path of data 
 
 import torch
-from torch import nn, Tensor
 from torch.nn import functional as F
 from torch.utils.data import Dataset, DataLoader
 from torch.utils.tensorboard import SummaryWriter
-from transformers import get_cosine_with_hard_restarts_schedule_with_warmup
+from transformers import Adafactor, get_cosine_with_hard_restarts_schedule_with_warmup
 import sentencepiece as spm
 import pandas as pd
-from typing import Optional
 import math
 import time
 import datetime
+import os
+import sys
+
+# The model is defined once, in the bo_translate package at the repository root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+from bo_translate.scratch import (
+    PositionalEncoding, PrunedMultiheadAttention, MyTransformer, resize_pruned_layers, generate_np_mask, 
+    convert_seq_first_state_dict, bf16_autocast, quantize_dynamic_int8, save_quantized_model, load_quantized_model, 
+    skip_weight_init, save_inference_checkpoint, load_inference_checkpoint
+)
 
 
 device = torch.device(
@@ -261,102 +270,92 @@ class Timer:
 #### Section 4: Encoder and Model class
 # --------------------------
 
-class PositionalEncoding(nn.Module):   
-    def __init__(self, hparams): 
-        super(PositionalEncoding, self).__init__()
-        self.dropout = nn.Dropout(p = hparams['dropout'])
-        self.d_model = hparams['d_model']
-        pe = torch.zeros(hparams['max_len'], self.d_model)    # positional encoding 
-        position = torch.arange(0, hparams['max_len']).unsqueeze(1)
-        div_term = torch.exp(
-            torch.arange(0, self.d_model, 2).float() * (
-                -math.log(10000.0) / self.d_model
-            )
-        )    # What for? 
-        pe[:, 0::2] = torch.sin(position * div_term)    # even dimensions
-        pe[:, 1::2] = torch.cos(position * div_term)    # odd dimensions
-        pe = pe.unsqueeze(0).transpose(0, 1)    # Unsqueeze turns a matrix to a 3D tensor. Transpose 0th and 1st dim? 
-        self.register_buffer('pe', pe)
-        
-    def forward(self, x): 
-        x = x * math.sqrt(self.d_model)    # What for        
-        x = x + self.pe[:x.size(0), :]
-        return self.dropout(x)
+# MyTransformer, its layers and the checkpoint and quantization helpers are defined once in bo_translate/scratch.py, 
+# imported at the top of this file. The structured pruning below needs compute_loss() and the batch iterator, so it stays here. 
 
+'''
+# Structured pruning: remove whole attention heads and feedforward neurons, so the pruned model is smaller and faster 
+# rather than sparse. hparams['pruned_layers'] records what is left of every layer, and MyTransformer is built with those 
+# sizes, so a pruned model saves and loads like any other. 
+'''
 
+def prunable_blocks(model): 
+    '''
+    (stack, layer index, block name, output weight, group size) of every attention and feedforward block. Removing a head 
+    removes `head_dim` columns of the out_proj weight, removing a feedforward neuron one column of linear2. 
+    '''
+    for stack_name, stack in [('encoder', model.encoder), ('decoder', model.decoder)]: 
+        for i, layer in enumerate(stack.layers): 
+            for name in ['self_attn', 'multihead_attn']: 
+                if hasattr(layer, name): 
+                    attention = getattr(layer, name)
+                    yield stack_name, i, name, attention.out_proj.weight, attention.head_dim
+            yield stack_name, i, 'dim_feedforward', layer.linear2.weight, 1
 
-class MyTransformer(nn.Module): 
-    def __init__(self, hparams) -> None: 
-        super(MyTransformer, self).__init__()
-        
-        self.source_embedding = nn.Embedding(
-            hparams['source_vocab_length'], hparams['d_model']
-        )
-        self.pos_encoder = PositionalEncoding(hparams)
-        encoder_layer = nn.TransformerEncoderLayer(
-            hparams['d_model'], hparams['nhead'], 
-            hparams['dim_feedforward'], hparams['dropout'], 
-            hparams['activation']
-        )
-        encoder_norm = nn.LayerNorm(hparams['d_model'])    # What for? 
-        self.encoder = nn.TransformerEncoder(
-            encoder_layer, hparams['num_encoder_layers'], encoder_norm
-        )
-        
-        self.target_embedding = nn.Embedding(
-            hparams['target_vocab_length'], hparams['d_model']
-        )
-        decoder_layer = nn.TransformerDecoderLayer(
-            hparams['d_model'], hparams['nhead'], 
-            hparams['dim_feedforward'], hparams['dropout'], 
-            hparams['activation']
-        )
-        decoder_norm = nn.LayerNorm(hparams['d_model'])
-        self.decoder = nn.TransformerDecoder(
-            decoder_layer, hparams['num_decoder_layers'], decoder_norm
-        )
-        
-        self.out = nn.Linear(hparams['d_model'], hparams['target_vocab_length'])   # The original examples wrote nn.Linear(512, target_vocab_length). I suspect this is a typo as hard-coding numbers is not really cool 
-        
-        self._reset_parameters()
-        self.d_model = hparams['d_model']
-        self.nhead = hparams['nhead']
-        
-        
-    def forward(self, src: Tensor, tgt: Tensor,
-                src_mask: Optional[Tensor] = None, 
-                tgt_mask: Optional[Tensor] = None, 
-                memory_mask: Optional[Tensor] = None, 
-                src_key_padding_mask: Optional[Tensor] = None, 
-                tgt_key_padding_mask: Optional[Tensor] = None, 
-                memory_key_padding_mask: Optional[Tensor] = None
-               ) -> Tensor: 
-        # Why batch size is the number of columns instead of rows? 
-        if src.size(1) != tgt.size(1): 
-            raise RuntimeError('The batch number of src and tgt must be equal')
-            
-        src = self.source_embedding(src)
-        src = self.pos_encoder(src)
-        memory = self.encoder(src, mask = src_mask, src_key_padding_mask = src_key_padding_mask)
-        
-        tgt = self.target_embedding(tgt)
-        tgt = self.pos_encoder(tgt)
-        output = self.decoder(
-            tgt, memory, tgt_mask = tgt_mask, 
-            memory_mask = memory_mask, 
-            tgt_key_padding_mask = tgt_key_padding_mask, 
-            memory_key_padding_mask = memory_key_padding_mask
-        )
-        output = self.out(output)
-        return output
-        
+
+def structure_importance(model, batches, hparams): 
+    '''
+    First-order importance of every head and feedforward neuron on `batches` from MyBatchIterator: the loss change 
+    estimated from the gradient when its output columns are zeroed, |sum of weight * grad|, summed over batches 
+    (Michel et al., 2019; Molchanov et al., 2019). Return {(stack, layer index, block name): scores}. 
+    '''
+    model.eval()    # No dropout, and gradients still flow 
+    scores = {}
+    for batch in batches: 
+        model.zero_grad(set_to_none = True)
+        compute_loss(model, batch, hparams).backward()
+        for stack_name, i, name, weight, group in prunable_blocks(model): 
+            contribution = (weight * weight.grad).sum(0).view(-1, group).sum(1).abs().detach()
+            key = (stack_name, i, name)
+            scores[key] = scores[key] + contribution if key in scores else contribution
+    model.zero_grad(set_to_none = True)
+    return scores
+
+
+def prune_model(model, hparams, scores, head_ratio, ffn_ratio): 
+    '''
+    Remove the least important `head_ratio` of all attention heads and `ffn_ratio` of the neurons of every feedforward 
+    block, with `scores` from structure_importance(). Head scores are normalized per block so that blocks compare, and 
+    every block keeps at least one head and one neuron. Return the pruned model, a new MyTransformer on the CPU, and its hparams. 
+    '''
+    keep = {}
+    heads = []
+    for key, score in scores.items(): 
+        if key[2] == 'dim_feedforward': 
+            size = max(1, round((1 - ffn_ratio) * score.numel()))
+            keep[key] = score.topk(size).indices.sort().values
+        else: 
+            keep[key] = list(range(score.numel()))
+            heads += [(value, key, h) for h, value in enumerate((score / score.norm().clamp(min = 1e-12)).tolist())]
+    for _, key, h in sorted(heads)[:round(head_ratio * len(heads))]: 
+        if len(keep[key]) > 1: 
+            keep[key].remove(h)
+    
+    pruned_layers = dict(encoder = [{} for _ in model.encoder.layers], decoder = [{} for _ in model.decoder.layers])
+    state_dict = {name: tensor.detach().to('cpu') for name, tensor in model.state_dict().items()}
+    for (stack_name, i, name), kept in keep.items(): 
+        kept = torch.as_tensor(kept, dtype = torch.long)
+        pruned_layers[stack_name][i][name] = len(kept)
+        prefix = f'{stack_name}.layers.{i}.'
+        if name == 'dim_feedforward': 
+            for param in ['linear1.weight', 'linear1.bias']: 
+                state_dict[prefix + param] = state_dict[prefix + param][kept]
+            state_dict[prefix + 'linear2.weight'] = state_dict[prefix + 'linear2.weight'][:, kept]
+        else: 
+            head_dim = hparams['d_model'] // hparams['nhead']
+            columns = (kept[:, None] * head_dim + torch.arange(head_dim)).view(-1)    # The features of the kept heads 
+            inner = state_dict[prefix + name + '.out_proj.weight'].size(1)    # Heads * head_dim before this pruning 
+            rows = torch.cat([columns, inner + columns, 2 * inner + columns])    # ... in the q, k and v projections 
+            for param in ['in_proj_weight', 'in_proj_bias']: 
+                state_dict[f'{prefix}{name}.{param}'] = state_dict[f'{prefix}{name}.{param}'][rows]
+            state_dict[prefix + name + '.out_proj.weight'] = state_dict[prefix + name + '.out_proj.weight'][:, columns]
     
-    def _reset_parameters(self): 
-        r'''Initiate parameters in the transformer model'''
-        # How work? 
-        for p in self.parameters(): 
-            if p.dim() > 1: 
-                torch.nn.init.xavier_uniform_(p)
+    pruned_hparams = dict(hparams, pruned_layers = pruned_layers)
+    with skip_weight_init(): 
+        pruned = MyTransformer(pruned_hparams)
+    pruned.load_state_dict({name: tensor.contiguous() for name, tensor in state_dict.items()})
+    return pruned.eval(), pruned_hparams
+
 
 
 
@@ -364,18 +363,59 @@ class MyTransformer(nn.Module):
 #### Section 5: Training routine
 # --------------------------
 
+def compute_loss(model, batch, hparams): 
+    '''
+    Summed cross entropy of a batch from MyBatchIterator with teacher forcing. Shared by the train and eval loops. 
+    With hparams['bf16'] the forward pass runs under bf16 autocast: matmuls run in bf16 while the weights, 
+    gradients and optimizer state stay fp32 (bf16 has the fp32 exponent range, so no loss scaling is needed). 
+    '''
+    # Get token ids 
+    src = batch['src'].to(device)    # batch_size * maxlen(src)
+    tgt = batch['tgt'].to(device)    # batch_size * maxlen(tgt)
+    
+    tgt_input = tgt[:, :-1]    # Remove the last column, intended EOS 
+    targets = tgt[:, 1:].contiguous().view(-1)    # Remove the first column (BOS should not be used for computing loss)
+    
+    # Create attention masks (True --> <pad> position that attention should ignore)
+    src_key_padding_mask = (src == src_pad_id)    # batch_size * maxlen(src)
+    tgt_key_padding_mask = (tgt_input == tgt_pad_id)    # batch_size * (maxlen(tgt) - 1)
+    
+    np_mask = generate_np_mask(tgt_input.size(1), device)    # size of target len with final token removed 
+    
+    # Forward 
+    with bf16_autocast(hparams['bf16'], device.type): 
+        preds = model(
+            src, 
+            tgt_input, 
+            tgt_mask = np_mask, 
+            src_key_padding_mask = src_key_padding_mask, 
+            tgt_key_padding_mask = tgt_key_padding_mask, 
+            memory_key_padding_mask = src_key_padding_mask, 
+        )
+    preds = preds.view(-1, preds.size(-1)).float()    # Already batch first, so just flatten to a 2D tensor reserving column number. Loss in fp32 
+    return F.cross_entropy(preds, targets, ignore_index = tgt_pad_id, reduction = 'sum')
+
+
 def train(train_iter, val_iter, model, optim, scheduler, hparams): 
+    '''
+    Train for hparams['num_epochs'] epochs, validating after each epoch. 
+    Return a dict with the per-epoch `train_losses` and `val_losses`, and the per-step 
+    `step_losses`, `step_seconds` (forward + backward + optimizer) and `step_tokens` (target tokens) of the training batches. 
+    '''
     train_losses = []    # For storing averages losses durinig each train epoch
     val_losses = []      # For storing averages losses during each val epoch
+    step_losses, step_seconds, step_tokens = [], [], []    # For throughput and loss-curve comparisons 
     train_step_counter = 0
     val_step_counter = 0
     tb_refresh_rate = 60    # Flush tensorboard log every ~ seconds
     msg_refresh_rate = 10    # Flush message log every ~ seconds
     best_epoch = 0
+    output_dir = hparams['output_dir']    # Where logs and checkpoints are written 
+    os.makedirs(output_dir, exist_ok = True)
     
-    msg_writer = open('message.log', 'w')    # For logging training progress
-    tb_writer = SummaryWriter(flush_secs=tb_refresh_rate)    # Tensorboard writer 
-    sample_writer = open('sample.log', 'w', encoding = 'utf-8')    # For logging example sentences
+    msg_writer = open(os.path.join(output_dir, 'message.log'), 'w')    # For logging training progress
+    tb_writer = SummaryWriter(log_dir = os.path.join(output_dir, 'runs', datetime.datetime.now().strftime('%b%d_%H-%M-%S')), flush_secs=tb_refresh_rate)    # Tensorboard writer 
+    sample_writer = open(os.path.join(output_dir, 'sample.log'), 'w', encoding = 'utf-8')    # For logging example sentences
     
     for epoch in range(hparams['num_epochs']):      
         torch.cuda.empty_cache()   
@@ -392,39 +432,17 @@ def train(train_iter, val_iter, model, optim, scheduler, hparams):
         myTimer = Timer(len(train_iter))    # For estimating remaining time for training each epoch
         
         for idx, batch in enumerate(train_iter): 
-            # Get token ids 
-            src = batch['src'].to(device)    # batch_size * maxlen(src)
-            tgt = batch['tgt'].to(device)    # batch_size * maxlen(tgt)
-            
-            tgt_input = tgt[:, :-1]    # Remove the last column, intended EOS 
-            targets = tgt[:, 1:].contiguous().view(-1)    # Remove the first column (BOS should not be used for computing loss)
-            
-            # Create attention masks 
-            src_mask = (src != 0).float().to(device)
-            src_mask = src_mask.masked_fill(src_mask == 0, float('-inf')).masked_fill(src_mask == 1, float(0))    # map 0-->(-inf), 1-->0. What for? 
-            tgt_mask = (tgt_input != 0).float().to(device)
-            tgt_mask = tgt_mask.masked_fill(tgt_mask == 0, float('-inf')).masked_fill(tgt_mask == 1, float(0))    # map 0-->(-inf), 1-->0. What for? 
-            
-            size = tgt_input.size(1)    # size of target len with final token removed 
-            np_mask = torch.triu(torch.ones(size, size) == 1).transpose(0, 1).to(device)    # This mask looks like Fig.3(b) (causal mask) in T5 paper. What np means? 
-            np_mask = np_mask.float().masked_fill(np_mask == 0, float('-inf')).masked_fill(np_mask == 1, float(0))    # map 0-->(-inf), 1-->0. What for? 
-            
             # Forward, backprop, optimizer 
+            step_start = time.time()
             optim.zero_grad()
-            preds = model(
-                src.transpose(0, 1), 
-                tgt_input.transpose(0, 1), 
-                tgt_mask = np_mask, 
-                # src_mask = src_mask, 
-                # tgt_key_padding_mask = tgt_mask
-                # I have no idea why these two args are commented out
-            )
-            preds = preds.transpose(0, 1).contiguous().view(-1, preds.size(-1))    # Why transpose back? Then convert to 2D tensor reserving column number 
-            loss = F.cross_entropy(preds, targets, ignore_index = 0, reduction = 'sum')
+            loss = compute_loss(model, batch, hparams)
             loss.backward()
             optim.step()
             scheduler.step()
-            train_loss += loss.item() / src.size(0)    # Tutorial uses the constant BATCH_SIZE as denominator, but since the final batch may have a smaller size, I decided to use current batch size 
+            train_loss += loss.item() / batch['src'].size(0)    # Tutorial uses the constant BATCH_SIZE as denominator, but since the final batch may have a smaller size, I decided to use current batch size 
+            step_seconds.append(time.time() - step_start)    # loss.item() waits for the step to finish 
+            step_losses.append(loss.item() / batch['src'].size(0))
+            step_tokens.append((batch['tgt'][:, 1:] != tgt_pad_id).sum().item())
             
             # Tensorboard logging 
                 # Which epoch are we at 
@@ -462,35 +480,9 @@ def train(train_iter, val_iter, model, optim, scheduler, hparams):
         
         with torch.no_grad(): 
             for idx, batch in enumerate(val_iter): 
-                # Get token ids
-                src = batch['src'].to(device)    # batch_size * maxlen(src)
-                tgt = batch['tgt'].to(device)    # batch_size * maxlen(tgt)
-               
-                tgt_input = tgt[:, :-1]    # Remove the last column, intended EOS  
-                targets = tgt[:, 1:].contiguous().view(-1)    # Remove the first column (BOS should not be used for computing loss)
-                
-                # Create attention masks 
-                src_mask = (src != 0).float().to(device)
-                src_mask = src_mask.masked_fill(src_mask == 0, float('-inf')).masked_fill(src_mask == 1, float(0))    # map 0-->(-inf), 1-->0. What for? 
-                tgt_mask = (tgt_input != 0).float().to(device)
-                tgt_mask = tgt_mask.masked_fill(tgt_mask == 0, float('-inf')).masked_fill(tgt_mask == 1, float(0))    # map 0-->(-inf), 1-->0. What for? 
-
-                size = tgt_input.size(1)    # size of target len with final token removed 
-                np_mask = torch.triu(torch.ones(size, size) == 1).transpose(0, 1).to(device)    # This mask looks like Fig.3(b) (causal mask) in T5 paper. What np means? 
-                np_mask = np_mask.float().masked_fill(np_mask == 0, float('-inf')).masked_fill(np_mask == 1, float(0))    # map 0-->(-inf), 1-->0. What for? 
-                
                 # Forward 
-                preds = model(
-                    src.transpose(0, 1), 
-                    tgt_input.transpose(0, 1), 
-                    tgt_mask = np_mask, 
-                    # src_mask = src_mask, 
-                    # tgt_key_padding_mask = tgt_mask
-                    # I have no idea why these two args are commented out
-                )
-                preds = preds.transpose(0, 1).contiguous().view(-1, preds.size(-1))    # Why transpose back? Then convert to 2D tensor reserving column number 
-                loss = F.cross_entropy(preds, targets, ignore_index = 0, reduction = 'sum')
-                val_loss += loss.item() / src.size(0)
+                loss = compute_loss(model, batch, hparams)
+                val_loss += loss.item() / batch['src'].size(0)
                 
                 # Tensorboard logging 
                     # Which epoch are we at 
@@ -531,12 +523,12 @@ def train(train_iter, val_iter, model, optim, scheduler, hparams):
             if val_loss / len(val_iter) < min(val_losses, default = 1e9): 
                 best_epoch = epoch
                 msg_writer.write(f'Saving state_dict...\n')
-                torch.save(model.state_dict(), 'checkpoint_best_epoch.pt')
+                torch.save(model.state_dict(), os.path.join(output_dir, 'checkpoint_best_epoch.pt'))
 
             # Save checkpoint model 
             if epoch in hparams['checkpoint_at']: 
                 print(f'Saving checkpoint state_dict...')
-                torch.save(model.state_dict(), f'checkpoint_epoch={epoch}.pt')
+                torch.save(model.state_dict(), os.path.join(output_dir, f'checkpoint_epoch={epoch}.pt'))
                 
             train_losses.append(train_loss / len(train_iter))
             val_losses.append(val_loss / len(val_iter))
@@ -555,44 +547,109 @@ def train(train_iter, val_iter, model, optim, scheduler, hparams):
             
     # Wrap up the training routine 
     msg_writer.write(f'Best epoch idx = {best_epoch}')
-    torch.save(model.state_dict(), 'checkpoint_final_epoch.pt')
+    torch.save(model.state_dict(), os.path.join(output_dir, 'checkpoint_final_epoch.pt'))
     msg_writer.close()
     tb_writer.close()
     sample_writer.close()
+    
+    return dict(
+        train_losses = train_losses, val_losses = val_losses, 
+        step_losses = step_losses, step_seconds = step_seconds, step_tokens = step_tokens, 
+    )
 
 
 
 '''
-# Define the helper function for generating translation for a source text
-# Use "greedy-decoding" algorithm 
+# Define the helper functions for generating translation for a source text
+# Use "greedy-decoding" algorithm, or "beam search" that keeps the `num_beams` best partial translations at each step 
+# The *_ids functions take and return token ids, and run on whichever device the model is on 
 '''
 
-def greedy_decode_sentence(model, sentence, max_len = 100): # Restrict translation up to 100 words 
+def greedy_decode_ids(model, src_ids, max_len = 100): 
     model.eval()
-    src = torch.LongTensor([srcTokenizer.encode(sentence)]).to(device) 
-    tgt_init_tok = tgt_bos_id
-    tgt = torch.LongTensor([[tgt_init_tok]]).to(device)    # For forward() purpose, stored as a column vector
-    translated_sentence = ''
+    model_device = next(model.parameters()).device
+    src = torch.LongTensor([src_ids]).to(model_device)    # 1 * len(src)
+    tgt = torch.LongTensor([[tgt_bos_id]]).to(model_device)    # 1 * len(tgt), batch first like src
+    generated_ids = []
     
-    for i in range(max_len): 
-        size = tgt.size(0)
-        np_mask = torch.triu(torch.ones(size, size) == 1).transpose(0, 1).to(device).float()
-        np_mask = np_mask.masked_fill(np_mask == 0, float('-inf')).masked_fill(np_mask == 1, float(0))
-        
-        # Predict the next word based on previous words 
-        pred = model(src.transpose(0, 1), tgt, tgt_mask = np_mask)
-        generated_id = pred.argmax(dim = 2)[-1]    # Not sure the mechanism behind
-        generated_word = tgtTokenizer.decode([generated_id.item()])
-        translated_sentence += (' ' + generated_word)
+    # No autograd + eval mode lets the encoder run on PyTorch's fused fast path 
+    with torch.inference_mode(): 
+        # The source does not change while decoding, so encode it only once 
+        memory = model.encode(src)
         
-        # Stop generation when </s> is generated
-        if generated_id == tgt_eos_id: 
-            break 
+        for i in range(max_len): 
+            np_mask = generate_np_mask(tgt.size(1), model_device)
+            
+            # Predict the next word based on previous words 
+            pred = model.decode(tgt, memory, tgt_mask = np_mask)    # 1 * len(tgt) * vocab
+            generated_id = pred[0, -1].argmax().item()    # The most likely token at the last position 
+            generated_ids.append(generated_id)
+            
+            # Stop generation when </s> is generated
+            if generated_id == tgt_eos_id: 
+                break 
+            
+            # Append the new token to tgt
+            tgt = torch.cat((tgt, torch.LongTensor([[generated_id]]).to(model_device)), dim = 1)
         
-        # Append the new token to tgt
-        tgt = torch.cat((tgt, torch.LongTensor([[generated_id]]).to(device)))
+    return generated_ids
+
+
+def greedy_decode_sentence(model, sentence, max_len = 100): # Restrict translation up to 100 words 
+    # Decode all ids at once: SentencePiece turns the '▁' starting a word into a space only between words, 
+    # so decoding token by token and joining with spaces splits words. </s> is a control piece, decode() drops it. 
+    return tgtTokenizer.decode(greedy_decode_ids(model, srcTokenizer.encode(sentence), max_len))
+
+
+def beam_decode_ids(model, src_ids, num_beams = 4, max_len = 100, length_penalty = 0.6): 
+    '''
+    Beam search. All live beams are decoded together as one batch against the same encoder memory. 
+    Finished hypotheses are ranked by sum(log prob) / len ** length_penalty, and the search stops 
+    once `num_beams` hypotheses are finished (like `early_stopping = True` in T5's generate()). 
+    '''
+    model.eval()
+    model_device = next(model.parameters()).device
+    src = torch.LongTensor([src_ids]).to(model_device)    # 1 * len(src)
+    tgt = torch.LongTensor([[tgt_bos_id]]).to(model_device)    # num_live_beams * len(tgt)
+    beam_scores = torch.zeros(1, device = model_device)    # Summed log probs of each live beam 
+    finished = []    # (normalized score, token ids) of hypotheses that generated </s> 
+    
+    with torch.inference_mode(): 
+        memory = model.encode(src)
         
-    return translated_sentence
+        for i in range(max_len): 
+            np_mask = generate_np_mask(tgt.size(1), model_device)
+            pred = model.decode(tgt, memory.expand(tgt.size(0), -1, -1), tgt_mask = np_mask)
+            log_probs = F.log_softmax(pred[:, -1].float(), dim = -1)    # num_live_beams * vocab
+            vocab_size = log_probs.size(1)
+            
+            # Take 2 * num_beams candidates so that enough beams survive even if some of them end with </s> 
+            candidate_scores, candidate_idx = (beam_scores.unsqueeze(1) + log_probs).view(-1).topk(2 * num_beams)
+            next_tgt, next_scores = [], []
+            for score, idx in zip(candidate_scores.tolist(), candidate_idx.tolist()): 
+                beam, token = idx // vocab_size, idx % vocab_size
+                if token == tgt_eos_id: 
+                    finished.append((score / (i + 1) ** length_penalty, tgt[beam, 1:].tolist() + [token]))
+                else: 
+                    next_tgt.append(torch.cat((tgt[beam], torch.LongTensor([token]).to(model_device))))
+                    next_scores.append(score)
+                if len(next_tgt) == num_beams: 
+                    break 
+            
+            if len(finished) >= num_beams: 
+                break 
+            tgt = torch.stack(next_tgt)
+            beam_scores = torch.tensor(next_scores, device = model_device)
+    
+    # Fall back to the live beams if nothing finished within max_len steps 
+    if not finished: 
+        finished = [(score / (tgt.size(1) - 1) ** length_penalty, tgt[beam, 1:].tolist()) for beam, score in enumerate(beam_scores.tolist())]
+    return max(finished, key = lambda hypothesis: hypothesis[0])[1]
+
+
+def beam_decode_sentence(model, sentence, num_beams = 4, max_len = 100, length_penalty = 0.6): 
+    ids = beam_decode_ids(model, srcTokenizer.encode(sentence), num_beams, max_len, length_penalty)
+    return tgtTokenizer.decode(ids)
 
 
 
@@ -607,6 +664,7 @@ def greedy_decode_sentence(model, sentence, max_len = 100): # Restrict translati
     # Instantiate optimizer and scheduler 
     # Instantiate the batch iterator 
     # Start training 
+# Other scripts (e.g. Scratch_benchmark.py) import this file for the model, helpers and `hparams`, so the training run only starts when Scratch.py is run directly 
 '''
 
 hparams = dict(
@@ -614,8 +672,8 @@ hparams = dict(
     dropout = 0.3, 
     max_len = 5000,    
     nhead = 8,    # Little understand what for 
-    num_encoder_layers = 6, 
-    num_decoder_layers = 6, 
+    num_encoder_layers = 6,    # The encoder runs once per sentence when decoding 
+    num_decoder_layers = 6,    # The decoder runs once per generated token, so it dominates decoding latency. Asymmetric setups like 12-1 or 6-2 are fine, see `python Scratch_benchmark.py depth` 
     dim_feedforward = 2048, 
     activation = 'relu', 
     source_vocab_length = srcTokenizer.get_piece_size(),    # Consider increase
@@ -631,37 +689,81 @@ hparams = dict(
     train_percentage = 0.95, 
     val_percentage = 0.02, 
     checkpoint_at = [9, 19, 29, 39], 
+    output_dir = '.',    # Where logs and checkpoints are written 
+    bf16 = False,    # bf16 autocast for the forward pass, weights stay fp32. Needs a CPU with native bf16 (AVX512-BF16/AMX) or an Ampere+ GPU to be faster 
+    activation_checkpointing = False,    # Recompute layer activations in backward: much less activation memory for a larger train_batch_size, ~30% slower steps. See `python Scratch_benchmark.py checkpointing` 
+    optimizer = 'adam',    # 'adam', or 'adafactor' for factored second moments and no first moment: the optimizer state shrinks from 2x the weights to a small fraction. See `python Scratch_benchmark.py optimizer` 
+    distilled_targets = None,    # Sequence-level distillation: a file of teacher translations of the training sources, one per line, used as the train split targets instead of train.en. See `python Scratch_benchmark.py distill` 
 )
 
 
-model = MyTransformer(hparams).to(device)
 
-optim = torch.optim.Adam(model.parameters(), lr = hparams['lr'], betas = hparams['adam_betas'], weight_decay = hparams['weight_decay'])
+def read_distilled_targets(path, train_end): 
+    '''
+    The targets of all sentence pairs, with the first `train_end` (the train split) replaced by the lines of `path`, 
+    which translate srcTextsAll[:train_end] line for line. The val and test splits keep the references. 
+    '''
+    with open(path, 'r', encoding = 'utf-8') as f: 
+        distilled = f.read().split('\n')[:train_end]
+    if len(distilled) < train_end: 
+        raise ValueError(f'{path} has {len(distilled)} lines, but the train split has {train_end} sentences')
+    return [line.strip() for line in distilled] + tgtTextsAll[train_end:]
 
-# The scheduler first warm up to the target learning rate and then decay according to a cosine function
-scheduler = get_cosine_with_hard_restarts_schedule_with_warmup(
-    optim, 
-    num_warmup_steps = hparams['warmup_steps'], 
-    num_training_steps = hparams['num_epochs'] * math.ceil(len(srcTextsAll) / hparams['train_batch_size']), 
-    num_cycles = 3
-)
 
-train_mbi = MyBatchIterator(
-    srcTextsAll, tgtTextsAll, srcTokenizer, tgtTokenizer,
-    start_idx = 0, 
-    end_idx = int(hparams['train_percentage'] * len(srcTextsAll)), 
-    batch_size = hparams['train_batch_size'], 
-    src_pad_id = src_pad_id, tgt_pad_id = tgt_pad_id, 
-    tgt_bos_id = tgt_bos_id, tgt_eos_id = tgt_eos_id)
+def build_optimizer(model, hparams): 
+    '''
+    hparams['optimizer'] = 'adam' keeps fp32 first and second moments for every weight. 'adafactor' (Shazeer & Stern, 2018) 
+    keeps no first moment and factors the second moment of each matrix into a row and a column vector. Both take the 
+    learning rate from hparams['lr'] and the scheduler; Adafactor's own relative step size is turned off. 
+    '''
+    if hparams['optimizer'] == 'adafactor': 
+        return Adafactor(
+            model.parameters(), lr = hparams['lr'], weight_decay = hparams['weight_decay'], 
+            scale_parameter = False, relative_step = False, warmup_init = False
+        )
+    if hparams['optimizer'] != 'adam': 
+        raise ValueError(f"hparams['optimizer'] must be 'adam' or 'adafactor', not {hparams['optimizer']!r}")
+    return torch.optim.Adam(model.parameters(), lr = hparams['lr'], betas = hparams['adam_betas'], weight_decay = hparams['weight_decay'])
 
-val_mbi = MyBatchIterator(
-    srcTextsAll, tgtTextsAll, srcTokenizer, tgtTokenizer,
-    start_idx = int(hparams['train_percentage'] * len(srcTextsAll)),
-    end_idx = int((hparams['train_percentage'] + hparams['val_percentage']) * len(srcTextsAll)), 
-    batch_size = hparams['val_batch_size'], 
-    src_pad_id = src_pad_id, tgt_pad_id = tgt_pad_id, 
-    tgt_bos_id = tgt_bos_id, tgt_eos_id = tgt_eos_id)
 
-train(iter(train_mbi), iter(val_mbi), model, optim, scheduler, hparams)
+def build_training(hparams): 
+    '''
+    Instantiate the model, optimizer, scheduler and batch iterators for `hparams`. 
+    With hparams['distilled_targets'], the train split is the training sources paired with those translations. 
+    '''
+    model = MyTransformer(hparams).to(device)
+    
+    optim = build_optimizer(model, hparams)
+    
+    train_end = int(hparams['train_percentage'] * len(srcTextsAll))
+    tgtTexts = read_distilled_targets(hparams['distilled_targets'], train_end) if hparams.get('distilled_targets') else tgtTextsAll
+    train_mbi = MyBatchIterator(
+        srcTextsAll, tgtTexts, srcTokenizer, tgtTokenizer,
+        start_idx = 0, 
+        end_idx = train_end, 
+        batch_size = hparams['train_batch_size'], 
+        src_pad_id = src_pad_id, tgt_pad_id = tgt_pad_id, 
+        tgt_bos_id = tgt_bos_id, tgt_eos_id = tgt_eos_id)
+    
+    val_mbi = MyBatchIterator(
+        srcTextsAll, tgtTextsAll, srcTokenizer, tgtTokenizer,
+        start_idx = int(hparams['train_percentage'] * len(srcTextsAll)),
+        end_idx = int((hparams['train_percentage'] + hparams['val_percentage']) * len(srcTextsAll)), 
+        batch_size = hparams['val_batch_size'], 
+        src_pad_id = src_pad_id, tgt_pad_id = tgt_pad_id, 
+        tgt_bos_id = tgt_bos_id, tgt_eos_id = tgt_eos_id)
+    
+    # The scheduler first warm up to the target learning rate and then decay according to a cosine function
+    scheduler = get_cosine_with_hard_restarts_schedule_with_warmup(
+        optim, 
+        num_warmup_steps = hparams['warmup_steps'], 
+        num_training_steps = hparams['num_epochs'] * len(train_mbi), 
+        num_cycles = 3
+    )
+    
+    return model, optim, scheduler, train_mbi, val_mbi
 
 
+if __name__ == '__main__': 
+    model, optim, scheduler, train_mbi, val_mbi = build_training(hparams)
+    train(iter(train_mbi), iter(val_mbi), model, optim, scheduler, hparams)
@@ -0,0 +1,819 @@
+# =======================================
+##### Benchmarks for the transformer from scratch
+# =======================================
+
+'''
+# Run from this folder, e.g.
+#   python Scratch_benchmark.py depth --configs 12-1 6-2 6-6 --num-epochs 2 --train-percentage 0.2
+#   python Scratch_benchmark.py quantize --checkpoint Scratch_checkpoint_best_epoch=34.pt --output Scratch_checkpoint_int8.pt
+#   python Scratch_benchmark.py bf16 --num-epochs 1 --train-percentage 0.05
+#   python Scratch_benchmark.py checkpointing --memory-budget-mb 8000
+#   python Scratch_benchmark.py optimizer --num-epochs 1 --train-percentage 0.05
+#   python Scratch_benchmark.py coldstart --checkpoint Scratch_checkpoint_best_epoch=34.pt --output Scratch_inference.safetensors
+#   python Scratch_benchmark.py prune --checkpoint Scratch_inference.safetensors --ratios 0 0.25 0.5 0.75 --finetune-epochs 1
+#   python Scratch_benchmark.py distill --teacher ../T5_Transformers/T5_inference.safetensors --config 6-2 --d-model 256
+#   python Scratch_benchmark.py onnx --checkpoint Scratch_inference.safetensors
+#   python Scratch_benchmark.py compile --checkpoint Scratch_inference.safetensors --backends torchscript inductor --batch-sizes 1 8
+# Importing Scratch.py loads the corpus and tokenizers, but does not start a training run.
+# Every benchmark prints a table and writes the raw numbers to a json file in --output-dir.
+'''
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import torch
+
+# The reporting helpers of the bo_translate package and the benchmark helpers of benchmarks/ are shared from the repository root
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(SCRIPT_DIR)
+sys.path.insert(0, REPO_ROOT)
+from bo_translate.reporting import corpus_bleu, percentile, print_table
+from benchmarks.common import (
+    test_split, train_batch_iterator, first_train_batch, short_run_hparams, step_stats, moving_average, train_step,
+    weights_megabytes, optimizer_state_megabytes, saved_activation_megabytes, peak_train_step_megabytes, largest_fitting_batch,
+    launch_and_time, onnx_logit_difference, write_json
+)
+
+from Scratch import (
+    srcTextsAll, tgtTextsAll, srcTokenizer, tgtTokenizer, srcTokenizerPath, tgtTokenizerPath, hparams, device, src_pad_id, tgt_pad_id, tgt_bos_id, tgt_eos_id,
+    MyTransformer, MyBatchIterator, build_training, train, compute_loss, generate_np_mask, greedy_decode_ids, beam_decode_ids,
+    convert_seq_first_state_dict, quantize_dynamic_int8, save_quantized_model, load_quantized_model,
+    save_inference_checkpoint, load_inference_checkpoint, structure_importance, prune_model
+)
+
+# The MyBatchIterator arguments of Scratch.build_training() other than the range and batch size
+BATCH_OPTIONS = dict(
+    srcTexts = srcTextsAll, tgtTexts = tgtTextsAll, srcTokenizer = srcTokenizer, tgtTokenizer = tgtTokenizer,
+    src_pad_id = src_pad_id, tgt_pad_id = tgt_pad_id, tgt_bos_id = tgt_bos_id, tgt_eos_id = tgt_eos_id
+)
+
+
+
+# --------------------------
+#### Helpers
+# --------------------------
+
+def decode_and_time(decode_ids, src_texts):
+    '''Translate one sentence at a time with `decode_ids(src_ids) -> tgt_ids`. Return the translations and per-sentence latencies in seconds. '''
+    decode_ids(srcTokenizer.encode(src_texts[0]))    # Warm up, so one-off allocations are not timed
+    hypotheses, latencies = [], []
+    for text in src_texts:
+        src_ids = srcTokenizer.encode(text)
+        start = time.perf_counter()
+        tgt_ids = decode_ids(src_ids)
+        latencies.append(time.perf_counter() - start)
+        hypotheses.append(tgtTokenizer.decode(tgt_ids))
+    return hypotheses, latencies
+
+
+def layer_hparams(config):
+    '''Scratch.hparams with the depth taken from an `<encoder layers>-<decoder layers>` string. '''
+    num_encoder_layers, num_decoder_layers = (int(n) for n in config.split('-'))
+    return dict(hparams, num_encoder_layers = num_encoder_layers, num_decoder_layers = num_decoder_layers)
+
+
+def load_checkpoint(path, config):
+    '''An inference checkpoint (*.safetensors) or a state_dict saved by Scratch.train() with the depth in `config`. Return the fp32 model on the CPU and its hparams. '''
+    if path.endswith('.safetensors'):
+        from safetensors import safe_open    # Imported here because only inference checkpoints need it
+        with safe_open(path, framework = 'pt') as f:
+            model_hparams = dict(hparams, **json.loads(f.metadata()['hparams']))
+        return load_inference_checkpoint(path, 'cpu')[0], model_hparams
+    model_hparams = layer_hparams(config)
+    model = MyTransformer(model_hparams)
+    model.load_state_dict(convert_seq_first_state_dict(torch.load(path, map_location = 'cpu')))
+    return model.eval(), model_hparams
+
+
+
+# --------------------------
+#### Benchmark: encoder / decoder depth
+# --------------------------
+
+'''
+# Decoding latency grows with decoder depth only, because the encoder runs once per sentence.
+# For every `<encoder layers>-<decoder layers>` config, train a short run with Scratch.train() and then
+# report BLEU on the held-out split together with greedy and beam decoding latency on CPU.
+'''
+
+def benchmark_depth(args):
+    test_src, test_tgt = test_split(srcTextsAll, tgtTextsAll, hparams, args.eval_size)
+    results = []
+
+    for config in args.configs:
+        run_hparams = dict(
+            layer_hparams(config),
+            num_epochs = args.num_epochs,
+            train_percentage = args.train_percentage,
+            warmup_steps = args.warmup_steps,
+            checkpoint_at = [],
+            output_dir = os.path.join(args.output_dir, f'depth_{config}'),
+        )
+        print(f'Training {config} for {args.num_epochs} epoch(s)...')
+        torch.manual_seed(args.seed)
+        model, optim, scheduler, train_mbi, val_mbi = build_training(run_hparams)
+        train_start = time.time()
+        history = train(iter(train_mbi), iter(val_mbi), model, optim, scheduler, run_hparams)
+        train_secs = time.time() - train_start
+
+        # Production decoding is on CPU
+        model = model.to('cpu')
+        greedy_hyps, greedy_latencies = decode_and_time(lambda ids: greedy_decode_ids(model, ids), test_src)
+        beam_hyps, beam_latencies = decode_and_time(lambda ids: beam_decode_ids(model, ids, num_beams = args.num_beams), test_src)
+
+        results.append(dict(
+            config = config,
+            params_M = round(sum(p.numel() for p in model.parameters()) / 1e6, 1),
+            train_min = round(train_secs / 60, 1),
+            val_loss = round(history['val_losses'][-1], 3),
+            greedy_bleu = round(corpus_bleu(greedy_hyps, test_tgt), 2),
+            greedy_p50_ms = round(percentile(greedy_latencies, 50) * 1000, 1),
+            greedy_p90_ms = round(percentile(greedy_latencies, 90) * 1000, 1),
+            beam_bleu = round(corpus_bleu(beam_hyps, test_tgt), 2),
+            beam_p50_ms = round(percentile(beam_latencies, 50) * 1000, 1),
+            beam_p90_ms = round(percentile(beam_latencies, 90) * 1000, 1),
+        ))
+        del model, optim
+
+    print(f'\nHeld-out sentences: {len(test_src)}, beams: {args.num_beams}, CPU threads: {torch.get_num_threads()}')
+    print_table(results, list(results[0].keys()))
+    write_json(args, 'depth_benchmark.json', results)
+
+
+
+# --------------------------
+#### Benchmark: dynamic int8 quantization
+# --------------------------
+
+'''
+# Quantize a trained fp32 checkpoint with Scratch.quantize_dynamic_int8(), save the artifact to --output,
+# then reload it the way Scratch_get_results.py does and compare it with fp32 on the held-out split.
+'''
+
+def benchmark_quantize(args):
+    test_src, test_tgt = test_split(srcTextsAll, tgtTextsAll, hparams, args.eval_size)
+    model_hparams = layer_hparams(args.config)
+
+    fp32_model = MyTransformer(model_hparams)
+    fp32_model.load_state_dict(convert_seq_first_state_dict(torch.load(args.checkpoint, map_location = 'cpu')))
+    fp32_model.eval()
+    save_quantized_model(quantize_dynamic_int8(fp32_model), model_hparams, args.output)
+    print('Quantized model saved to', args.output)
+    int8_model = load_quantized_model(args.output)
+
+    results = []
+    for name, model in [('fp32', fp32_model), ('int8', int8_model)]:
+        greedy_hyps, greedy_latencies = decode_and_time(lambda ids: greedy_decode_ids(model, ids), test_src)
+        beam_hyps, beam_latencies = decode_and_time(lambda ids: beam_decode_ids(model, ids, num_beams = args.num_beams), test_src)
+        results.append(dict(
+            model = name,
+            weights_MB = weights_megabytes(model),
+            greedy_bleu = round(corpus_bleu(greedy_hyps, test_tgt), 2),
+            greedy_p50_ms = round(percentile(greedy_latencies, 50) * 1000, 1),
+            greedy_p90_ms = round(percentile(greedy_latencies, 90) * 1000, 1),
+            beam_bleu = round(corpus_bleu(beam_hyps, test_tgt), 2),
+            beam_p50_ms = round(percentile(beam_latencies, 50) * 1000, 1),
+            beam_p90_ms = round(percentile(beam_latencies, 90) * 1000, 1),
+        ))
+
+    print(f'\nHeld-out sentences: {len(test_src)}, beams: {args.num_beams}, CPU threads: {torch.get_num_threads()}')
+    print_table(results, list(results[0].keys()))
+    write_json(args, 'quantize_benchmark.json', results)
+
+
+
+# --------------------------
+#### Benchmark: bf16 autocast training
+# --------------------------
+
+'''
+# Train the same short run twice from the same seed, in fp32 and with hparams['bf16'] = True.
+# Reports step time, tokens/sec and activation memory, then checks that the bf16 loss curve tracks fp32:
+# the smoothed per-step train loss and the per-epoch val loss must stay within --tolerance (relative).
+'''
+
+def benchmark_bf16(args):
+    results, histories = [], {}
+
+    for name, bf16 in [('fp32', False), ('bf16', True)]:
+        run_hparams = short_run_hparams(layer_hparams(args.config), args, f'bf16_{name}', bf16 = bf16)
+        torch.manual_seed(args.seed)
+        model, optim, scheduler, train_mbi, val_mbi = build_training(run_hparams)
+        activation_MB = saved_activation_megabytes(compute_loss, model, next(iter(train_mbi)), run_hparams)
+        print(f'Training {name} for {args.num_epochs} epoch(s)...')
+        histories[name] = train(iter(train_mbi), iter(val_mbi), model, optim, scheduler, run_hparams)
+        results.append(dict(
+            precision = name,
+            **step_stats(histories[name]),
+            activation_MB = activation_MB,
+            train_loss = round(histories[name]['train_losses'][-1], 3),
+            val_loss = round(histories[name]['val_losses'][-1], 3),
+        ))
+        del model, optim
+
+    fp32_curve = moving_average(histories['fp32']['step_losses'], args.window)
+    bf16_curve = moving_average(histories['bf16']['step_losses'], args.window)
+    curve_diff = max(abs(b - f) / f for f, b in zip(fp32_curve, bf16_curve))
+    val_diff = max(abs(b - f) / f for f, b in zip(histories['fp32']['val_losses'], histories['bf16']['val_losses']))
+    parity = dict(
+        max_rel_diff_train_curve = round(curve_diff, 4),
+        max_rel_diff_val_loss = round(val_diff, 4),
+        passed = curve_diff <= args.tolerance and val_diff <= args.tolerance,
+    )
+
+    print(f'\nTrain steps: {len(fp32_curve)}, CPU threads: {torch.get_num_threads()}')
+    print_table(results, list(results[0].keys()))
+    print(f"Loss-curve parity ({args.window}-step moving average, tolerance {args.tolerance}): {'PASS' if parity['passed'] else 'FAIL'}. "
+          f"Max relative difference: train curve {parity['max_rel_diff_train_curve']}, val loss {parity['max_rel_diff_val_loss']}")
+    write_json(args, 'bf16_benchmark.json', dict(results = results, parity = parity, step_losses = {name: h['step_losses'] for name, h in histories.items()}))
+
+
+
+# --------------------------
+#### Benchmark: memory-light optimizer state
+# --------------------------
+
+'''
+# Train the same short run with hparams['optimizer'] = 'adam' and 'adafactor', both under the cosine-with-restarts
+# scheduler of Scratch.build_training(), and compare the optimizer state memory, step time and convergence. Adafactor's
+# state is a row and a column vector per matrix instead of two full copies of the weights. Convergence counts as matching
+# when the final --window-step moving average of the train loss and the final val loss agree within --tolerance.
+'''
+
+def benchmark_optimizer(args):
+    results, histories = [], {}
+
+    for name in ['adam', 'adafactor']:
+        run_hparams = short_run_hparams(layer_hparams(args.config), args, f'optimizer_{name}', optimizer = name)
+        torch.manual_seed(args.seed)
+        model, optim, scheduler, train_mbi, val_mbi = build_training(run_hparams)
+        print(f'Training with {name} for {args.num_epochs} epoch(s)...')
+        histories[name] = train(iter(train_mbi), iter(val_mbi), model, optim, scheduler, run_hparams)
+        results.append(dict(
+            optimizer = name,
+            weights_MB = round(sum(p.numel() * p.element_size() for p in model.parameters()) / 2**20, 1),
+            state_MB = optimizer_state_megabytes(optim),
+            **step_stats(histories[name]),
+            train_loss = round(moving_average(histories[name]['step_losses'], args.window)[-1], 3),
+            val_loss = round(histories[name]['val_losses'][-1], 3),
+        ))
+        del model, optim
+
+    adam, adafactor = results
+    convergence = dict(
+        rel_diff_train_loss = round(abs(adafactor['train_loss'] - adam['train_loss']) / adam['train_loss'], 4),
+        rel_diff_val_loss = round(abs(adafactor['val_loss'] - adam['val_loss']) / adam['val_loss'], 4),
+    )
+    convergence['passed'] = max(convergence.values()) <= args.tolerance
+
+    print(f"\nTrain steps: {len(histories['adam']['step_losses'])}, device: {device}, CPU threads: {torch.get_num_threads()}")
+    print_table(results, list(results[0].keys()))
+    print(f"Convergence (final {args.window}-step moving average train loss and val loss, tolerance {args.tolerance}): {'PASS' if convergence['passed'] else 'FAIL'}. "
+          f"Relative difference: train {convergence['rel_diff_train_loss']}, val {convergence['rel_diff_val_loss']}")
+    write_json(args, 'optimizer_benchmark.json', dict(results = results, convergence = convergence, step_losses = {name: h['step_losses'] for name, h in histories.items()}))
+
+
+
+# --------------------------
+#### Benchmark: activation checkpointing
+# --------------------------
+
+'''
+# For hparams['activation_checkpointing'] off and on: the largest train batch whose training step fits in
+# --memory-budget-mb (peak memory of one step on the first N training pairs; estimated on CPU, measured on GPU,
+# where running out of memory also counts as not fitting), and tokens/sec over --steps steps at --batch-size and
+# at that largest batch.
+'''
+
+def benchmark_checkpointing(args):
+    limit = min(args.max_batch_size, int(hparams['train_percentage'] * len(srcTextsAll)))
+    results = []
+
+    for checkpointing in [False, True]:
+        run_hparams = dict(layer_hparams(args.config), activation_checkpointing = checkpointing)
+        torch.manual_seed(args.seed)
+        model = MyTransformer(run_hparams).to(device)
+        optim = torch.optim.Adam(model.parameters(), lr = run_hparams['lr'], betas = run_hparams['adam_betas'], weight_decay = run_hparams['weight_decay'])
+        peaks = {}
+
+        def fits(size):
+            try:
+                peaks[size] = peak_train_step_megabytes(compute_loss, model, optim, first_train_batch(MyBatchIterator, BATCH_OPTIONS, size), run_hparams)
+            except torch.cuda.OutOfMemoryError:
+                torch.cuda.empty_cache()
+                return False
+            return peaks[size] <= args.memory_budget_mb
+
+        largest = largest_fitting_batch(fits, limit)
+        print(f'activation_checkpointing = {checkpointing}: largest batch within {args.memory_budget_mb} MB is {largest}')
+
+        for batch_size in sorted({args.batch_size, largest} - {0}):
+            history = dict(step_seconds = [], step_tokens = [])
+            for step, batch in zip(range(args.steps + 1), train_batch_iterator(MyBatchIterator, BATCH_OPTIONS, batch_size, limit)):
+                start = time.perf_counter()
+                train_step(compute_loss, model, optim, batch, run_hparams)
+                if step > 0:    # The first step allocates the Adam state, don't time it
+                    history['step_seconds'].append(time.perf_counter() - start)
+                    history['step_tokens'].append((batch['tgt'][:, 1:] != tgt_pad_id).sum().item())
+            results.append(dict(
+                checkpointing = checkpointing,
+                batch_size = batch_size,
+                largest_batch = largest,
+                peak_MB = peaks[batch_size] if batch_size in peaks else peak_train_step_megabytes(compute_loss, model, optim, first_train_batch(MyBatchIterator, BATCH_OPTIONS, batch_size), run_hparams),
+                **step_stats(history),
+            ))
+        del model, optim
+
+    print(f"\nConfig: {args.config}, memory budget: {args.memory_budget_mb} MB ({'measured' if device.type == 'cuda' else 'estimated'}), "
+          f'timed steps: {args.steps}, device: {device}, CPU threads: {torch.get_num_threads()}')
+    print_table(results, list(results[0].keys()))
+    write_json(args, 'checkpointing_benchmark.json', results)
+
+
+
+# --------------------------
+#### Benchmark: cold start with inference checkpoints
+# --------------------------
+
+'''
+# Export --checkpoint as inference checkpoints (Scratch.save_inference_checkpoint(): one safetensors file with the config,
+# weights and tokenizer paths) in fp32 to --output and in bf16 next to it. Then launch Scratch_get_results.py in fresh processes
+# with the original checkpoint and with each export, and time from process launch until the model is loaded and until
+# the first translation is printed (median of --repeats launches). bf16 files are cast back to fp32 on load.
+'''
+
+def benchmark_coldstart(args):
+    bf16_output = args.output.replace('.safetensors', '_bf16.safetensors')
+    run_hparams = layer_hparams(args.config)
+    model = MyTransformer(run_hparams)
+    model.load_state_dict(convert_seq_first_state_dict(torch.load(args.checkpoint, map_location = 'cpu')))
+    save_inference_checkpoint(model, run_hparams, args.output, (srcTokenizerPath, tgtTokenizerPath), dtype = torch.float32)
+    save_inference_checkpoint(model, run_hparams, bf16_output, (srcTokenizerPath, tgtTokenizerPath), dtype = torch.bfloat16)
+    print('Inference checkpoints saved to', args.output, 'and', bf16_output)
+    del model
+
+    results = []
+    for name, path in [('original', args.checkpoint), ('safetensors fp32', args.output), ('safetensors bf16', bf16_output)]:
+        launches = [launch_and_time([sys.executable, '-u', 'Scratch_get_results.py', path], ['Model loading', 'Translated 1/'], SCRIPT_DIR) for _ in range(args.repeats)]
+        results.append(dict(
+            checkpoint = name,
+            file_MB = round(os.path.getsize(path) / 2**20, 1),
+            model_loaded_s = round(percentile([launch['Model loading'] for launch in launches], 50), 2),
+            first_translation_s = round(percentile([launch['Translated 1/'] for launch in launches], 50), 2),
+        ))
+
+    print(f'\nLaunches per checkpoint: {args.repeats}, device: {device}')
+    print_table(results, list(results[0].keys()))
+    write_json(args, 'coldstart_benchmark.json', results)
+
+
+
+# --------------------------
+#### Benchmark: structured pruning
+# --------------------------
+
+'''
+# Score every attention head and feedforward neuron of a trained model on the start of its validation split with
+# Scratch.structure_importance(), then for every ratio remove that share of heads and of the neurons of each feedforward
+# block with Scratch.prune_model(). Each pruned model is optionally fine-tuned for a short run with Scratch.train(), saved
+# as an inference checkpoint, reloaded from it and compared on the held-out split: the latency/BLEU curve over the ratios.
+# Every reloaded checkpoint must give the logits of the model it was saved from, and Scratch_get_results.py must load it
+# in a fresh process, so a pruned checkpoint that only this script can read fails the benchmark.
+'''
+
+def first_step_logits(model, text):
+    '''The decoder logits after <s> for `text`, on the CPU. Enough to tell whether two models compute the same function. '''
+    with torch.inference_mode():
+        memory = model.encode(torch.LongTensor([srcTokenizer.encode(text)]))
+        return model.decode(torch.LongTensor([[tgt_bos_id]]), memory)[0, -1]
+
+
+def benchmark_prune(args):
+    test_src, test_tgt = test_split(srcTextsAll, tgtTextsAll, hparams, args.eval_size)
+    model, model_hparams = load_checkpoint(args.checkpoint, args.config)
+    score_start = int(model_hparams['train_percentage'] * len(srcTextsAll))
+    score_batches = MyBatchIterator(
+        srcTextsAll, tgtTextsAll, srcTokenizer, tgtTokenizer,
+        start_idx = score_start, end_idx = score_start + args.score_size, batch_size = hparams['train_batch_size'],
+        src_pad_id = src_pad_id, tgt_pad_id = tgt_pad_id,
+        tgt_bos_id = tgt_bos_id, tgt_eos_id = tgt_eos_id
+    )
+    print(f'Scoring heads and feedforward neurons on {args.score_size} validation sentences...')
+    scores = structure_importance(model, iter(score_batches), model_hparams)
+    os.makedirs(os.path.join(args.output_dir, 'prune'), exist_ok = True)
+
+    results = []
+    for ratio in args.ratios:
+        head_ratio, ffn_ratio = (ratio if block in args.blocks else 0 for block in ['heads', 'ffn'])
+        pruned, pruned_hparams = prune_model(model, model_hparams, scores, head_ratio, ffn_ratio)
+        val_loss = None
+        if args.finetune_epochs:
+            run_hparams = dict(
+                pruned_hparams,
+                num_epochs = args.finetune_epochs,
+                train_percentage = args.train_percentage,
+                warmup_steps = args.warmup_steps,
+                checkpoint_at = [],
+                output_dir = os.path.join(args.output_dir, 'prune', f'finetune_{ratio}'),
+            )
+            print(f'Fine-tuning the model pruned by {ratio} for {args.finetune_epochs} epoch(s)...')
+            torch.manual_seed(args.seed)
+            pruned_state = pruned.state_dict()
+            pruned, optim, scheduler, train_mbi, val_mbi = build_training(run_hparams)    # The same shapes, so the pruned weights load as they are
+            pruned.load_state_dict(pruned_state)
+            history = train(iter(train_mbi), iter(val_mbi), pruned, optim, scheduler, run_hparams)
+            val_loss = round(history['val_losses'][-1], 3)
+            del optim
+
+        path = os.path.join(args.output_dir, 'prune', f'pruned_{ratio}.safetensors')
+        save_inference_checkpoint(pruned.to('cpu'), pruned_hparams, path, (srcTokenizerPath, tgtTokenizerPath))
+        reference = first_step_logits(pruned.eval(), test_src[0])
+        del pruned
+        pruned = load_inference_checkpoint(path, 'cpu')[0]
+        reload_difference = (first_step_logits(pruned, test_src[0]) - reference).abs().max().item()
+        if reload_difference > 1e-4:
+            raise RuntimeError(f'{path} reloads with logits {reload_difference:.2e} off the pruned model it was saved from')
+        get_results_load = launch_and_time([sys.executable, '-u', 'Scratch_get_results.py', os.path.abspath(path)], ['Model loading complete'], SCRIPT_DIR)
+        greedy_hyps, greedy_latencies = decode_and_time(lambda ids: greedy_decode_ids(pruned, ids), test_src)
+        beam_hyps, beam_latencies = decode_and_time(lambda ids: beam_decode_ids(pruned, ids, num_beams = args.num_beams), test_src)
+        layers = pruned_hparams['pruned_layers']
+        results.append(dict(
+            ratio = ratio,
+            heads = sum(sizes[name] for stack in layers.values() for sizes in stack for name in ['self_attn', 'multihead_attn'] if name in sizes),
+            ffn_neurons = sum(sizes['dim_feedforward'] for stack in layers.values() for sizes in stack),
+            params_M = round(sum(p.numel() for p in pruned.parameters()) / 1e6, 1),
+            file_MB = round(os.path.getsize(path) / 2**20, 1),
+            get_results_load_s = round(get_results_load['Model loading complete'], 2),
+            val_loss = val_loss,
+            greedy_bleu = round(corpus_bleu(greedy_hyps, test_tgt), 2),
+            greedy_p50_ms = round(percentile(greedy_latencies, 50) * 1000, 1),
+            greedy_p90_ms = round(percentile(greedy_latencies, 90) * 1000, 1),
+            beam_bleu = round(corpus_bleu(beam_hyps, test_tgt), 2),
+            beam_p50_ms = round(percentile(beam_latencies, 50) * 1000, 1),
+            beam_p90_ms = round(percentile(beam_latencies, 90) * 1000, 1),
+        ))
+        print(results[-1], flush = True)
+        del pruned
+
+    print(f'\nPruned: {" and ".join(args.blocks)}, held-out sentences: {len(test_src)}, beams: {args.num_beams}, CPU threads: {torch.get_num_threads()}')
+    print('Pruned inference checkpoints saved to', os.path.join(args.output_dir, 'prune'))
+    print_table(results, list(results[0].keys()))
+    write_json(args, 'prune_benchmark.json', results)
+
+
+
+# --------------------------
+#### Benchmark: sequence-level distillation from T5
+# --------------------------
+
+'''
+# Sequence-level knowledge distillation (Kim & Rush, 2016): the T5 teacher translates the training sources, and a smaller
+# MyTransformer is trained on its translations instead of the references, with the same build_training() and train().
+# The teacher decodes with `python -m bo_translate.backtranslate`, so the distilled corpus is written in length-sorted
+# batches and a killed run resumes where it stopped. Teacher and students are then compared on the held-out split through
+# the same bo_translate translators, in batches, for BLEU and sentences/sec. The held-out split of Scratch.hparams is part
+# of T5's validation split, so the teacher never trained on it either.
+'''
+
+def distill_corpus(args, train_end, job_dir):
+    '''Translate the first `train_end` training sources with the teacher into job_dir/train.distilled.en, or reuse it. '''
+    distilled_path = os.path.join(job_dir, 'train.distilled.en')
+    if os.path.exists(distilled_path):
+        print('Reusing the distilled corpus', distilled_path)
+        return distilled_path, None
+    os.makedirs(job_dir, exist_ok = True)
+    src_path = os.path.join(job_dir, 'train.bo')
+    with open(src_path, 'w', encoding = 'utf-8') as f:
+        f.writelines(text + '\n' for text in srcTextsAll[:train_end])
+    command = [
+        sys.executable, '-m', 'bo_translate.backtranslate', os.path.abspath(args.teacher),
+        '--input', os.path.abspath(src_path), '--output', os.path.abspath(distilled_path), '--job-dir', os.path.abspath(os.path.join(job_dir, 'teacher_job')),
+        '--shards', str(args.shards), '--batch-size', str(args.batch_size), '--num-beams', str(args.teacher_beams),
+    ]
+    print(f'Translating {train_end} training sentences with the teacher...')
+    start = time.time()
+    subprocess.run(command, check = True, cwd = REPO_ROOT)
+    return distilled_path, time.time() - start
+
+
+def translate_and_score(path, test_src, test_tgt, batch_size, num_beams):
+    '''BLEU and batched sentences/sec of the inference checkpoint at `path` on the given sentences. '''
+    from bo_translate import load_translator, translate_window    # Imported here because only this benchmark needs the package at the repository root
+    translator = load_translator(path, 'cpu')
+    options = dict(num_beams = num_beams)
+    translate_window(translator, test_src[:batch_size], batch_size, options)    # Warm up, so one-off allocations are not timed
+    start = time.perf_counter()
+    hypotheses = translate_window(translator, test_src, batch_size, options)
+    secs = time.perf_counter() - start
+    return dict(
+        params_M = round(sum(p.numel() for p in translator.model.parameters()) / 1e6, 1),
+        file_MB = round(os.path.getsize(path) / 2**20, 1),
+        bleu = round(corpus_bleu(hypotheses, test_tgt), 2),
+        sentences_per_sec = round(len(test_src) / secs, 2),
+    )
+
+
+def benchmark_distill(args):
+    test_src, test_tgt = test_split(srcTextsAll, tgtTextsAll, hparams, args.eval_size)
+    train_end = int(args.train_percentage * len(srcTextsAll))
+    job_dir = os.path.join(args.output_dir, 'distill')
+    distilled_path, teacher_secs = distill_corpus(args, train_end, job_dir)
+
+    students = [('distilled', distilled_path)] + ([('references', None)] if args.reference_student else [])
+    results = [dict(model = 'T5 teacher', num_beams = args.teacher_beams, train_min = None, val_loss = None,
+                    **translate_and_score(args.teacher, test_src, test_tgt, args.batch_size, args.teacher_beams))]
+    for name, targets in students:
+        run_hparams = short_run_hparams(layer_hparams(args.config), args, f'distill_{name}', d_model = args.d_model, dim_feedforward = args.dim_feedforward, distilled_targets = targets)
+        print(f'Training the {args.config} student (d_model {args.d_model}) on the {name} for {args.num_epochs} epoch(s)...')
+        torch.manual_seed(args.seed)
+        model, optim, scheduler, train_mbi, val_mbi = build_training(run_hparams)
+        train_start = time.time()
+        history = train(iter(train_mbi), iter(val_mbi), model, optim, scheduler, run_hparams)
+        train_secs = time.time() - train_start
+
+        student_path = os.path.join(job_dir, f'student_{name}.safetensors')
+        save_inference_checkpoint(model.to('cpu'), run_hparams, student_path, (srcTokenizerPath, tgtTokenizerPath))
+        del model, optim
+        for num_beams in [1, args.num_beams]:
+            results.append(dict(model = f'{args.config} student ({name})', num_beams = num_beams, train_min = round(train_secs / 60, 1),
+                                val_loss = round(history['val_losses'][-1], 3), **translate_and_score(student_path, test_src, test_tgt, args.batch_size, num_beams)))
+        print('Student inference checkpoint saved to', student_path)
+
+    print(f'\nTraining sentences: {train_end}, held-out sentences: {len(test_src)}, batch size: {args.batch_size}, CPU threads: {torch.get_num_threads()}')
+    if teacher_secs is not None:
+        print(f'Teacher decoding of the training sources: {teacher_secs / 60:.1f} min ({train_end / teacher_secs:.2f} sentences/sec)')
+    print('Val loss is measured against the references.')
+    print_table(results, list(results[0].keys()))
+    write_json(args, 'distill_benchmark.json', results)
+
+
+
+# --------------------------
+#### Benchmark: ONNX Runtime decoding
+# --------------------------
+
+'''
+# Export an inference checkpoint with bo_translate.onnx_export and translate the held-out split on the CPU with eager
+# PyTorch and with bo_translate.onnx_runtime: one sentence at a time greedily and with beam search, then --batch-size
+# sentences at a time through the translators. ONNX Runtime feeds the decoder one token per step with the past keys and
+# values, eager PyTorch decodes the whole prefix at every step. Parity: every ONNX greedy translation must equal
+# greedy_decode_sentence() (which decodes greedy_decode_ids()), and the logits of the decoder step graph must stay within
+# --tolerance of MyTransformer.decode() along the eager greedy output.
+'''
+
+def eager_logits(model, src_ids, tgt):
+    '''Logits of MyTransformer.decode() for every target id of `tgt` (<s> first), as a numpy array to compare with the ONNX decoder steps. '''
+    with torch.inference_mode():
+        memory = model.encode(torch.LongTensor([src_ids]))
+        return model.decode(torch.LongTensor([tgt]), memory, tgt_mask = generate_np_mask(len(tgt), 'cpu'))[0].numpy()
+
+
+def benchmark_onnx(args):
+    # Imported here because only this benchmark needs them
+    from bo_translate import load_translator, translate_window
+    from bo_translate.onnx_export import export_onnx
+    from bo_translate import onnx_runtime
+
+    test_src, test_tgt = test_split(srcTextsAll, tgtTextsAll, hparams, args.eval_size)
+    export_dir = args.export_dir or os.path.join(args.output_dir, 'onnx')
+    start = time.perf_counter()
+    export_onnx(args.checkpoint, export_dir)
+    export_secs = time.perf_counter() - start
+    onnx_MB = sum(os.path.getsize(os.path.join(export_dir, name)) for name in ['encoder.onnx', 'decoder.onnx']) / 2**20
+    print(f'Exported to {export_dir} in {export_secs:.1f} s ({onnx_MB:.1f} MB)')
+
+    model = load_inference_checkpoint(args.checkpoint, 'cpu')[0]
+    onnx_translator = onnx_runtime.Translator(export_dir, 'cpu', threads = torch.get_num_threads())
+    onnx_model = onnx_translator.model
+    decoders = [
+        ('PyTorch eager', lambda ids: greedy_decode_ids(model, ids), lambda ids: beam_decode_ids(model, ids, num_beams = args.num_beams), load_translator(args.checkpoint, 'cpu')),
+        ('ONNX Runtime', lambda ids: onnx_runtime.greedy_decode_batch(onnx_model, [ids], src_pad_id, tgt_bos_id, tgt_eos_id)[0][0],
+         lambda ids: onnx_runtime.beam_decode_ids(onnx_model, ids, tgt_bos_id, tgt_eos_id, args.num_beams), onnx_translator),
+    ]
+
+    results, hypotheses = [], {}
+    for name, greedy, beam, translator in decoders:
+        greedy_hyps, greedy_latencies = decode_and_time(greedy, test_src)
+        beam_hyps, beam_latencies = decode_and_time(beam, test_src)
+        translate_window(translator, test_src[:args.batch_size], args.batch_size, dict(num_beams = 1))    # Warm up
+        start = time.perf_counter()
+        translate_window(translator, test_src, args.batch_size, dict(num_beams = 1))
+        batch_secs = time.perf_counter() - start
+        hypotheses[name] = greedy_hyps, beam_hyps
+        results.append(dict(
+            backend = name,
+            greedy_bleu = round(corpus_bleu(greedy_hyps, test_tgt), 2),
+            greedy_p50_ms = round(percentile(greedy_latencies, 50) * 1000, 1),
+            greedy_p90_ms = round(percentile(greedy_latencies, 90) * 1000, 1),
+            beam_bleu = round(corpus_bleu(beam_hyps, test_tgt), 2),
+            beam_p50_ms = round(percentile(beam_latencies, 50) * 1000, 1),
+            beam_p90_ms = round(percentile(beam_latencies, 90) * 1000, 1),
+            batched_sentences_per_sec = round(len(test_src) / batch_secs, 2),
+            greedy_identical = sum(hyp == ref for hyp, ref in zip(greedy_hyps, hypotheses['PyTorch eager'][0])),
+            beam_identical = sum(hyp == ref for hyp, ref in zip(beam_hyps, hypotheses['PyTorch eager'][1])),
+        ))
+        print(results[-1], flush = True)
+
+    differences = []
+    for text in test_src:
+        src_ids = srcTokenizer.encode(text)
+        tgt = [tgt_bos_id] + greedy_decode_ids(model, src_ids)[:-1]
+        differences.append(onnx_logit_difference(eager_logits(model, src_ids, tgt), onnx_model, src_ids, tgt))
+    parity = dict(
+        greedy_identical = results[1]['greedy_identical'],
+        max_logit_difference = max(differences),
+        passed = results[1]['greedy_identical'] == len(test_src) and max(differences) <= args.tolerance,
+    )
+
+    print(f'\nHeld-out sentences: {len(test_src)}, beams: {args.num_beams}, batch size: {args.batch_size}, CPU threads: {torch.get_num_threads()}')
+    print_table(results, list(results[0].keys()))
+    print(f"Parity with greedy_decode_sentence() (logit tolerance {args.tolerance}): {'PASS' if parity['passed'] else 'FAIL'}. "
+          f"Identical greedy translations: {parity['greedy_identical']}/{len(test_src)}, max logit difference: {parity['max_logit_difference']:.2e}")
+    write_json(args, 'onnx_benchmark.json', dict(results = results, parity = parity, export_s = round(export_secs, 1), onnx_MB = round(onnx_MB, 1)))
+
+
+
+# --------------------------
+#### Benchmark: compiled greedy decoding
+# --------------------------
+
+'''
+# Greedy decoding with the encoder and the decoder step compiled by bo_translate.compiled, with TorchScript and with
+# torch.compile (inductor), against eager PyTorch. Each backend runs `python -m bo_translate.compiled` in a fresh process
+# twice: cold, with an empty compile cache, then warm, reusing what the cold start saved. Per batch size that reports the
+# startup, the first pass over the held-out sentences (where the buckets are compiled or loaded) and the steady-state
+# batch latency. The translations of every run are compared with the eager ones.
+'''
+
+def benchmark_compile(args):
+    test_src, _ = test_split(srcTextsAll, tgtTextsAll, hparams, args.eval_size)
+    job_dir = os.path.abspath(os.path.join(args.output_dir, 'compile'))
+    os.makedirs(job_dir, exist_ok = True)
+    src_path = os.path.join(job_dir, 'test.bo')
+    with open(src_path, 'w', encoding = 'utf-8') as f:
+        f.writelines(text + '\n' for text in test_src)
+
+    runs = [('eager', '-')] + [(backend, start) for backend in args.backends for start in ('cold', 'warm')]
+    results, translations = [], {}
+    for backend, start in runs:
+        cache_dir = os.path.join(job_dir, f'{backend}_cache')
+        if start == 'cold' and os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir)
+        name = f'{backend}_{start}'.strip('_-')
+        command = [
+            sys.executable, '-m', 'bo_translate.compiled', os.path.abspath(args.checkpoint), '--backend', backend, '--cache-dir', cache_dir,
+            '--input', src_path, '--sentences', str(len(test_src)), '--batch-sizes', *map(str, args.batch_sizes), '--max-len', str(args.max_len),
+            '--output', os.path.join(job_dir, f'{name}.en'), '--json', os.path.join(job_dir, f'{name}.json'),
+        ]
+        if args.threads:
+            command += ['--threads', str(args.threads)]
+        print(f'Running {backend} ({start} start)...', flush = True)
+        launched = time.perf_counter()
+        subprocess.run(command, check = True, cwd = REPO_ROOT, stdout = subprocess.DEVNULL)
+        process_secs = time.perf_counter() - launched
+        with open(os.path.join(job_dir, f'{name}.json')) as f:
+            run = json.load(f)
+        with open(os.path.join(job_dir, f'{name}.en'), encoding = 'utf-8') as f:
+            translations[name] = f.read().splitlines()
+        for row in run['results']:
+            results.append(dict(
+                backend = backend, start = start, batch_size = row['batch_size'], process_s = round(process_secs, 1),
+                load_s = row['load_s'], first_pass_s = row['first_pass_s'], p50_batch_ms = row['p50_batch_ms'], p90_batch_ms = row['p90_batch_ms'],
+                sentences_per_sec = row['sentences_per_sec'], buckets_compiled = run['stats']['compiled'], buckets_loaded = run['stats']['loaded'],
+                identical = sum(hyp == ref for hyp, ref in zip(translations[name], translations['eager'])),
+            ))
+        print(results[-1], flush = True)
+
+    parity = dict(
+        identical = {name: sum(hyp == ref for hyp, ref in zip(hyps, translations['eager'])) for name, hyps in translations.items()},
+        passed = all(hyps == translations['eager'] for hyps in translations.values()),
+    )
+
+    print(f'\nHeld-out sentences: {len(test_src)}, max_len: {args.max_len}, CPU threads: {args.threads or torch.get_num_threads()}')
+    print_table(results, list(results[0].keys()))
+    print(f"Parity with eager greedy decoding: {'PASS' if parity['passed'] else 'FAIL'}. Identical translations: "
+          + ', '.join(f'{name} {count}/{len(test_src)}' for name, count in parity['identical'].items() if name != 'eager'))
+    write_json(args, 'compile_benchmark.json', dict(results = results, parity = parity))
+
+
+
+# --------------------------
+#### Command line
+# --------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmarks for the transformer from scratch')
+    parser.add_argument('--output-dir', default = 'benchmark', help = 'where logs, checkpoints and json results go')
+    parser.add_argument('--threads', type = int, default = None, help = 'torch intra-op threads for CPU timing')
+    parser.add_argument('--seed', type = int, default = 0)
+    subparsers = parser.add_subparsers(dest = 'benchmark', required = True)
+
+    depth = subparsers.add_parser('depth', help = 'BLEU vs. decoding latency for encoder-decoder depth configs')
+    depth.add_argument('--configs', nargs = '+', default = ['6-6', '6-2', '12-1'], help = '<encoder layers>-<decoder layers>')
+    depth.add_argument('--num-epochs', type = int, default = 1)
+    depth.add_argument('--train-percentage', type = float, default = 0.1, help = 'fraction of the corpus used for the short training runs')
+    depth.add_argument('--warmup-steps', type = int, default = 500)
+    depth.add_argument('--eval-size', type = int, default = 200, help = 'number of held-out sentences to translate')
+    depth.add_argument('--num-beams', type = int, default = 4)
+    depth.set_defaults(run = benchmark_depth)
+
+    quantize = subparsers.add_parser('quantize', help = 'save a dynamic int8 model and compare it with fp32')
+    quantize.add_argument('--checkpoint', default = 'Scratch_checkpoint_best_epoch=34.pt', help = 'fp32 state_dict to quantize')
+    quantize.add_argument('--config', default = f"{hparams['num_encoder_layers']}-{hparams['num_decoder_layers']}", help = '<encoder layers>-<decoder layers> of the checkpoint')
+    quantize.add_argument('--output', default = 'Scratch_checkpoint_int8.pt')
+    quantize.add_argument('--eval-size', type = int, default = 200)
+    quantize.add_argument('--num-beams', type = int, default = 4)
+    quantize.set_defaults(run = benchmark_quantize)
+
+    bf16 = subparsers.add_parser('bf16', help = 'fp32 vs. bf16 autocast training: throughput, memory and loss-curve parity')
+    bf16.add_argument('--config', default = f"{hparams['num_encoder_layers']}-{hparams['num_decoder_layers']}", help = '<encoder layers>-<decoder layers>')
+    bf16.add_argument('--num-epochs', type = int, default = 1)
+    bf16.add_argument('--train-percentage', type = float, default = 0.05)
+    bf16.add_argument('--warmup-steps', type = int, default = 500)
+    bf16.add_argument('--window', type = int, default = 50, help = 'moving-average window for the train loss curves')
+    bf16.add_argument('--tolerance', type = float, default = 0.05, help = 'max relative loss difference for the parity check')
+    bf16.set_defaults(run = benchmark_bf16)
+
+    optimizer = subparsers.add_parser('optimizer', help = 'Adam vs. Adafactor: optimizer state memory, step time and convergence')
+    optimizer.add_argument('--config', default = f"{hparams['num_encoder_layers']}-{hparams['num_decoder_layers']}", help = '<encoder layers>-<decoder layers>')
+    optimizer.add_argument('--num-epochs', type = int, default = 1)
+    optimizer.add_argument('--train-percentage', type = float, default = 0.05)
+    optimizer.add_argument('--warmup-steps', type = int, default = 500)
+    optimizer.add_argument('--window', type = int, default = 50, help = 'moving-average window for the final train loss')
+    optimizer.add_argument('--tolerance', type = float, default = 0.05, help = 'max relative loss difference for the convergence check')
+    optimizer.set_defaults(run = benchmark_optimizer)
+
+    checkpointing = subparsers.add_parser('checkpointing', help = 'largest batch that fits and tokens/sec with activation checkpointing off and on')
+    checkpointing.add_argument('--config', default = f"{hparams['num_encoder_layers']}-{hparams['num_decoder_layers']}", help = '<encoder layers>-<decoder layers>')
+    checkpointing.add_argument('--memory-budget-mb', type = float, default = 8000, help = 'memory a training step may use, e.g. the GPU memory')
+    checkpointing.add_argument('--max-batch-size', type = int, default = 1024)
+    checkpointing.add_argument('--batch-size', type = int, default = hparams['train_batch_size'], help = 'common batch size for the tokens/sec comparison')
+    checkpointing.add_argument('--steps', type = int, default = 20, help = 'timed training steps per batch size')
+    checkpointing.set_defaults(run = benchmark_checkpointing)
+
+    coldstart = subparsers.add_parser('coldstart', help = 'export inference checkpoints and time Scratch_get_results.py from launch to first translation')
+    coldstart.add_argument('--checkpoint', default = 'Scratch_checkpoint_best_epoch=34.pt', help = 'state_dict saved by Scratch.train()')
+    coldstart.add_argument('--config', default = f"{hparams['num_encoder_layers']}-{hparams['num_decoder_layers']}", help = '<encoder layers>-<decoder layers> of the checkpoint')
+    coldstart.add_argument('--output', default = 'Scratch_inference.safetensors', help = 'fp32 inference checkpoint, the bf16 one goes next to it')
+    coldstart.add_argument('--repeats', type = int, default = 5, help = 'launches per checkpoint')
+    coldstart.set_defaults(run = benchmark_coldstart)
+
+    prune = subparsers.add_parser('prune', help = 'remove the least important attention heads and feedforward neurons: latency/BLEU curve over pruning ratios')
+    prune.add_argument('--checkpoint', default = 'Scratch_inference.safetensors', help = 'inference checkpoint, or state_dict saved by Scratch.train()')
+    prune.add_argument('--config', default = f"{hparams['num_encoder_layers']}-{hparams['num_decoder_layers']}", help = '<encoder layers>-<decoder layers> of a state_dict checkpoint')
+    prune.add_argument('--ratios', type = float, nargs = '+', default = [0, 0.25, 0.5, 0.75], help = 'share of heads / feedforward neurons removed')
+    prune.add_argument('--blocks', nargs = '+', choices = ['heads', 'ffn'], default = ['heads', 'ffn'], help = 'what to prune')
+    prune.add_argument('--score-size', type = int, default = 200, help = 'validation sentences the importance scores are computed on')
+    prune.add_argument('--finetune-epochs', type = int, default = 0, help = 'short fine-tune of every pruned model, 0 = none')
+    prune.add_argument('--train-percentage', type = float, default = 0.1, help = 'fraction of the corpus used for fine-tuning')
+    prune.add_argument('--warmup-steps', type = int, default = 100)
+    prune.add_argument('--eval-size', type = int, default = 200)
+    prune.add_argument('--num-beams', type = int, default = 4)
+    prune.set_defaults(run = benchmark_prune)
+
+    distill = subparsers.add_parser('distill', help = 'train a smaller model on T5 translations of the training sources and compare it with T5')
+    distill.add_argument('--teacher', default = '../T5_Transformers/T5_inference.safetensors', help = 'T5 inference checkpoint')
+    distill.add_argument('--teacher-beams', type = int, default = 4, help = 'beams of the teacher, for distillation and evaluation')
+    distill.add_argument('--config', default = '6-2', help = '<encoder layers>-<decoder layers> of the student')
+    distill.add_argument('--d-model', type = int, default = 256)
+    distill.add_argument('--dim-feedforward', type = int, default = 1024)
+    distill.add_argument('--reference-student', action = 'store_true', help = 'also train the student on the references, for comparison')
+    distill.add_argument('--num-epochs', type = int, default = 1)
+    distill.add_argument('--train-percentage', type = float, default = hparams['train_percentage'], help = 'fraction of the corpus distilled and trained on')
+    distill.add_argument('--warmup-steps', type = int, default = 500)
+    distill.add_argument('--shards', type = int, default = 16, help = 'shards of the resumable teacher decoding job')
+    distill.add_argument('--batch-size', type = int, default = 32, help = 'sentences per batch when translating')
+    distill.add_argument('--eval-size', type = int, default = 200)
+    distill.add_argument('--num-beams', type = int, default = 4, help = 'beams of the student, which is also evaluated greedily')
+    distill.set_defaults(run = benchmark_distill)
+
+    onnx = subparsers.add_parser('onnx', help = 'export to ONNX and compare onnxruntime decoding with eager PyTorch on CPU: parity and latency')
+    onnx.add_argument('--checkpoint', default = 'Scratch_inference.safetensors', help = 'inference checkpoint, see the coldstart benchmark')
+    onnx.add_argument('--export-dir', default = None, help = 'where the ONNX graphs go, default <output-dir>/onnx')
+    onnx.add_argument('--eval-size', type = int, default = 200)
+    onnx.add_argument('--num-beams', type = int, default = 4)
+    onnx.add_argument('--batch-size', type = int, default = 32, help = 'sentences per batch for the batched greedy throughput')
+    onnx.add_argument('--tolerance', type = float, default = 1e-3, help = 'max absolute logit difference for the parity check')
+    onnx.set_defaults(run = benchmark_onnx)
+
+    compiled = subparsers.add_parser('compile', help = 'TorchScript and torch.compile greedy decoding vs. eager: cold and warm start, latency per batch size')
+    compiled.add_argument('--checkpoint', default = 'Scratch_inference.safetensors', help = 'inference checkpoint, see the coldstart benchmark')
+    compiled.add_argument('--backends', nargs = '+', choices = ['torchscript', 'inductor'], default = ['torchscript', 'inductor'])
+    compiled.add_argument('--batch-sizes', type = int, nargs = '+', default = [1, 8])
+    compiled.add_argument('--eval-size', type = int, default = 200)
+    compiled.add_argument('--max-len', type = int, default = 100)
+    compiled.set_defaults(run = benchmark_compile)
+
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+# =======================================
+##### Helpers shared by Scratch_benchmark.py and T5_benchmark.py
+# =======================================
+
+'''
+# One definition of each helper that does not depend on the model: splits, memory estimates, short training runs,
+# timed launches and the json output. What differs between the two models (the corpus, compute_loss(), the batch
+# iterator, the eager logits) is passed in by the benchmark script, so this module imports neither Scratch.py nor T5.py.
+# The benchmark scripts put the repository root on sys.path and import it as benchmarks.common.
+'''
+
+import io
+import json
+import os
+import subprocess
+import time
+
+import torch
+
+from bo_translate.reporting import percentile
+
+
+
+# --------------------------
+#### Splits and batches
+# --------------------------
+
+def test_split(srcTexts, tgtTexts, hparams, size):
+    '''The first `size` sentence pairs of the held-out split, i.e. after the train and val splits of `hparams`. '''
+    start = int((hparams['train_percentage'] + hparams['val_percentage']) * len(srcTexts))
+    return srcTexts[start:start + size], tgtTexts[start:start + size]
+
+
+def train_batch_iterator(MyBatchIterator, batch_options, batch_size, end_idx):
+    '''Batches of the training pairs [0, end_idx), as build_training() makes them. `batch_options` are the other MyBatchIterator arguments. '''
+    return MyBatchIterator(start_idx = 0, end_idx = end_idx, batch_size = batch_size, **batch_options)
+
+
+def first_train_batch(MyBatchIterator, batch_options, size):
+    '''The first `size` training pairs as one padded batch. '''
+    return next(iter(train_batch_iterator(MyBatchIterator, batch_options, size, size)))
+
+
+
+# --------------------------
+#### Training steps and memory
+# --------------------------
+
+def short_run_hparams(base_hparams, args, name, **overrides):
+    '''`base_hparams` for a short benchmark run that logs to --output-dir/<name>. '''
+    return dict(
+        base_hparams,
+        num_epochs = args.num_epochs,
+        train_percentage = args.train_percentage,
+        warmup_steps = args.warmup_steps,
+        checkpoint_at = [],
+        output_dir = os.path.join(args.output_dir, name),
+        **overrides
+    )
+
+
+def step_stats(history):
+    '''Median step time and training throughput from the history returned by train(). '''
+    return dict(
+        step_p50_ms = round(percentile(history['step_seconds'], 50) * 1000, 1),
+        tokens_per_sec = round(sum(history['step_tokens']) / sum(history['step_seconds']), 1),
+    )
+
+
+def moving_average(values, window):
+    return [sum(values[max(0, i - window + 1):i + 1]) / (i + 1 - max(0, i - window + 1)) for i in range(len(values))]
+
+
+def train_step(compute_loss, model, optimizer, batch, hparams):
+    '''One optimizer step on `batch`. Returns the loss, which also waits for the step to finish. '''
+    optimizer.zero_grad(set_to_none = True)
+    loss = compute_loss(model, batch, hparams)
+    loss.backward()
+    optimizer.step()
+    return loss.item()
+
+
+def weights_megabytes(model):
+    '''Size of the serialized state_dict, i.e. the memory the weights take once loaded. '''
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return round(buffer.tell() / 2**20, 1)
+
+
+def optimizer_state_megabytes(optimizer):
+    '''Memory of every tensor in the optimizer state, e.g. the moments of Adam / AdamW. '''
+    return round(sum(t.numel() * t.element_size() for state in optimizer.state.values() for t in state.values() if torch.is_tensor(t)) / 2**20, 1)
+
+
+def saved_activation_megabytes(compute_loss, model, batch, hparams):
+    '''
+    Memory of the activations autograd keeps for backward in one training step, i.e. what grows with batch size.
+    Counts every storage saved by the forward pass once, except the parameters themselves. Works on CPU and GPU alike.
+    '''
+    param_ptrs = {p.untyped_storage().data_ptr() for p in model.parameters()}
+    saved = {}
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in param_ptrs:
+            saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    model.train()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        loss = compute_loss(model, batch, hparams)
+    del loss
+    return round(sum(saved.values()) / 2**20, 1)
+
+
+def peak_train_step_megabytes(compute_loss, model, optimizer, batch, hparams):
+    '''
+    Peak memory of one training step. On GPU this is measured. On CPU it is estimated as
+    weights + gradients + Adam / AdamW moments (4x the parameter bytes) plus the activations saved for backward.
+    '''
+    device = next(model.parameters()).device
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        train_step(compute_loss, model, optimizer, batch, hparams)
+        return round(torch.cuda.max_memory_allocated(device) / 2**20, 1)
+    static_MB = 4 * sum(p.numel() * p.element_size() for p in model.parameters()) / 2**20
+    return round(static_MB + saved_activation_megabytes(compute_loss, model, batch, hparams), 1)
+
+
+def largest_fitting_batch(fits, limit):
+    '''Largest batch size in [1, limit] with fits(size) true, by doubling and then bisecting. Assumes fits is monotone. '''
+    size, largest = 1, 0
+    while size <= limit and fits(size):
+        largest, size = size, size * 2
+    lower, upper = largest, min(size, limit + 1)    # fits(lower) holds (or lower == 0), fits(upper) does not (or is past the limit)
+    while upper - lower > 1:
+        middle = (lower + upper) // 2
+        lower, upper = (middle, upper) if fits(middle) else (lower, middle)
+    return lower
+
+
+
+# --------------------------
+#### Launches, ONNX parity and output
+# --------------------------
+
+def launch_and_time(command, markers, cwd):
+    '''Run `command` in a fresh process from `cwd`. Return the seconds from launch until a line starting with each of `markers` is printed, then stop the process. '''
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, text = True, cwd = cwd)
+    seen, output = {}, []
+    for line in process.stdout:
+        output.append(line)
+        for marker in markers:
+            if marker not in seen and line.startswith(marker):
+                seen[marker] = time.perf_counter() - start
+        if len(seen) == len(markers):
+            break
+    process.kill()
+    process.wait()
+    if len(seen) < len(markers):
+        raise RuntimeError(f'{command} exited before printing {markers}:\n' + ''.join(output[-20:]))
+    return seen
+
+
+def onnx_logit_difference(eager, onnx_model, src_ids, decoder_ids):
+    '''Largest absolute difference between the eager logits `eager` (one row per decoder id) and those of the ONNX decoder steps fed `decoder_ids`. '''
+    import numpy as np    # Imported here because only the onnx benchmarks need it
+    attention_mask = np.ones((1, len(src_ids)), dtype = np.int64)
+    cross = onnx_model.encode(np.array([src_ids], dtype = np.int64), attention_mask)
+    past = onnx_model.empty_past(1)
+    difference = 0.0
+    for i, token in enumerate(decoder_ids):
+        logits, past = onnx_model.step(np.array([[token]], dtype = np.int64), i, attention_mask, past, cross)
+        difference = max(difference, float(np.abs(logits[0] - eager[i]).max()))
+    return difference
+
+
+def write_json(args, name, results):
+    os.makedirs(args.output_dir, exist_ok = True)
+    path = os.path.join(args.output_dir, name)
+    with open(path, 'w') as f:
+        json.dump(dict(args = {k: v for k, v in vars(args).items() if k != 'run'}, results = results), f, indent = 2)
+    print('Results written to', path)
@@ -0,0 +1,370 @@
+# =======================================
+##### Offline benchmark suite
+# =======================================
+
+'''
+# Run from this folder, e.g.
+#   python suite.py run --output baseline.json
+#   python suite.py run --output current.json --only spm_encode_bo collate scratch_train_step
+#   python suite.py compare baseline.json current.json --tolerance 0.1
+# `run` times the building blocks of training and decoding on a synthetic corpus (synthetic_corpus.py), so it needs
+# neither the real corpus nor a download: SentencePiece encoding, MyBatchIterator collation, a MyTransformer forward and
+# training step, a T5 training step (t5-small's architecture, randomly initialized), greedy and beam decoding, and the
+# data_preprocess.py cleaners. Every benchmark runs once to warm up and then --repeats times, and the json records the
+# timings together with the environment (versions, CPU, threads, git commit).
+# `compare` matches two such files benchmark by benchmark and exits with status 1 if any median got slower by more than
+# --tolerance, so it can gate a change in CI. Results are only comparable on the same machine and settings, which it checks.
+#
+# Scratch.py and T5.py read ../data/train.* and ../preProcessing/*.model relative to the working directory on import, so
+# the suite writes the synthetic corpus and copies the tokenizers into --work-dir with that layout and runs from there.
+# Models are randomly initialized with --seed: timings do not depend on the weights, and decoding always runs --max-len
+# steps, since an untrained model hardly ever produces </s>. A benchmark whose module fails to import (e.g. T5.py with a
+# transformers that lacks something it needs) is recorded as skipped, with the error, and the others still run.
+'''
+
+import argparse
+import datetime
+import importlib
+import importlib.metadata
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from synthetic_corpus import write_corpus
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+from bo_translate.reporting import percentile, print_table    # The reporting helpers are shared with the bo_translate package
+
+
+
+# --------------------------
+#### Helpers
+# --------------------------
+
+def prepare_workspace(args):
+    '''
+    Write the synthetic corpus to <work-dir>/data and the tokenizers to <work-dir>/preProcessing, then move into
+    <work-dir>/run and put the training scripts on sys.path, so that `import Scratch` / `import T5` load the synthetic corpus.
+    '''
+    work_dir = os.path.abspath(args.work_dir)
+    write_corpus(os.path.join(work_dir, 'data'), args.sentences, args.seed)
+    os.makedirs(os.path.join(work_dir, 'preProcessing'), exist_ok = True)
+    for name in ['bo.model', 'en.model']:
+        shutil.copy(os.path.join(REPO_ROOT, 'preProcessing', name), os.path.join(work_dir, 'preProcessing', name))
+    os.makedirs(os.path.join(work_dir, 'run'), exist_ok = True)
+    os.chdir(os.path.join(work_dir, 'run'))
+    for folder in ['Transformer_From_Scratch', 'T5_Transformers', 'preProcessing']:
+        sys.path.insert(0, os.path.join(REPO_ROOT, folder))
+    return work_dir
+
+
+def git_commit():
+    '''The checked-out commit, with '-dirty' if the tree has uncommitted changes, or None outside a git checkout. '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd = REPO_ROOT, capture_output = True, text = True, check = True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd = REPO_ROOT, capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+
+def environment():
+    import torch
+    packages = {}
+    for package in ['sentencepiece', 'transformers', 'numpy']:
+        try:
+            packages[package] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            packages[package] = None
+    return dict(
+        timestamp = datetime.datetime.now().isoformat(timespec = 'seconds'),
+        git_commit = git_commit(),
+        python = platform.python_version(),
+        platform = platform.platform(),
+        processor = platform.processor() or platform.machine(),
+        cpu_count = os.cpu_count(),
+        torch = torch.__version__,
+        torch_threads = torch.get_num_threads(),
+        cuda = torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+        **packages,
+    )
+
+
+def measure(function, repeats):
+    '''Call `function` once to warm up, then `repeats` times. Return the seconds each timed call took. '''
+    function()
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+
+# --------------------------
+#### Benchmarks
+# --------------------------
+
+'''
+# Each benchmark sets up its inputs and returns (function to time, items per call, unit of the items, extra info).
+# Setup is not timed. `per_sec` in the results is items / median seconds.
+'''
+
+def bench_spm_encode_bo(args):
+    Scratch = importlib.import_module('Scratch')
+    texts = Scratch.srcTextsAll
+    tokens = sum(len(ids) for ids in Scratch.srcTokenizer.encode(texts))
+    return lambda: Scratch.srcTokenizer.encode(texts), len(texts), 'sentences', dict(tokens = tokens)
+
+
+def bench_spm_encode_en(args):
+    Scratch = importlib.import_module('Scratch')
+    texts = Scratch.tgtTextsAll
+    tokens = sum(len(ids) for ids in Scratch.tgtTokenizer.encode(texts))
+    return lambda: Scratch.tgtTokenizer.encode(texts), len(texts), 'sentences', dict(tokens = tokens)
+
+
+def bench_collate(args):
+    '''Tokenize, add <s></s>, pad and stack the whole corpus in batches, as Scratch.train() gets it. '''
+    Scratch = importlib.import_module('Scratch')
+    batches = Scratch.MyBatchIterator(
+        Scratch.srcTextsAll, Scratch.tgtTextsAll, Scratch.srcTokenizer, Scratch.tgtTokenizer,
+        start_idx = 0, end_idx = len(Scratch.srcTextsAll), batch_size = args.batch_size,
+        src_pad_id = Scratch.src_pad_id, tgt_pad_id = Scratch.tgt_pad_id, tgt_bos_id = Scratch.tgt_bos_id, tgt_eos_id = Scratch.tgt_eos_id)
+    return lambda: sum(1 for _ in iter(batches)), len(Scratch.srcTextsAll), 'sentences', dict(batches = len(batches))
+
+
+def scratch_model_and_batch(args):
+    import torch
+    Scratch = importlib.import_module('Scratch')
+    torch.manual_seed(args.seed)
+    model = Scratch.MyTransformer(Scratch.hparams).to(Scratch.device)
+    batches = Scratch.MyBatchIterator(
+        Scratch.srcTextsAll, Scratch.tgtTextsAll, Scratch.srcTokenizer, Scratch.tgtTokenizer,
+        start_idx = 0, end_idx = args.batch_size, batch_size = args.batch_size,
+        src_pad_id = Scratch.src_pad_id, tgt_pad_id = Scratch.tgt_pad_id, tgt_bos_id = Scratch.tgt_bos_id, tgt_eos_id = Scratch.tgt_eos_id)
+    batch = next(iter(batches))
+    target_tokens = int((batch['tgt'][:, 1:] != Scratch.tgt_pad_id).sum())
+    return Scratch, model, batch, target_tokens
+
+
+def bench_scratch_forward(args):
+    '''Loss of one batch with teacher forcing, without autograd. '''
+    import torch
+    Scratch, model, batch, target_tokens = scratch_model_and_batch(args)
+    model.train()    # dropout on, as in training
+
+    def forward():
+        with torch.no_grad():
+            Scratch.compute_loss(model, batch, Scratch.hparams)
+    return forward, target_tokens, 'tokens', dict(batch_size = args.batch_size)
+
+
+def bench_scratch_train_step(args):
+    '''Forward, backward and optimizer step of one batch, as in Scratch.train(). '''
+    Scratch, model, batch, target_tokens = scratch_model_and_batch(args)
+    model.train()
+    optim = Scratch.build_optimizer(model, Scratch.hparams)
+
+    def step():
+        optim.zero_grad()
+        Scratch.compute_loss(model, batch, Scratch.hparams).backward()
+        optim.step()
+    return step, target_tokens, 'tokens', dict(batch_size = args.batch_size)
+
+
+def bench_t5_train_step(args):
+    '''Forward, backward and AdamW step of one batch of T5.compute_loss(), on t5-small's architecture built from its config, so nothing is downloaded. '''
+    import torch
+    from transformers import T5Config, T5ForConditionalGeneration
+    T5 = importlib.import_module('T5')
+    torch.manual_seed(args.seed)
+    config = T5Config(    # The defaults are t5-small's sizes, including its 32,128-row vocabulary, which right_size_vocabularies() cuts down
+        dropout_rate = T5.hparams['dropout'], eos_token_id = T5.tgt_eos_id, pad_token_id = T5.tgt_pad_id, decoder_start_token_id = T5.tgt_pad_id,
+    )
+    model = T5ForConditionalGeneration(config)
+    T5.right_size_vocabularies(model, range(T5.srcTokenizer.get_piece_size()), range(T5.tgtTokenizer.get_piece_size()))
+    model.to(T5.device).train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr = T5.hparams['target_lr'], betas = T5.hparams['adam_betas'])
+    batches = T5.MyBatchIterator(
+        T5.srcTextsAll, T5.tgtTextsAll, T5.srcTokenizer, T5.tgtTokenizer,
+        start_idx = 0, end_idx = args.batch_size, batch_size = args.batch_size,
+        src_pad_id = T5.src_pad_id, tgt_pad_id = T5.tgt_pad_id, tgt_bos_id = T5.tgt_pad_id, tgt_eos_id = T5.tgt_eos_id)
+    batch = next(iter(batches))
+    target_tokens = int((batch['tgt_ids'][:, 1:] != T5.tgt_pad_id).sum())
+
+    def step():
+        optimizer.zero_grad()
+        T5.compute_loss(model, batch, T5.hparams).backward()
+        optimizer.step()
+    return step, target_tokens, 'tokens', dict(batch_size = args.batch_size)
+
+
+def decoding_model_and_sources(args):
+    import torch
+    Scratch = importlib.import_module('Scratch')
+    torch.manual_seed(args.seed)
+    model = Scratch.MyTransformer(Scratch.hparams).to(Scratch.device).eval()
+    return Scratch, model, [Scratch.srcTokenizer.encode(text) for text in Scratch.srcTextsAll[:args.decode_sentences]]
+
+
+def bench_greedy_decode(args):
+    Scratch, model, sources = decoding_model_and_sources(args)
+    decode = lambda: [Scratch.greedy_decode_ids(model, ids, args.max_len) for ids in sources]
+    tokens = sum(len(ids) for ids in decode())
+    return decode, len(sources), 'sentences', dict(generated_tokens = tokens, max_len = args.max_len)
+
+
+def bench_beam_decode(args):
+    Scratch, model, sources = decoding_model_and_sources(args)
+    decode = lambda: [Scratch.beam_decode_ids(model, ids, args.num_beams, args.max_len) for ids in sources]
+    tokens = sum(len(ids) for ids in decode())
+    return decode, len(sources), 'sentences', dict(generated_tokens = tokens, max_len = args.max_len, num_beams = args.num_beams)
+
+
+def raw_lines(args, name):
+    data_preprocess = importlib.import_module('data_preprocess')
+    with open(os.path.join(args.work_dir, 'data', name), encoding = 'utf-8') as f:
+        return data_preprocess, data_preprocess.to_sentences(f.read())
+
+
+def bench_clean_bo(args):
+    data_preprocess, lines = raw_lines(args, 'bo.txt')
+    return lambda: data_preprocess.clean_lines_bo(lines), len(lines), 'lines', {}
+
+
+def bench_clean_en(args):
+    data_preprocess, lines = raw_lines(args, 'en.txt')
+    return lambda: data_preprocess.clean_lines_en(lines), len(lines), 'lines', {}
+
+
+BENCHMARKS = dict(
+    spm_encode_bo = bench_spm_encode_bo,
+    spm_encode_en = bench_spm_encode_en,
+    collate = bench_collate,
+    scratch_forward = bench_scratch_forward,
+    scratch_train_step = bench_scratch_train_step,
+    t5_train_step = bench_t5_train_step,
+    greedy_decode = bench_greedy_decode,
+    beam_decode = bench_beam_decode,
+    clean_bo = bench_clean_bo,
+    clean_en = bench_clean_en,
+)
+
+
+
+# --------------------------
+#### Commands
+# --------------------------
+
+def run(args):
+    output = os.path.abspath(args.output)
+    args.work_dir = prepare_workspace(args)
+    import torch
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    results = {}
+    for name in args.only or BENCHMARKS:
+        try:
+            function, items, unit, extra = BENCHMARKS[name](args)
+        except ImportError as error:    # A backend that cannot be imported here must not take the other benchmarks down with it
+            results[name] = dict(skipped = f'{type(error).__name__}: {error}')
+            print(name, 'skipped,', results[name]['skipped'], flush = True)
+            continue
+        seconds = measure(function, args.repeats)
+        median = percentile(seconds, 50)
+        results[name] = dict(
+            unit = unit, items = items, median_s = round(median, 6), min_s = round(min(seconds), 6), max_s = round(max(seconds), 6),
+            per_sec = round(items / median, 2), seconds = [round(s, 6) for s in seconds], **extra,
+        )
+        print(name, results[name], flush = True)
+
+    rows = [dict(benchmark = name, median_ms = round(r['median_s'] * 1000, 2), min_ms = round(r['min_s'] * 1000, 2),
+                 max_ms = round(r['max_s'] * 1000, 2), per_sec = f"{r['per_sec']} {r['unit']}") if 'skipped' not in r else
+            dict(benchmark = name, median_ms = '-', min_ms = '-', max_ms = '-', per_sec = 'skipped') for name, r in results.items()]
+    env = environment()
+    print(f"\nSynthetic sentences: {args.sentences}, repeats: {args.repeats}, torch threads: {env['torch_threads']}, commit: {env['git_commit']}")
+    print_table(rows, list(rows[0].keys()))
+    with open(output, 'w') as f:
+        json.dump(dict(environment = env, args = {k: v for k, v in vars(args).items() if k != 'run'}, results = results), f, indent = 2)
+    print('Results written to', output)
+
+
+# Settings that change the timings; `compare` warns when the two runs differ in any of them
+COMPARABLE_ENVIRONMENT = ['processor', 'cpu_count', 'torch_threads', 'cuda', 'python', 'torch', 'transformers', 'sentencepiece']
+COMPARABLE_ARGS = ['sentences', 'seed', 'batch_size', 'decode_sentences', 'max_len', 'num_beams']
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    for section, keys in [('environment', COMPARABLE_ENVIRONMENT), ('args', COMPARABLE_ARGS)]:
+        for key in keys:
+            if baseline[section].get(key) != current[section].get(key):
+                print(f'Warning: {key} differs, {baseline[section].get(key)} in the baseline and {current[section].get(key)} now')
+
+    rows, regressions = [], []
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            continue
+        if 'skipped' in result or 'skipped' in baseline['results'][name]:
+            print(f'Warning: {name} was skipped in the ' + ('current run' if 'skipped' in result else 'baseline') + ', not compared')
+            continue
+        before, after = baseline['results'][name]['median_s'], result['median_s']
+        change = after / before - 1
+        status = 'REGRESSION' if change > args.tolerance else 'faster' if change < -args.tolerance else 'ok'
+        if status == 'REGRESSION':
+            regressions.append(name)
+        rows.append(dict(benchmark = name, baseline_ms = round(before * 1000, 2), current_ms = round(after * 1000, 2), change = f'{change:+.1%}', status = status))
+
+    print(f"Baseline: {baseline['environment']['git_commit']} ({baseline['environment']['timestamp']}), "
+          f"current: {current['environment']['git_commit']} ({current['environment']['timestamp']}), tolerance: {args.tolerance:.0%}")
+    if rows:
+        print_table(rows, list(rows[0].keys()))
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
+    print('No regressions.')
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Offline benchmark suite: tokenization, collation, training steps, decoding and cleaning on a synthetic corpus')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+    run_parser = subparsers.add_parser('run', help = 'run the benchmarks and write the timings and the environment to json')
+    run_parser.add_argument('--output', default = 'suite_results.json')
+    run_parser.add_argument('--only', nargs = '+', choices = list(BENCHMARKS), default = None, help = 'default: all of them')
+    run_parser.add_argument('--work-dir', default = os.path.join(tempfile.gettempdir(), 'bo_benchmark_suite'), help = 'where the synthetic corpus is written')
+    run_parser.add_argument('--sentences', type = int, default = 2000, help = 'size of the synthetic corpus')
+    run_parser.add_argument('--seed', type = int, default = 0, help = 'seed of the corpus and of the model weights')
+    run_parser.add_argument('--repeats', type = int, default = 5, help = 'timed calls per benchmark, after one warm-up call')
+    run_parser.add_argument('--batch-size', type = int, default = 8, help = 'sentences per batch for collation and training steps')
+    run_parser.add_argument('--decode-sentences', type = int, default = 4, help = 'sentences decoded per call')
+    run_parser.add_argument('--max-len', type = int, default = 32, help = 'decoding steps per sentence')
+    run_parser.add_argument('--num-beams', type = int, default = 4)
+    run_parser.add_argument('--threads', type = int, default = None, help = 'torch intra-op threads')
+    run_parser.set_defaults(run = run)
+
+    compare_parser = subparsers.add_parser('compare', help = 'compare two result files and exit with status 1 on regressions')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--tolerance', type = float, default = 0.1, help = 'relative slowdown of a median that counts as a regression')
+    compare_parser.set_defaults(run = compare)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# =======================================
+##### Synthetic Tibetan / English parallel corpus
+# =======================================
+
+'''
+# The benchmarks need a corpus that anyone can regenerate, without downloading the real one, e.g.
+#   python synthetic_corpus.py --sentences 2000 --seed 0 --output-dir synthetic_data
+# writes train.bo / train.en (the layout Scratch.py and T5.py read from ../data) and bo.txt / en.txt, the same sentences
+# with the noise data_preprocess.py cleans up: bracketed glosses, numbers, punctuation, capitals and accents.
+# Words are drawn from a Zipf distribution over a vocabulary of common words plus generated ones, and sentence lengths from
+# a log-normal distribution, so token counts and the share of unknown pieces look roughly like the real corpus.
+# The same seed always gives the same corpus.
+'''
+
+import argparse
+import os
+import random
+
+
+# Common syllables, so that bo.model finds real pieces; the generated ones make up the long tail
+BO_SYLLABLES = [
+    'ནི', 'ཡིན', 'དང', 'གི', 'ཀྱི', 'གྱི', 'ལ', 'སུ', 'ཏུ', 'དུ', 'ན', 'ནས', 'ལས', 'བྱས', 'པ', 'བ', 'མ', 'མི', 'ཆོས', 'སངས',
+    'རྒྱས', 'བླ', 'སེམས', 'ཅན', 'ཐམས', 'ཅད', 'རིན', 'པོ', 'ཆེ', 'བོད', 'ཡུལ', 'རྒྱལ', 'ཁབ', 'བདེ', 'ལེགས', 'བཀྲ', 'ཤིས', 'ཡོད',
+    'རེད', 'འདི', 'དེ', 'གང', 'ཞིག', 'བཞིན', 'ཚིག', 'དོན', 'ཤེས', 'རབ', 'སྙིང', 'རྗེ', 'མིང', 'བསྟན', 'སྒྲོལ', 'ཟེར', 'ངའི',
+]
+EN_WORDS = [
+    'the', 'of', 'and', 'to', 'in', 'is', 'that', 'all', 'by', 'with', 'as', 'for', 'this', 'are', 'be', 'not', 'from', 'it',
+    'mind', 'buddha', 'dharma', 'beings', 'teacher', 'wisdom', 'compassion', 'nature', 'emptiness', 'practice', 'body',
+    'speech', 'great', 'path', 'world', 'king', 'people', 'said', 'one', 'there', 'when', 'who', 'which', 'will', 'has',
+    'have', 'they', 'their', 'without', 'through', 'those', 'such', 'sentient', 'enlightenment', 'meditation', 'virtue',
+]
+CONSONANTS = [chr(i) for i in range(0x0F40, 0x0F6A)]
+SUBJOINED = [chr(i) for i in range(0x0F90, 0x0FB9)]
+VOWELS = ['', '', 'ི', 'ུ', 'ེ', 'ོ']
+BO_DIGITS = [chr(i) for i in range(0x0F20, 0x0F2A)]
+TSEK, SHAD = '་', '།'
+
+
+def generated_syllable(rng):
+    syllable = rng.choice(CONSONANTS)
+    if rng.random() < 0.3:
+        syllable += rng.choice(SUBJOINED)
+    syllable += rng.choice(VOWELS)
+    if rng.random() < 0.4:
+        syllable += rng.choice(CONSONANTS)
+    return syllable
+
+
+def generated_word(rng):
+    return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 10)))
+
+
+def zipf_sampler(rng, vocabulary, exponent = 1.1):
+    '''A function drawing words of `vocabulary`, the i-th with probability proportional to 1 / (i + 1) ** exponent. '''
+    weights = [1 / (rank + 1) ** exponent for rank in range(len(vocabulary))]
+    return lambda k: rng.choices(vocabulary, weights = weights, k = k)
+
+
+def generate_corpus(num_sentences, seed = 0, vocabulary_size = 5000, mean_syllables = 24):
+    '''
+    Return (clean Tibetan, clean English, raw Tibetan, raw English) lists of `num_sentences` lines each. The raw lines are
+    the clean ones with the noise that data_preprocess.clean_lines_bo() / clean_lines_en() remove.
+    '''
+    rng = random.Random(seed)
+    bo_vocabulary = BO_SYLLABLES + list(dict.fromkeys(generated_syllable(rng) for _ in range(vocabulary_size)))
+    en_vocabulary = EN_WORDS + list(dict.fromkeys(generated_word(rng) for _ in range(vocabulary_size)))
+    bo_words, en_words = zipf_sampler(rng, bo_vocabulary), zipf_sampler(rng, en_vocabulary)
+
+    bo_clean, en_clean, bo_raw, en_raw = [], [], [], []
+    for _ in range(num_sentences):
+        length = max(2, min(200, int(rng.lognormvariate(0, 0.6) * mean_syllables)))
+        bo = bo_words(length)
+        en = en_words(max(1, int(length * rng.uniform(0.5, 0.9))))    # English is shorter in words than Tibetan in syllables
+        bo_clean.append(TSEK.join(bo) + TSEK)
+        en_clean.append(' '.join(en))
+
+        if rng.random() < 0.2:
+            bo = bo + ['[' + rng.choice(EN_WORDS) + ']']
+        if rng.random() < 0.2:
+            bo.insert(rng.randrange(len(bo)), ''.join(rng.choices(BO_DIGITS, k = 2)))
+        bo_raw.append(TSEK.join(bo) + SHAD)
+        en = [word.capitalize() if rng.random() < 0.1 else word for word in en]
+        if rng.random() < 0.2:
+            en.insert(rng.randrange(len(en)), str(rng.randint(1, 999)))
+        if rng.random() < 0.1:
+            en.append('café')
+        en_raw.append(' '.join(en).capitalize() + rng.choice(['.', '.', ',', '!', '?', ';']))
+    return bo_clean, en_clean, bo_raw, en_raw
+
+
+def write_corpus(output_dir, num_sentences, seed = 0):
+    '''Write train.bo, train.en, bo.txt and en.txt to `output_dir`. Return the clean sentence pairs. '''
+    os.makedirs(output_dir, exist_ok = True)
+    bo_clean, en_clean, bo_raw, en_raw = generate_corpus(num_sentences, seed)
+    for name, lines in [('train.bo', bo_clean), ('train.en', en_clean), ('bo.txt', bo_raw), ('en.txt', en_raw)]:
+        with open(os.path.join(output_dir, name), 'w', encoding = 'utf-8') as f:
+            f.writelines(line + '\n' for line in lines)
+    return bo_clean, en_clean
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Write a synthetic Tibetan / English parallel corpus')
+    parser.add_argument('--sentences', type = int, default = 2000)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--output-dir', default = 'synthetic_data')
+    args = parser.parse_args()
+    write_corpus(args.output_dir, args.sentences, args.seed)
+    print(f'{args.sentences} sentence pairs written to {args.output_dir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# =======================================
+##### Lightweight Tibetan-English translation entry point
+# =======================================
+
+'''
+# Translate with an inference checkpoint, without the training scripts, e.g.
+#   from bo_translate import load_translator
+#   translator = load_translator('Transformer_From_Scratch/Scratch_inference.safetensors')
+#   translator.translate(['བཀྲ་ཤིས་བདེ་ལེགས།'])
+# Inference checkpoints are written by save_inference_checkpoint() in Scratch.py and T5.py (or by the `coldstart` benchmarks).
+# They bundle the config, the weights and the tokenizer paths, so the training corpus is never read.
+# `python -m bo_translate.onnx_export` turns them into ONNX graphs, and load_translator() of the export directory decodes on onnxruntime.
+#
+# Importing this package only imports the standard library. load_translator() reads the checkpoint header to find the
+# backend and then imports what that backend needs: torch, sentencepiece and safetensors, plus transformers for T5 only.
+# See `python -m bo_translate.importtime` for the import-time profile.
+'''
+
+import importlib
+import json
+import os
+import struct
+
+
+# Checkpoint format (the 'format' metadata of the safetensors file, or of model.json in an ONNX export) --> backend module
+BACKENDS = {
+    'Scratch-inference': 'bo_translate.scratch',
+    'T5-inference': 'bo_translate.t5',
+    'Scratch-onnx': 'bo_translate.onnx_runtime',
+    'T5-onnx': 'bo_translate.onnx_runtime',
+}
+
+
+def read_checkpoint_metadata(path):
+    '''
+    The metadata of a safetensors file, read with the standard library only.
+    The file starts with the header size (8 bytes, little endian) and a json header whose '__metadata__' holds it.
+    An ONNX export written by bo_translate.onnx_export is a directory, whose model.json holds it.
+    '''
+    if os.path.isdir(path):
+        with open(os.path.join(path, 'model.json')) as f:
+            return json.load(f)
+    with open(path, 'rb') as f:
+        header_size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_size))
+    return header.get('__metadata__', {})
+
+
+def load_translator(path, device = None):
+    '''
+    Load an inference checkpoint (or an ONNX export directory) and return the Translator of its backend, which has
+    translate(texts, num_beams, max_len) -> list of translations, see max_target_length() for the other options.
+    `device` is e.g. 'cpu' or 'cuda:0', by default the GPU if there is one.
+    '''
+    checkpoint_format = read_checkpoint_metadata(path).get('format')
+    if checkpoint_format not in BACKENDS:
+        raise ValueError(f'{path} is not an inference checkpoint (format {checkpoint_format!r}), see save_inference_checkpoint() in Scratch.py / T5.py')
+    backend = importlib.import_module(BACKENDS[checkpoint_format])
+    return backend.Translator(path, device)
+
+
+def max_target_length(source_length, max_len = 100, max_len_a = None, max_len_b = 10):
+    '''
+    Longest translation, in target tokens, for a source of `source_length` tokens: max_len, or with max_len_a
+    min(max_len, max_len_a * source_length + max_len_b) like fairseq's --max-len-a / --max-len-b, at least 1.
+    Together with `deadline` (a time.monotonic() value, checked between decoding steps) these are the options that bound
+    decoding. Translators' translate_detailed() flags the translations cut off by either one as truncated.
+    '''
+    if max_len_a is None:
+        return max_len
+    return max(1, min(max_len, int(max_len_a * source_length + max_len_b)))
+
+
+def translate_window(translator, texts, batch_size, options):
+    '''Translate `texts` in batches of similar source length and return the translations in the order of `texts`. '''
+    lengths = translator.source_lengths(texts)
+    order = sorted(range(len(texts)), key = lambda i: lengths[i])
+    translations = [None] * len(texts)
+    for start in range(0, len(order), batch_size):
+        batch = order[start : start + batch_size]
+        for i, translation in zip(batch, translator.translate([texts[i] for i in batch], **options)):
+            translations[i] = translation
+    return translations
@@ -0,0 +1,89 @@
+'''
+# Translate Tibetan sentences, one per line, from stdin or a file to stdout or a file, e.g.
+#   python -m bo_translate Transformer_From_Scratch/Scratch_inference.safetensors < test.bo > test.en
+#   python -m bo_translate T5_Transformers/T5_inference.safetensors --input corpus.bo --output corpus.en --buffer-size 2000 --batch-size 64
+#
+# Like `fairseq-interactive --buffer-size --batch-size`: the input is read --buffer-size lines at a time. Each window is
+# sorted by source length, so a batch pads to sentences of similar length, and translated in batches of --batch-size.
+# The window is written back in input order before the next one is read, so memory stays bounded for any input size.
+'''
+
+import argparse
+import itertools
+import sys
+import time
+
+from bo_translate import load_translator, translate_window
+from bo_translate.cache import add_cache_arguments, cached_from_arguments
+from bo_translate.pool import InferencePool
+from bo_translate.translation_memory import add_memory_arguments, memory_from_arguments
+
+
+def main():
+    parser = argparse.ArgumentParser(prog = 'python -m bo_translate', description = 'Translate Tibetan sentences, one per line')
+    parser.add_argument('checkpoint', help = 'inference checkpoint (*.safetensors) written by save_inference_checkpoint()')
+    parser.add_argument('--input', default = None, help = 'default: stdin')
+    parser.add_argument('--output', default = None, help = 'default: stdout')
+    parser.add_argument('--num-beams', type = int, default = None, help = 'default: greedy for Scratch, 4 for T5')
+    parser.add_argument('--max-len', type = int, default = 100)
+    parser.add_argument('--max-len-a', type = float, default = None, help = 'cap translations at max_len_a * source tokens + max_len_b, e.g. 1.2')
+    parser.add_argument('--max-len-b', type = int, default = 10)
+    parser.add_argument('--batch-size', type = int, default = 32, help = 'sentences translated together')
+    parser.add_argument('--buffer-size', type = int, default = 2000, help = 'lines read and length-sorted at a time')
+    parser.add_argument('--device', default = None, help = 'e.g. cpu or cuda:0, default: the GPU if there is one')
+    parser.add_argument('--workers', type = int, default = 1, help = 'CPU worker processes sharing one copy of the weights')
+    parser.add_argument('--threads-per-worker', type = int, default = 1, help = 'intra-op threads of each worker, with --workers > 1')
+    parser.add_argument('--quiet', action = 'store_true', help = 'no progress on stderr')
+    parser.add_argument('--compile', choices = ['torchscript', 'inductor'], default = None, help = 'run greedy decoding of a Scratch checkpoint compiled')
+    parser.add_argument('--compile-cache', default = None, help = 'directory that keeps the compiled buckets across starts')
+    add_cache_arguments(parser)
+    add_memory_arguments(parser)
+    args = parser.parse_args()
+    if args.compile and args.workers > 1:
+        parser.error('--compile runs in this process, it does not go with --workers')
+
+    batch_size, pool = args.batch_size, None
+    if args.workers > 1:
+        translator = pool = InferencePool(args.checkpoint, args.workers, args.threads_per_worker, args.batch_size)
+        batch_size = args.buffer_size    # the pool cuts each window into length-sorted batches for its workers
+    else:
+        translator = load_translator(args.checkpoint, args.device)
+        if args.compile:
+            from bo_translate.compiled import compiled_from_arguments    # Imported here because it needs torch, which ONNX checkpoints do without
+            translator = compiled_from_arguments(translator, args.checkpoint, args)
+    translator = cached_from_arguments(memory_from_arguments(translator, args), args.checkpoint, args)
+    options = dict(max_len = args.max_len)
+    if args.num_beams is not None:
+        options['num_beams'] = args.num_beams
+    if args.max_len_a is not None:
+        options.update(max_len_a = args.max_len_a, max_len_b = args.max_len_b)
+
+    source = open(args.input, encoding = 'utf-8') if args.input else sys.stdin
+    target = open(args.output, 'w', encoding = 'utf-8') if args.output else sys.stdout
+    start = time.perf_counter()
+    sentences = 0
+    try:
+        lines = (line.strip() for line in source)
+        while True:
+            window = list(itertools.islice(lines, args.buffer_size))
+            if not window:
+                break
+            for translation in translate_window(translator, window, batch_size, options):
+                target.write(translation + '\n')
+            target.flush()
+            sentences += len(window)
+            if not args.quiet:
+                print(f'{sentences} sentences, {sentences / (time.perf_counter() - start):.2f} sentences/s', file = sys.stderr, flush = True)
+    finally:
+        if args.input:
+            source.close()
+        if args.output:
+            target.close()
+        if pool is not None:
+            pool.close()
+    seconds = time.perf_counter() - start
+    print(f'Translated {sentences} sentences in {seconds:.1f}s, {sentences / seconds if seconds else 0:.2f} sentences/s', file = sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+'''
+# Resumable, sharded batch translation of a large monolingual corpus into synthetic parallel data, e.g. from the repository root
+#   python -m bo_translate.backtranslate Transformer_From_Scratch/Scratch_inference.safetensors \
+#       --input data/boTokenData.txt --job-dir bt_job --output data/boTokenData.synthetic.en --shards 64 --workers 4
+#
+# The input is cut into --shards byte ranges at line boundaries, so no pass is needed to count lines. Worker processes
+# (forked, sharing one copy of the weights, see pool.py) take whole shards. Each translates its shard in windows of
+# --buffer-size lines, length-sorted into batches of --batch-size. After every window the shard output is fsynced and
+# <job-dir>/shard-NNNNN.progress records how far the shard got, so a killed job started again with the same command
+# continues where every shard stopped. Once all shards are done they are concatenated in input order into --output,
+# line for line with the input. Progress goes to stderr: sentences/s over the last minute and an ETA from the bytes left.
+#
+# The models translate Tibetan to English, so the input is Tibetan text such as boTokenData.txt. The output pairs it
+# with synthetic English, i.e. forward translation data for self-training.
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import sys
+import time
+
+from bo_translate import load_translator, translate_window
+
+
+JOB_FORMAT = 'bo-backtranslate-1'
+
+
+# --------------------------
+#### Shards and progress files
+# --------------------------
+
+def shard_boundaries(path, shards):
+    '''Byte offsets cutting `path` into up to `shards` ranges, each starting at a line start. '''
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, 'rb') as f:
+        for k in range(1, shards):
+            f.seek(max(0, k * size // shards - 1))
+            f.readline()    # move to the start of the next line
+            position = min(f.tell(), size)
+            if position > boundaries[-1]:
+                boundaries.append(position)
+    if boundaries[-1] < size or size == 0:
+        boundaries.append(size)
+    return boundaries
+
+
+def shard_path(job_dir, shard, suffix):
+    return os.path.join(job_dir, f'shard-{shard:05d}.{suffix}')
+
+
+def read_progress(job_dir, shard):
+    try:
+        with open(shard_path(job_dir, shard, 'progress')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return dict(lines = 0, input_bytes = 0, output_bytes = 0, done = False)
+
+
+def write_progress(job_dir, shard, progress):
+    '''Atomically replace the progress file, so a kill leaves either the old or the new state. '''
+    path = shard_path(job_dir, shard, 'progress')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(progress, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def prepare_job(args):
+    '''Create <job-dir>/job.json, or check that an existing one describes the same job. Return it. '''
+    job = dict(
+        format = JOB_FORMAT,
+        input = os.path.abspath(args.input), input_size = os.path.getsize(args.input), input_mtime_ns = os.stat(args.input).st_mtime_ns,
+        checkpoint = os.path.abspath(args.checkpoint), options = args.options,
+        buffer_size = args.buffer_size, batch_size = args.batch_size,
+    )
+    path = os.path.join(args.job_dir, 'job.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            existing = json.load(f)
+        changed = [key for key in job if existing.get(key) != job[key]]
+        if changed:
+            raise SystemExit(f'{path} was started with different {", ".join(changed)}. Use a new --job-dir.')
+        return existing
+    os.makedirs(args.job_dir, exist_ok = True)
+    job['boundaries'] = shard_boundaries(args.input, args.shards)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(job, f, indent = 2)
+    os.replace(path + '.tmp', path)
+    return job
+
+
+# --------------------------
+#### Translating a shard
+# --------------------------
+
+def translate_shard(translator, job, job_dir, shard, report):
+    '''Translate one shard from its last checkpoint on. `report(lines, input_bytes)` is called after every window. '''
+    progress = read_progress(job_dir, shard)
+    if progress['done']:
+        return
+    start, end = job['boundaries'][shard], job['boundaries'][shard + 1]
+    output_path = shard_path(job_dir, shard, 'out')
+    with open(job['input'], 'rb') as source, open(output_path, 'r+b' if os.path.exists(output_path) else 'wb') as target:
+        target.truncate(progress['output_bytes'])    # drop output written after the last checkpoint
+        target.seek(progress['output_bytes'])
+        source.seek(start + progress['input_bytes'])
+        position = start + progress['input_bytes']
+        while position < end:
+            window = []
+            window_start = position
+            while len(window) < job['buffer_size'] and position < end:
+                line = source.readline()
+                position += len(line)
+                window.append(line.decode('utf-8').strip())
+            translations = translate_window(translator, window, job['batch_size'], job['options'])
+            target.write(''.join(' '.join(translation.split()) + '\n' for translation in translations).encode('utf-8'))
+            target.flush()
+            os.fsync(target.fileno())
+            progress.update(lines = progress['lines'] + len(window), input_bytes = position - start, output_bytes = target.tell())
+            write_progress(job_dir, shard, progress)
+            report(len(window), position - window_start)
+    progress['done'] = True
+    write_progress(job_dir, shard, progress)
+
+
+def shard_worker(translator, job, job_dir, cpus, threads, shards, events):
+    from bo_translate.pool import pin_current_process
+    pin_current_process(cpus, threads)
+    while True:
+        shard = shards.get()
+        if shard is None:
+            return
+        try:
+            translate_shard(translator, job, job_dir, shard, lambda lines, size: events.put(('progress', shard, lines, size)))
+            events.put(('done', shard, None, None))
+        except Exception as error:
+            events.put(('failed', shard, f'{type(error).__name__}: {error}', None))
+
+
+# --------------------------
+#### Throughput and ETA
+# --------------------------
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return f'{seconds // 3600:d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+class Progress:
+    '''
+    Sentences/s and ETA of the job. Unlike Timer in Scratch.py / T5.py, the rate is measured over the last `window`
+    seconds rather than since the start, so it follows slowdowns and ignores work done before a resume, and the ETA comes
+    from the input bytes left, which are known for every shard without counting lines.
+    '''
+    def __init__(self, total_bytes, done_bytes, done_lines, window = 60):
+        self.total_bytes = total_bytes
+        self.done_bytes = done_bytes
+        self.done_lines = done_lines
+        self.window = window
+        self.start = time.perf_counter()
+        self.samples = [(self.start, 0, 0)]    # (time, lines, bytes) done since start
+
+
+    def update(self, lines, size):
+        self.done_lines += lines
+        self.done_bytes += size
+        now = time.perf_counter()
+        _, total_lines, total_size = self.samples[-1]
+        self.samples.append((now, total_lines + lines, total_size + size))
+        while len(self.samples) > 2 and self.samples[1][0] < now - self.window:
+            self.samples.pop(0)
+
+
+    def report(self):
+        (t0, lines0, bytes0), (t1, lines1, bytes1) = self.samples[0], self.samples[-1]
+        rate = (lines1 - lines0) / (t1 - t0) if t1 > t0 else 0
+        byte_rate = (bytes1 - bytes0) / (t1 - t0) if t1 > t0 else 0
+        left = self.total_bytes - self.done_bytes
+        eta = format_seconds(left / byte_rate) if byte_rate else '?'
+        percent = 100 * self.done_bytes / self.total_bytes if self.total_bytes else 100
+        return (f'{percent:5.1f}% {self.done_lines} sentences, {rate:.1f} sentences/s, '
+                f'elapsed {format_seconds(time.perf_counter() - self.start)}, ETA {eta}')
+
+
+# --------------------------
+#### Job
+# --------------------------
+
+def merge_shards(job, job_dir, output):
+    '''Concatenate the shard outputs in input order into `output`. '''
+    with open(output + '.tmp', 'wb') as merged:
+        for shard in range(len(job['boundaries']) - 1):
+            with open(shard_path(job_dir, shard, 'out'), 'rb') as f:
+                shutil.copyfileobj(f, merged)
+    os.replace(output + '.tmp', output)
+
+
+def run_job(args):
+    job = prepare_job(args)
+    shards = len(job['boundaries']) - 1
+    states = [read_progress(args.job_dir, shard) for shard in range(shards)]
+    pending = [shard for shard in range(shards) if not states[shard]['done']]
+    progress = Progress(job['input_size'], sum(state['input_bytes'] for state in states), sum(state['lines'] for state in states))
+    print(f'{shards} shards, {shards - len(pending)} done, {progress.report()}', file = sys.stderr, flush = True)
+
+    if pending:
+        from bo_translate.pool import default_cpu_sets, share_weights    # Imported here because a finished job needs no torch
+        translator = load_translator(args.checkpoint, 'cpu' if args.workers > 1 else args.device)
+        last_report = time.perf_counter()
+        if args.workers <= 1:
+            def report(lines, size):
+                nonlocal last_report
+                progress.update(lines, size)
+                if time.perf_counter() - last_report >= args.log_seconds:
+                    print(progress.report(), file = sys.stderr, flush = True)
+                    last_report = time.perf_counter()
+            for shard in pending:
+                translate_shard(translator, job, args.job_dir, shard, report)
+        else:
+            share_weights(translator.model)
+            context = multiprocessing.get_context('fork')
+            shard_queue, events = context.Queue(), context.Queue()
+            for shard in pending:
+                shard_queue.put(shard)
+            workers = [
+                context.Process(target = shard_worker, args = (translator, job, args.job_dir, cpus, args.threads_per_worker, shard_queue, events), daemon = True)
+                for cpus in default_cpu_sets(min(args.workers, len(pending)), args.threads_per_worker)
+            ]
+            for worker in workers:
+                shard_queue.put(None)
+                worker.start()
+            finished, failed = 0, []
+            while finished + len(failed) < len(pending):
+                try:
+                    kind, shard, a, b = events.get(timeout = 5)
+                except queue.Empty:
+                    if not any(worker.is_alive() for worker in workers):
+                        break
+                    continue
+                if kind == 'progress':
+                    progress.update(a, b)
+                elif kind == 'done':
+                    finished += 1
+                else:
+                    failed.append(f'shard {shard}: {a}')
+                if time.perf_counter() - last_report >= args.log_seconds:
+                    print(progress.report(), file = sys.stderr, flush = True)
+                    last_report = time.perf_counter()
+            for worker in workers:
+                worker.join()
+            if failed or finished < len(pending):
+                raise SystemExit(f'{len(pending) - finished} shards unfinished ({"; ".join(failed) or "a worker died"}). Run the same command again to resume.')
+
+    merge_shards(job, args.job_dir, args.output)
+    print(progress.report(), file = sys.stderr)
+    print(f'Wrote {args.output}', file = sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog = 'python -m bo_translate.backtranslate', description = 'resumable sharded translation of a monolingual corpus')
+    parser.add_argument('checkpoint', help = 'inference checkpoint (*.safetensors)')
+    parser.add_argument('--input', required = True, help = 'Tibetan text, one sentence per line, e.g. data/boTokenData.txt')
+    parser.add_argument('--output', required = True, help = 'translations, line for line with --input')
+    parser.add_argument('--job-dir', required = True, help = 'shard outputs and progress, reused to resume')
+    parser.add_argument('--shards', type = int, default = 64)
+    parser.add_argument('--workers', type = int, default = 1, help = 'forked processes sharing the weights, each translating whole shards')
+    parser.add_argument('--threads-per-worker', type = int, default = 1)
+    parser.add_argument('--batch-size', type = int, default = 32)
+    parser.add_argument('--buffer-size', type = int, default = 2000, help = 'lines length-sorted together, and checkpoint interval')
+    parser.add_argument('--num-beams', type = int, default = None, help = 'default: greedy for Scratch, 4 for T5')
+    parser.add_argument('--max-len', type = int, default = 100)
+    parser.add_argument('--max-len-a', type = float, default = None, help = 'cap translations at max_len_a * source tokens + max_len_b, e.g. 1.2')
+    parser.add_argument('--max-len-b', type = int, default = 10)
+    parser.add_argument('--device', default = None, help = 'with --workers 1, e.g. cuda:0')
+    parser.add_argument('--log-seconds', type = float, default = 30)
+    args = parser.parse_args()
+    args.options = dict(max_len = args.max_len)
+    if args.num_beams is not None:
+        args.options['num_beams'] = args.num_beams
+    if args.max_len_a is not None:
+        args.options.update(max_len_a = args.max_len_a, max_len_b = args.max_len_b)
+    run_job(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+'''
+# Translation result cache in front of a Translator, e.g.
+#   translator = CachedTranslator(load_translator(path), path, cache_dir = 'translation_cache')
+#   translator.translate(texts)    # same API, repeated sentences are not decoded again
+#
+# Two tiers: an in-memory LRU (max_entries) and an on-disk sqlite store (max_disk_mb), which survives restarts and
+# can be shared by several processes. Keys combine the normalized source sentence, the sha256 of the checkpoint file
+# and the decoding options, so retraining or changing num_beams / max_len never returns a stale translation.
+# Identical sentences within one call are translated once.
+'''
+
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+from bo_translate.streaming import record_chunks, stream_translation
+
+
+def normalize_source(text):
+    '''NFC, with runs of whitespace collapsed to one space and the ends stripped. The translator sees this text too. '''
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+
+_checkpoint_hashes = {}
+
+def checkpoint_hash(path, chunk_size = 1 << 24):
+    '''sha256 of the checkpoint file (or of the files of an ONNX export directory), remembered per (path, size, mtime) for this process. '''
+    paths = [os.path.join(path, name) for name in sorted(os.listdir(path))] if os.path.isdir(path) else [path]
+    memo_key = tuple((os.path.abspath(p), os.stat(p).st_size, os.stat(p).st_mtime_ns) for p in paths)
+    if memo_key not in _checkpoint_hashes:
+        digest = hashlib.sha256()
+        for p in paths:
+            with open(p, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    digest.update(chunk)
+        _checkpoint_hashes[memo_key] = digest.hexdigest()
+    return _checkpoint_hashes[memo_key]
+
+
+class DiskCache:
+    '''
+    Size-bounded sqlite key --> translation store. Once the stored text exceeds max_bytes,
+    the least recently used entries are deleted down to 90% of it.
+    '''
+    def __init__(self, path, max_bytes):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+        self.max_bytes = max_bytes
+        self.db = sqlite3.connect(path, check_same_thread = False, timeout = 30)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, translation TEXT, bytes INTEGER, last_used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS by_last_used ON translations (last_used)')
+        self.db.commit()
+
+
+    def get_many(self, keys):
+        found = {}
+        for start in range(0, len(keys), 500):    # stay below sqlite's bound parameter limit
+            chunk = keys[start : start + 500]
+            marks = ', '.join('?' * len(chunk))
+            found.update(self.db.execute(f'SELECT key, translation FROM translations WHERE key IN ({marks})', chunk))
+        if found:
+            now = time.time()
+            self.db.executemany('UPDATE translations SET last_used = ? WHERE key = ?', [(now, key) for key in found])
+            self.db.commit()
+        return found
+
+
+    def put_many(self, items):
+        '''Store (key, translation) pairs and evict. Return the number of evicted entries. '''
+        now = time.time()
+        self.db.executemany(
+            'INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?)',
+            [(key, translation, len(key.encode('utf-8')) + len(translation.encode('utf-8')), now) for key, translation in items],
+        )
+        evicted = 0
+        total, = self.db.execute('SELECT COALESCE(SUM(bytes), 0) FROM translations').fetchone()
+        if total > self.max_bytes:
+            excess = total - int(0.9 * self.max_bytes)
+            doomed = []
+            for key, size in self.db.execute('SELECT key, bytes FROM translations ORDER BY last_used'):
+                if excess <= 0:
+                    break
+                doomed.append((key,))
+                excess -= size
+            self.db.executemany('DELETE FROM translations WHERE key = ?', doomed)
+            evicted = len(doomed)
+        self.db.commit()
+        return evicted
+
+
+    def stats(self):
+        entries, total = self.db.execute('SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM translations').fetchone()
+        return dict(disk_entries = entries, disk_megabytes = round(total / 2**20, 3))
+
+
+class CachedTranslator:
+    '''
+    Wrap a Translator with an in-memory LRU and an optional on-disk store. translate() has the same signature
+    as the wrapped translator's and returns the same translations for the normalized sentences.
+    '''
+    def __init__(self, translator, checkpoint, max_entries = 10000, cache_dir = None, max_disk_mb = 256):
+        self.translator = translator
+        self.model_hash = checkpoint_hash(checkpoint)
+        self.max_entries = max_entries
+        self.memory = collections.OrderedDict()
+        self.disk = DiskCache(os.path.join(cache_dir, 'translations.sqlite'), max_disk_mb * 2**20) if cache_dir else None
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+
+
+    def key(self, text, options):
+        options = {name: value for name, value in options.items() if name != 'deadline'}    # a time budget, not a setting
+        return json.dumps([self.model_hash, options, text], ensure_ascii = False, sort_keys = True)
+
+
+    def source_lengths(self, texts):
+        return self.translator.source_lengths(texts)
+
+
+    def translate(self, texts, **options):
+        return self.translate_detailed(texts, **options)[0]
+
+
+    def translate_detailed(self, texts, **options):
+        '''Like the wrapped translator's. Cached translations are never truncated: truncated ones are not stored. '''
+        sources = [normalize_source(text) for text in texts]
+        keys = [self.key(source, options) for source in sources]
+        with self.lock:
+            found = {}
+            for key in dict.fromkeys(keys):
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    found[key] = self.memory[key]
+            self.stats['memory_hits'] += sum(key in found for key in keys)
+            if self.disk is not None:
+                from_disk = self.disk.get_many([key for key in dict.fromkeys(keys) if key not in found])
+                self.stats['disk_hits'] += sum(key in from_disk for key in keys)
+                self.remember(from_disk.items())
+                found.update(from_disk)
+
+            missing = {}    # key --> source, each distinct sentence once
+            for key, source in zip(keys, sources):
+                if key not in found:
+                    missing.setdefault(key, source)
+            self.stats['sentences'] += len(keys)
+            self.stats['misses'] += sum(key not in found for key in keys)
+            self.stats['translated'] += len(missing)
+        cut = set()
+        if missing:
+            translations, truncated = self.translator.translate_detailed(list(missing.values()), **options)
+            translated = dict(zip(missing, translations))
+            cut = {key for key, was_cut in zip(missing, truncated) if was_cut}
+            complete = [(key, translation) for key, translation in translated.items() if key not in cut]
+            with self.lock:
+                self.remember(complete)
+                if self.disk is not None:
+                    self.stats['disk_evictions'] += self.disk.put_many(complete)
+            found.update(translated)
+        return [found[key] for key in keys], [key in cut for key in keys]
+
+
+    def translate_stream(self, text, **options):
+        '''Yield a cached translation at once, or stream the wrapped translator's and cache it unless truncated. '''
+        source = normalize_source(text)
+        key = self.key(source, options)
+        with self.lock:
+            self.stats['sentences'] += 1
+            translation = self.memory.get(key)
+            if translation is not None:
+                self.memory.move_to_end(key)
+                self.stats['memory_hits'] += 1
+            elif self.disk is not None:
+                translation = self.disk.get_many([key]).get(key)
+                if translation is not None:
+                    self.stats['disk_hits'] += 1
+                    self.remember([(key, translation)])
+            if translation is None:
+                self.stats['misses'] += 1
+                self.stats['translated'] += 1
+        if translation is not None:
+            if translation:
+                yield translation
+            return False
+
+        chunks = []
+        truncated = yield from record_chunks(stream_translation(self.translator, source, options), chunks)
+        if truncated:
+            return True
+        with self.lock:
+            self.remember([(key, ''.join(chunks))])
+            if self.disk is not None:
+                self.stats['disk_evictions'] += self.disk.put_many([(key, ''.join(chunks))])
+        return False
+
+
+    def remember(self, items):
+        '''Put translations in the in-memory LRU, with self.lock held. max_entries = 0 means there is no in-memory tier. '''
+        if not self.max_entries:
+            return
+        for key, translation in items:
+            self.memory[key] = translation
+            self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last = False)
+            self.stats['memory_evictions'] += 1
+
+
+    def metrics(self):
+        '''Hit rates are per sentence; `translated` counts sentences actually decoded after in-batch deduplication. '''
+        with self.lock:    # a consistent snapshot, the worker threads update the counts under the same lock
+            stats = collections.Counter(self.stats)
+            memory_entries = len(self.memory)
+        sentences = stats['sentences']
+        metrics = dict(
+            sentences = sentences,
+            memory_hits = stats['memory_hits'],
+            disk_hits = stats['disk_hits'],
+            misses = stats['misses'],
+            translated = stats['translated'],
+            hit_rate = round((stats['memory_hits'] + stats['disk_hits']) / sentences, 4) if sentences else None,
+            memory_hit_rate = round(stats['memory_hits'] / sentences, 4) if sentences else None,
+            memory_entries = memory_entries,
+            memory_evictions = stats['memory_evictions'],
+            disk_evictions = stats['disk_evictions'],
+            model_hash = self.model_hash[:12],
+        )
+        if self.disk is not None:
+            with self.lock:
+                metrics.update(self.disk.stats())
+        if hasattr(self.translator, 'metrics'):
+            metrics.update(self.translator.metrics())
+        return metrics
+
+
+def add_cache_arguments(parser):
+    parser.add_argument('--cache-entries', type = int, default = 0, help = 'in-memory LRU size, 0 = no in-memory tier (and no cache at all without --cache-dir)')
+    parser.add_argument('--cache-dir', default = None, help = 'directory of the on-disk translation cache')
+    parser.add_argument('--cache-disk-mb', type = float, default = 256, help = 'size bound of the on-disk cache')
+
+
+def cached_from_arguments(translator, checkpoint, args):
+    '''Wrap `translator` in a CachedTranslator if the command line asked for a cache. '''
+    if not args.cache_entries and not args.cache_dir:
+        return translator
+    return CachedTranslator(translator, checkpoint, max_entries = args.cache_entries, cache_dir = args.cache_dir, max_disk_mb = args.cache_disk_mb)
@@ -0,0 +1,373 @@
+# =======================================
+##### Compiled greedy decoding for the transformer from scratch
+# =======================================
+
+'''
+# At batch sizes 1-8 most of a greedy step of MyTransformer is Python and dispatch overhead, not arithmetic. This runs the
+# encoder and a single-token decoder step compiled, either traced with TorchScript or with torch.compile (inductor), e.g.
+#   python -m bo_translate Transformer_From_Scratch/Scratch_inference.safetensors --compile torchscript --compile-cache compiled
+#   python -m bo_translate.compiled Transformer_From_Scratch/Scratch_inference.safetensors --backend inductor --cache-dir compiled
+# The second one profiles a backend: startup, first pass (compiles) and steady-state latency per batch size.
+#
+# Compiled code is specialized to tensor shapes, so shapes are bucketed: the batch is padded to BATCH_BUCKETS rows, the
+# source to SOURCE_BUCKETS tokens, and the decoder keeps its past keys and values in buffers of TARGET_BUCKETS positions,
+# written in place one position per step, with the positions after the current step masked. A translation therefore
+# compiles at most one encoder and one decoder step per bucket, never one per length.
+# With a cache directory, TorchScript buckets are saved with torch.jit.save and loaded on later starts, and inductor
+# keeps its compiled kernels there (TORCHINDUCTOR_CACHE_DIR), so only the first start pays for compiling.
+'''
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from bo_translate import max_target_length
+from bo_translate.onnx_export import ScratchEncoderGraph, attend, in_projections, padding_bias, split_heads
+from bo_translate.reporting import percentile, print_table
+from bo_translate.streaming import detokenize_stream
+
+
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+SOURCE_BUCKETS = (16, 32, 64, 128, 256)
+TARGET_BUCKETS = (32, 64, 128, 256)
+BACKENDS = ('torchscript', 'inductor')
+
+
+def bucket(size, buckets):
+    '''The smallest bucket of at least `size`, or `size` rounded up to a multiple of the largest one. '''
+    for limit in buckets:
+        if size <= limit:
+            return limit
+    return -(-size // buckets[-1]) * buckets[-1]
+
+
+
+# --------------------------
+#### Compiled modules
+# --------------------------
+
+class StaticCacheDecoderStep(nn.Module):
+    '''
+    One greedy step of MyTransformer.decode() for the token at position `step`, like ScratchDecoderStep in onnx_export.py,
+    but the self-attention keys and values live in fixed-size buffers (batch_size * num_heads * max_steps * head_dim) that
+    the step writes into in place, so every step of a bucket has the same shapes. Positions after `step` are masked.
+    '''
+    def __init__(self, model):
+        super(StaticCacheDecoderStep, self).__init__()
+        self.model = model
+
+    def forward(self, input_ids, step, attention_mask, *cache):
+        model = self.model
+        num_layers = len(model.decoder.layers)
+        past, cross = cache[:2 * num_layers], cache[2 * num_layers:]
+        x = model.target_embedding(input_ids) * model.d_model ** 0.5 + model.pos_encoder.pe[0].index_select(0, step)    # batch_size * 1 * d_model
+        cross_bias = padding_bias(attention_mask, x.dtype)
+        positions = torch.arange(past[0].size(2), device = x.device)
+        self_bias = ((positions > step).to(x.dtype) * torch.finfo(x.dtype).min)[None, None, None, :]
+        for i, layer in enumerate(model.decoder.layers):
+            attention = layer.self_attn
+            q, k, v = (split_heads(F.linear(x, w, b), attention.num_heads, attention.head_dim) for w, b in in_projections(attention))
+            past[2 * i].index_copy_(2, step, k)
+            past[2 * i + 1].index_copy_(2, step, v)
+            x = layer.norm1(x + attention.out_proj(attend(q, past[2 * i], past[2 * i + 1], self_bias, attention.head_dim ** -0.5)))
+
+            attention = layer.multihead_attn
+            w_q, b_q = in_projections(attention)[0]
+            q = split_heads(F.linear(x, w_q, b_q), attention.num_heads, attention.head_dim)
+            x = layer.norm2(x + attention.out_proj(attend(q, cross[2 * i], cross[2 * i + 1], cross_bias, attention.head_dim ** -0.5)))
+            x = layer.norm3(x + layer.linear2(layer.activation(layer.linear1(x))))
+        return model.out(model.decoder.norm(x)[:, 0])
+
+
+class CompiledScratch:
+    '''
+    The encoder and the decoder step of a MyTransformer (eval mode), compiled per bucket on first use with `backend`
+    ('torchscript' or 'inductor'). With `cache_dir`, compiled buckets are kept on disk under `model_key` (e.g. the
+    checkpoint's sha256), which must change with the weights. `stats` counts the buckets compiled and loaded from disk, and the
+    seconds their first calls took.
+    '''
+    def __init__(self, model, backend = 'torchscript', cache_dir = None, model_key = None):
+        if backend not in BACKENDS:
+            raise ValueError(f'backend must be one of {BACKENDS}, not {backend!r}')
+        if cache_dir is not None and model_key is None:
+            raise ValueError('a cache_dir needs the model_key of the weights')
+        self.model = model.eval()
+        self.device = next(model.parameters()).device
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.model_key = model_key
+        self.max_positions = model.pos_encoder.pe.size(1)
+        self.layers = [(layer.self_attn.num_heads, layer.self_attn.head_dim) for layer in model.decoder.layers]
+        self.functions = {}    # (kind, shape) --> compiled function
+        self.stats = dict(compiled = 0, loaded = 0, compile_seconds = 0.0)
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok = True)
+        if backend == 'inductor':
+            if cache_dir is not None:
+                os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(os.path.join(cache_dir, 'inductor'))
+            # Every bucket is one more specialization of the same forward(); the default limit of 8 would fall back to eager
+            import torch._dynamo
+            limit_name = 'recompile_limit' if hasattr(torch._dynamo.config, 'recompile_limit') else 'cache_size_limit'
+            setattr(torch._dynamo.config, limit_name, max(getattr(torch._dynamo.config, limit_name), 256))
+            self.compiled_modules = dict(
+                encoder = torch.compile(ScratchEncoderGraph(model), dynamic = False),
+                decoder = torch.compile(StaticCacheDecoderStep(model), dynamic = False),
+            )
+
+
+    def run(self, kind, inputs):
+        '''Run the compiled `kind` ('encoder' or 'decoder') on `inputs`, tracing, loading or compiling it for their shapes first if needed. '''
+        shape = tuple(tuple(x.shape) for x in inputs[:4])    # the decoder's first past buffer holds the target bucket
+        if (kind, shape) in self.functions:
+            return self.functions[kind, shape](*inputs)
+        start = time.perf_counter()
+        if self.backend == 'inductor':
+            # torch.compile compiles during the first call; inductor's own cache tells whether the kernels were on disk
+            from torch._dynamo.utils import counters
+            hits = counters['inductor']['fxgraph_cache_hit']
+            function = self.compiled_modules[kind]
+            outputs = function(*inputs)
+            self.stats['loaded' if counters['inductor']['fxgraph_cache_hit'] > hits else 'compiled'] += 1
+        else:
+            name = f"{self.model_key}-{kind}-{'-'.join('x'.join(map(str, s)) for s in shape)}.pt"
+            path = None if self.cache_dir is None else os.path.join(self.cache_dir, name)
+            if path is not None and os.path.exists(path):
+                function = torch.jit.load(path, map_location = self.device)
+                self.stats['loaded'] += 1
+            else:
+                module = ScratchEncoderGraph(self.model) if kind == 'encoder' else StaticCacheDecoderStep(self.model)
+                with torch.no_grad():
+                    function = torch.jit.freeze(torch.jit.trace(module, tuple(x.clone() for x in inputs), check_trace = False).eval())
+                if path is not None:
+                    torch.jit.save(function, path + '.tmp')
+                    os.replace(path + '.tmp', path)    # never leave a half-written artifact behind
+                self.stats['compiled'] += 1
+            outputs = function(*inputs)
+        self.stats['compile_seconds'] += time.perf_counter() - start
+        self.functions[kind, shape] = function
+        return outputs
+
+
+    def encode(self, src, attention_mask):
+        '''Cross-attention keys and values of every decoder layer, for source ids already padded to a bucket. '''
+        return self.run('encoder', (src, attention_mask))
+
+
+    def empty_past(self, batch_size, max_steps):
+        return [torch.zeros(batch_size, heads, max_steps, head_dim, device = self.device) for heads, head_dim in self.layers for _ in range(2)]
+
+
+    def step(self, input_ids, step, attention_mask, past, cross):
+        '''Logits after `input_ids` (batch_size * 1) at position `step`, whose keys and values are written into `past`. '''
+        step = torch.tensor([step], device = self.device)
+        # A fresh copy, because compiled code is also specialized to strides (a column of the growing target has new ones
+        # every step) and to whether a tensor was made in inference mode
+        return self.run('decoder', (input_ids.clone(), step, attention_mask, *past, *cross))
+
+
+
+# --------------------------
+#### Decoding
+# --------------------------
+
+def greedy_decode_batch(compiled, src_batch, src_pad_id, tgt_bos_id, tgt_eos_id, max_len = 100, max_lens = None, deadline = None):
+    '''
+    greedy_decode_batch() of scratch.py on a CompiledScratch, with the same results. The batch, the source and the number
+    of steps are padded to buckets; padding rows have an empty source and are dropped at the end.
+    '''
+    device = compiled.device
+    limits = torch.tensor(max_lens or [max_len] * len(src_batch), device = device)
+    rows = bucket(len(src_batch), BATCH_BUCKETS)
+    longest = max(len(ids) for ids in src_batch)
+    width = min(bucket(longest, SOURCE_BUCKETS), max(longest, compiled.max_positions))    # no padding past the positional encoding
+    src = torch.full((rows, width), src_pad_id, dtype = torch.long)
+    for row, ids in enumerate(src_batch):
+        src[row, :len(ids)] = torch.LongTensor(ids)
+    src = src.to(device)
+    attention_mask = (src != src_pad_id).long()
+    tgt = torch.full((rows, 1), tgt_bos_id, dtype = torch.long, device = device)
+    finished = torch.zeros(len(src_batch), dtype = torch.bool, device = device)    # generated </s>
+    stopped = torch.zeros(len(src_batch), dtype = torch.bool, device = device)    # finished or at its length limit
+
+    with torch.inference_mode():
+        cross = compiled.encode(src, attention_mask)
+        past = compiled.empty_past(rows, bucket(int(limits.max()), TARGET_BUCKETS))
+        for i in range(int(limits.max())):
+            logits = compiled.step(tgt[:, -1:], i, attention_mask, past, cross)
+            next_ids = logits.argmax(dim = -1)
+            next_ids[:len(src_batch)] = next_ids[:len(src_batch)].masked_fill(stopped, tgt_eos_id)
+            tgt = torch.cat((tgt, next_ids.unsqueeze(1)), dim = 1)
+            finished |= (next_ids[:len(src_batch)] == tgt_eos_id) & ~stopped
+            stopped |= finished | (limits <= i + 1)
+            if stopped.all() or (deadline is not None and time.monotonic() >= deadline):
+                break
+
+    generated = []
+    for ids in tgt[:len(src_batch), 1:].tolist():
+        generated.append(ids[:ids.index(tgt_eos_id)] if tgt_eos_id in ids else ids)
+    return generated, [not done for done in finished.tolist()]
+
+
+def greedy_decode_stream(compiled, src_ids, tgt_bos_id, tgt_eos_id, max_len = 100, deadline = None):
+    '''greedy_decode_stream() of scratch.py on a CompiledScratch: yields each token id and returns whether the translation was truncated. '''
+    device = compiled.device
+    src = torch.zeros(1, min(bucket(len(src_ids), SOURCE_BUCKETS), max(len(src_ids), compiled.max_positions)), dtype = torch.long)
+    src[0, :len(src_ids)] = torch.LongTensor(src_ids)
+    attention_mask = torch.zeros_like(src)
+    attention_mask[0, :len(src_ids)] = 1
+    src, attention_mask = src.to(device), attention_mask.to(device)
+    with torch.inference_mode():
+        cross = compiled.encode(src, attention_mask)
+        past = compiled.empty_past(1, bucket(max_len, TARGET_BUCKETS))
+    generated_id = tgt_bos_id
+    for i in range(max_len):
+        with torch.inference_mode():
+            logits = compiled.step(torch.tensor([[generated_id]], device = device), i, attention_mask, past, cross)
+            generated_id = logits[0].argmax().item()
+        if generated_id == tgt_eos_id:
+            return False
+        yield generated_id
+        if deadline is not None and time.monotonic() >= deadline:
+            return True
+    return True
+
+
+
+# --------------------------
+#### Translator
+# --------------------------
+
+class CompiledTranslator:
+    '''
+    Wrap a Scratch Translator (bo_translate.scratch) so that greedy decoding runs compiled, see CompiledScratch. Beam
+    search goes to the wrapped translator. translate() has the same signature and returns the same translations.
+    '''
+    def __init__(self, translator, backend = 'torchscript', cache_dir = None, model_key = None):
+        from bo_translate.scratch import Translator    # Imported here so that importing this module does not need sentencepiece
+        if not isinstance(translator, Translator):
+            raise ValueError('only the transformer from scratch is compiled, T5 has its own kv cache in generate()')
+        self.translator = translator
+        self.compiled = CompiledScratch(translator.model, backend, cache_dir, model_key)
+
+
+    def source_lengths(self, texts):
+        return self.translator.source_lengths(texts)
+
+
+    def translate(self, texts, *args, **options):
+        return self.translate_detailed(texts, *args, **options)[0]
+
+
+    def translate_detailed(self, texts, num_beams = 1, max_len = 100, length_penalty = 0.6, max_len_a = None, max_len_b = 10, deadline = None):
+        '''Like Translator.translate_detailed() of scratch.py, greedy decoding compiled. '''
+        if num_beams > 1:
+            return self.translator.translate_detailed(texts, num_beams, max_len, length_penalty, max_len_a, max_len_b, deadline)
+        t = self.translator
+        src_batch = [t.srcTokenizer.encode(text) for text in texts]
+        translations = [''] * len(texts)
+        truncated = [False] * len(texts)
+        todo = [i for i, ids in enumerate(src_batch) if ids]
+        if not todo:
+            return translations, truncated
+        max_lens = [max_target_length(len(src_batch[i]), max_len, max_len_a, max_len_b) for i in todo]
+        generated, cut = greedy_decode_batch(self.compiled, [src_batch[i] for i in todo], t.src_pad_id, t.tgt_bos_id, t.tgt_eos_id, max_len, max_lens, deadline)
+        for i, ids, was_cut in zip(todo, generated, cut):
+            translations[i] = t.tgtTokenizer.decode(ids)
+            truncated[i] = was_cut
+        return translations, truncated
+
+
+    def translate_stream(self, text, num_beams = 1, max_len = 100, length_penalty = 0.6, max_len_a = None, max_len_b = 10, deadline = None):
+        '''Like Translator.translate_stream() of scratch.py, greedy decoding compiled. '''
+        t = self.translator
+        src_ids = t.srcTokenizer.encode(text)
+        if num_beams > 1 or not src_ids:
+            return (yield from t.translate_stream(text, num_beams, max_len, length_penalty, max_len_a, max_len_b, deadline))
+        limit = max_target_length(len(src_ids), max_len, max_len_a, max_len_b)
+        return (yield from detokenize_stream(t.tgtTokenizer, greedy_decode_stream(self.compiled, src_ids, t.tgt_bos_id, t.tgt_eos_id, limit, deadline)))
+
+
+def cache_key(checkpoint):
+    '''Names the compiled buckets of `checkpoint` in a cache directory: traced modules embed the weights and the torch version. '''
+    from bo_translate.cache import checkpoint_hash    # Imported here because only a compile cache needs it
+    return checkpoint_hash(checkpoint)[:16] + '-' + torch.__version__.replace('+', '_')
+
+
+def compiled_from_arguments(translator, checkpoint, args):
+    '''Wrap `translator` in a CompiledTranslator for the --compile and --compile-cache options of the CLI and the server. '''
+    return CompiledTranslator(translator, args.compile, args.compile_cache, cache_key(checkpoint) if args.compile_cache else None)
+
+
+
+# --------------------------
+#### Profiling
+# --------------------------
+
+def main():
+    parser = argparse.ArgumentParser(prog = 'python -m bo_translate.compiled', description = 'startup and latency of compiled greedy decoding, in this process')
+    parser.add_argument('checkpoint', help = 'Scratch inference checkpoint')
+    parser.add_argument('--backend', choices = ('eager',) + BACKENDS, default = 'torchscript')
+    parser.add_argument('--cache-dir', default = None, help = 'compile cache; run twice with the same directory for the warm start')
+    parser.add_argument('--input', default = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'train.bo'))
+    parser.add_argument('--sentences', type = int, default = 64)
+    parser.add_argument('--batch-sizes', type = int, nargs = '+', default = [1, 8])
+    parser.add_argument('--max-len', type = int, default = 100)
+    parser.add_argument('--threads', type = int, default = None, help = 'torch intra-op threads')
+    parser.add_argument('--output', default = None, help = 'write the translations of the first batch size here, one per line')
+    parser.add_argument('--json', default = None, help = 'also write the results to this file')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    from bo_translate import load_translator, translate_window
+    with open(args.input, encoding = 'utf-8') as f:
+        texts = list(itertools.islice((line.strip() for line in f if line.strip()), args.sentences))
+    start = time.perf_counter()
+    translator = load_translator(args.checkpoint, 'cpu')
+    if args.backend != 'eager':
+        translator = CompiledTranslator(translator, args.backend, args.cache_dir, cache_key(args.checkpoint) if args.cache_dir else None)
+    load_seconds = time.perf_counter() - start
+
+    results = []
+    for batch_size in args.batch_sizes:
+        # First pass: every bucket is compiled (cold start) or loaded from the cache (warm start) when first met
+        start = time.perf_counter()
+        translations = translate_window(translator, texts, batch_size, dict(max_len = args.max_len))
+        first_pass = time.perf_counter() - start
+        if args.output and batch_size == args.batch_sizes[0]:
+            with open(args.output, 'w', encoding = 'utf-8') as f:
+                f.writelines(translation + '\n' for translation in translations)
+        # Second pass: nothing left to compile
+        latencies = []
+        order = sorted(range(len(texts)), key = lambda i: translator.source_lengths([texts[i]])[0])
+        for batch_start in range(0, len(texts), batch_size):
+            batch = [texts[i] for i in order[batch_start : batch_start + batch_size]]
+            start = time.perf_counter()
+            translator.translate(batch, max_len = args.max_len)
+            latencies.append(time.perf_counter() - start)
+        results.append(dict(
+            backend = args.backend, batch_size = batch_size, load_s = round(load_seconds, 2), first_pass_s = round(first_pass, 2),
+            p50_batch_ms = round(percentile(latencies, 50) * 1000, 1), p90_batch_ms = round(percentile(latencies, 90) * 1000, 1),
+            sentences_per_sec = round(len(texts) / sum(latencies), 2),
+        ))
+        print(results[-1], file = sys.stderr, flush = True)
+    stats = translator.compiled.stats if args.backend != 'eager' else dict(compiled = 0, loaded = 0, compile_seconds = 0.0)
+    stats['compile_seconds'] = round(stats['compile_seconds'], 2)
+
+    print(f"{len(texts)} sentences, {torch.get_num_threads()} threads. Buckets compiled: {stats['compiled']}, loaded from the cache: {stats['loaded']}, in {stats['compile_seconds']} s.")
+    print_table(results, list(results[0].keys()))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(args = vars(args), stats = stats, results = results), f, indent = 2)
+        print('Results written to', args.json)
+
+
+if __name__ == '__main__':
+    main()
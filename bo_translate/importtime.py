@@ -0,0 +1,88 @@
+'''
+# Import-time profile of the inference entry points. Every scenario runs in a fresh interpreter with `python -X importtime`
+# (median of --repeats runs), e.g. from the repository root
+#   python -m bo_translate.importtime Transformer_From_Scratch/Scratch_inference.safetensors T5_Transformers/T5_inference.safetensors
+# The baseline is what every get_results / training script imported at module level before bo_translate existed.
+'''
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+from bo_translate.reporting import percentile, print_table
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BASELINE_IMPORTS = '\n'.join([
+    'import sentencepiece, pandas, torch',
+    'import torch.utils.tensorboard',
+    'from transformers import T5ForConditionalGeneration, get_cosine_with_hard_restarts_schedule_with_warmup',
+])
+
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def profile(code):
+    '''Run `code` in a fresh interpreter. Return the wall time and the per-module import times reported by -X importtime. '''
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd = REPO_ROOT, capture_output = True, text = True)
+    wall_s = time.perf_counter() - start
+    if completed.returncode != 0:
+        raise RuntimeError(f'{code!r} failed:\n{completed.stderr[-2000:]}')
+    modules = []
+    for line in completed.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules.append(dict(name = name, self_us = int(self_us), cumulative_us = int(cumulative_us), top_level = len(indent) == 1))
+    return wall_s, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(prog = 'python -m bo_translate.importtime', description = 'import-time profile of the inference entry points')
+    parser.add_argument('checkpoints', nargs = '*', help = 'inference checkpoints to profile load_translator() and a first translation with')
+    parser.add_argument('--text', default = 'བཀྲ་ཤིས་བདེ་ལེགས།', help = 'sentence for the first translation')
+    parser.add_argument('--repeats', type = int, default = 3)
+    parser.add_argument('--top', type = int, default = 5, help = 'slowest top-level imports listed per scenario')
+    parser.add_argument('--json', default = None, help = 'also write the results to this file')
+    args = parser.parse_args()
+
+    scenarios = [('baseline: script imports', BASELINE_IMPORTS), ('import bo_translate', 'import bo_translate')]
+    for path in args.checkpoints:
+        path = os.path.abspath(path)
+        name = os.path.basename(path)
+        load = f'import bo_translate; translator = bo_translate.load_translator({path!r})'
+        scenarios.append((f'load_translator({name})', load))
+        scenarios.append((f'first translation ({name})', load + f'; translator.translate([{args.text!r}])'))
+
+    results = []
+    for name, code in scenarios:
+        runs = [profile(code) for _ in range(args.repeats)]
+        modules = runs[-1][1]
+        slowest = sorted((module for module in modules if module['top_level']), key = lambda module: -module['cumulative_us'])[:args.top]
+        results.append(dict(
+            scenario = name,
+            modules = len(modules),
+            import_s = round(percentile([sum(module['self_us'] for module in run_modules) / 1e6 for _, run_modules in runs], 50), 3),
+            wall_s = round(percentile([wall_s for wall_s, _ in runs], 50), 3),
+            slowest = ', '.join(f"{module['name']} {module['cumulative_us'] / 1e6:.2f}s" for module in slowest),
+        ))
+
+    print(f'Fresh interpreter per run, median of {args.repeats} runs. wall_s includes interpreter start-up.')
+    print_table(results, ['scenario', 'modules', 'import_s', 'wall_s'])
+    print()
+    for row in results:
+        print(f"{row['scenario']}: {row['slowest'] or '-'}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(python = sys.version, results = results), f, indent = 2)
+        print('Results written to', args.json)
+
+
+if __name__ == '__main__':
+    main()
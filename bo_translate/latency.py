@@ -0,0 +1,166 @@
+# =======================================
+##### Latency harness across backends and decoding configs
+# =======================================
+
+'''
+# Replay a fixed set of Tibetan sentences through every backend and decoding config and report latency percentiles,
+# throughput and peak memory, e.g.
+#   python -m bo_translate.latency Transformer_From_Scratch/Scratch_inference.safetensors T5_Transformers/T5_inference.safetensors \
+#       Scratch_onnx --num-beams 1 4 --int8 --batch-sizes 1 8 --threads 1 4 --sentences 64 --json latency.json
+# Checkpoints are anything load_translator() takes: Scratch or T5 inference checkpoints, or ONNX export directories.
+# --int8 adds a dynamic int8 variant of every PyTorch checkpoint, quantized on load by the quantize_dynamic_int8() that
+# Scratch.py / T5.py use. Every (checkpoint, variant, num_beams, threads, batch size) runs in its own forked process, so the
+# peak resident memory of a row is that config's alone and thread settings never leak from one row into the next.
+#
+# The sentences are replayed in input order, cut into consecutive batches, as a server sees them, rather than sorted by
+# length: p50 / p90 / p99 are over the latencies of these batches. One batch is translated before timing, to warm up.
+# Throughput counts the target tokens of the translations (re-encoded with the target tokenizer) and the sentences.
+'''
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import traceback
+
+from bo_translate import load_translator, read_checkpoint_metadata
+from bo_translate.reporting import percentile, print_table
+
+
+def peak_rss_megabytes():
+    '''Peak resident memory of this process so far. ru_maxrss is in kilobytes on Linux and in bytes on macOS. '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (2**20 if sys.platform == 'darwin' else 2**10), 1)
+
+
+def quantize_int8(translator, checkpoint_format):
+    '''Quantize the translator's model to dynamic int8 in place with quantize_dynamic_int8() of bo_translate.scratch / bo_translate.t5. '''
+    if checkpoint_format == 'Scratch-inference':
+        from bo_translate.scratch import quantize_dynamic_int8    # Imported here because ONNX configs never need torch
+    elif checkpoint_format == 'T5-inference':
+        from bo_translate.t5 import quantize_dynamic_int8
+    else:
+        raise ValueError(f'int8 is for PyTorch checkpoints, not {checkpoint_format}')
+    translator.model = quantize_dynamic_int8(translator.model)
+    return translator
+
+
+def load_for_config(checkpoint, variant, threads):
+    '''The translator of one config on the CPU, limited to `threads` intra-op threads. '''
+    checkpoint_format = read_checkpoint_metadata(checkpoint).get('format')
+    if checkpoint_format in ('Scratch-onnx', 'T5-onnx'):
+        if variant != 'fp32':
+            raise ValueError(f'{checkpoint} is an ONNX export, it has no {variant} variant')
+        from bo_translate.onnx_runtime import Translator    # Imported here because only ONNX configs need it
+        return Translator(checkpoint, 'cpu', threads = threads)
+    import torch    # Imported here because ONNX configs never need it
+    torch.set_num_threads(threads)
+    translator = load_translator(checkpoint, 'cpu')
+    return quantize_int8(translator, checkpoint_format) if variant == 'int8' else translator
+
+
+def measure_config(config, texts, max_len, passes, connection):
+    '''Run in a forked process: load, warm up, replay `texts` `passes` times and send the measurements through `connection`. '''
+    try:
+        start = time.perf_counter()
+        translator = load_for_config(config['checkpoint'], config['variant'], config['threads'])
+        load_seconds = time.perf_counter() - start
+        options = dict(max_len = max_len)
+        if config['num_beams'] is not None:
+            options['num_beams'] = config['num_beams']
+        batch_size = config['batch_size']
+        batches = [texts[i : i + batch_size] for i in range(0, len(texts), batch_size)]
+
+        translator.translate(batches[0], **options)    # warm-up
+        latencies, tokens = [], 0
+        for _ in range(passes):
+            for batch in batches:
+                start = time.perf_counter()
+                translations = translator.translate(batch, **options)
+                latencies.append(time.perf_counter() - start)
+                tokens += sum(len(ids) for ids in translator.tgtTokenizer.encode(translations))
+        total = sum(latencies)
+        connection.send(dict(
+            load_s = round(load_seconds, 2),
+            p50_ms = round(percentile(latencies, 50) * 1000, 1),
+            p90_ms = round(percentile(latencies, 90) * 1000, 1),
+            p99_ms = round(percentile(latencies, 99) * 1000, 1),
+            sentences_per_sec = round(len(texts) * passes / total, 2),
+            tokens_per_sec = round(tokens / total, 1),
+            peak_rss_mb = peak_rss_megabytes(),
+        ))
+    except Exception:
+        connection.send(dict(error = traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+def run_config(config, texts, max_len, passes):
+    '''measure_config() in a fresh forked process. The parent has not imported torch, so the child starts clean. '''
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex = False)
+    process = context.Process(target = measure_config, args = (config, texts, max_len, passes, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = dict(error = f'the process exited with code {process.exitcode} before reporting')
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(prog = 'python -m bo_translate.latency', description = 'latency percentiles, throughput and peak memory per backend and decoding config')
+    parser.add_argument('checkpoints', nargs = '+', help = 'inference checkpoints and/or ONNX export directories')
+    parser.add_argument('--num-beams', type = int, nargs = '+', default = [None], help = "default: each backend's own default")
+    parser.add_argument('--int8', action = 'store_true', help = 'also run every PyTorch checkpoint quantized to dynamic int8')
+    parser.add_argument('--batch-sizes', type = int, nargs = '+', default = [1, 8])
+    parser.add_argument('--threads', type = int, nargs = '+', default = [1], help = 'intra-op threads (torch or onnxruntime)')
+    parser.add_argument('--input', default = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'train.bo'))
+    parser.add_argument('--sentences', type = int, default = 64, help = 'the first N non-empty lines of --input are the sentence set')
+    parser.add_argument('--passes', type = int, default = 1, help = 'times the sentence set is replayed per config')
+    parser.add_argument('--max-len', type = int, default = 100)
+    parser.add_argument('--json', default = None, help = 'also write the results to this file')
+    args = parser.parse_args()
+
+    with open(args.input, encoding = 'utf-8') as f:
+        texts = list(itertools.islice((line.strip() for line in f if line.strip()), args.sentences))
+    configs = []
+    for checkpoint in args.checkpoints:
+        checkpoint_format = read_checkpoint_metadata(checkpoint).get('format')
+        variants = ['fp32', 'int8'] if args.int8 and checkpoint_format.endswith('-inference') else ['fp32']
+        for variant, num_beams, threads, batch_size in itertools.product(variants, args.num_beams, args.threads, args.batch_sizes):
+            configs.append(dict(
+                checkpoint = checkpoint, format = checkpoint_format, variant = variant,
+                num_beams = num_beams, threads = threads, batch_size = batch_size,
+            ))
+
+    results = []
+    for config in configs:
+        result = run_config(config, texts, args.max_len, args.passes)
+        if 'error' in result:
+            print(f'{config} failed:\n{result["error"]}', file = sys.stderr, flush = True)
+            continue
+        results.append(dict(
+            checkpoint = os.path.basename(os.path.normpath(config['checkpoint'])), format = config['format'], variant = config['variant'],
+            num_beams = 'default' if config['num_beams'] is None else config['num_beams'], threads = config['threads'], batch_size = config['batch_size'],
+            **result,
+        ))
+        print(results[-1], file = sys.stderr, flush = True)
+
+    print(f'{len(texts)} sentences x {args.passes} pass(es), max_len {args.max_len}, {os.cpu_count()} CPUs. Latencies are per batch, peak RSS per config process.')
+    if results:
+        print_table(results, list(results[0].keys()))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(sentences = texts, args = vars(args), cpus = os.cpu_count(), results = results), f, indent = 2, ensure_ascii = False)
+        print('Results written to', args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+'''
+# Load test for bo_translate.server: closed-loop clients, each sending one sentence per request, e.g. from the repository root
+#   python -m bo_translate.loadtest Transformer_From_Scratch/Scratch_inference.safetensors --concurrency 16
+# starts the server twice, one sentence at a time (--max-batch-size 1 --max-wait-ms 0) and micro-batched, runs the same
+# load against both and reports p50/p95/p99 latency and throughput. --url tests a server that is already running instead.
+# --stream sends streamed requests and also reports the time to first token (TTFT). --deadline-ms sends a latency
+# budget with every request and reports the share of translations truncated to meet it.
+'''
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from bo_translate.reporting import percentile, print_table
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def request(reader, writer, host, method, path, payload = None):
+    body = b'' if payload is None else json.dumps(payload, ensure_ascii = False).encode('utf-8')
+    writer.write(
+        f'{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    response = json.loads(await reader.readexactly(length))
+    if status != 200:
+        raise RuntimeError(f'{method} {path} --> {status} {response}')
+    return response
+
+
+async def stream_request(reader, writer, host, payload):
+    '''POST a streamed translation. Return the seconds to the first chunk and to the end of the stream, and whether it was truncated. '''
+    body = json.dumps(dict(payload, stream = True), ensure_ascii = False).encode('utf-8')
+    start = time.perf_counter()
+    writer.write(
+        f'POST /translate HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    while (await reader.readline()) not in (b'\r\n', b''):
+        pass
+    first_chunk = None
+    truncated = False
+    while True:
+        size = int((await reader.readline()).strip(), 16)
+        data = await reader.readexactly(size + 2)
+        if size == 0:
+            break
+        line = json.loads(data[:-2])
+        if 'error' in line or status != 200:
+            raise RuntimeError(f'POST /translate --> {status} {line}')
+        if first_chunk is None and ('text' in line or line.get('done')):
+            first_chunk = time.perf_counter() - start
+        truncated = truncated or line.get('truncated', False)
+    return first_chunk, time.perf_counter() - start, truncated
+
+
+async def get(host, port, path):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        return await request(reader, writer, host, 'GET', path)
+    finally:
+        writer.close()
+
+
+async def run_load(host, port, sentences, concurrency, options, stream = False):
+    '''
+    `concurrency` clients on keep-alive connections send the sentences one per request until all are translated.
+    With `stream` the requests are streamed and the time to the first chunk is measured too.
+    '''
+    todo = iter(sentences)
+    latencies = []
+    first_chunk_latencies = []
+    truncated = []
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for text in todo:    # shared iterator: each sentence is sent once
+                if stream:
+                    first_chunk, total, was_cut = await stream_request(reader, writer, host, dict(text = text, **options))
+                    first_chunk_latencies.append(first_chunk)
+                    latencies.append(total)
+                    truncated.append(was_cut)
+                    continue
+                start = time.perf_counter()
+                response = await request(reader, writer, host, 'POST', '/translate', dict(text = text, **options))
+                latencies.append(time.perf_counter() - start)
+                truncated.append(response.get('truncated', False))
+        finally:
+            writer.close()
+
+    before = await get(host, port, '/metrics')
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    after = await get(host, port, '/metrics')
+    batches = after['batches'] - before['batches']
+    if stream:
+        return dict(
+            sentences = len(latencies),
+            seconds = round(seconds, 3),
+            sentences_per_second = round(len(latencies) / seconds, 2),
+            **{f'ttft_p{q}_ms': round(1000 * percentile(first_chunk_latencies, q), 1) for q in (50, 95, 99)},
+            **{f'p{q}_ms': round(1000 * percentile(latencies, q), 1) for q in (50, 95, 99)},
+            truncated = round(sum(truncated) / len(truncated), 3),
+        )
+    return dict(
+        sentences = len(latencies),
+        seconds = round(seconds, 3),
+        sentences_per_second = round(len(latencies) / seconds, 2),
+        **{f'p{q}_ms': round(1000 * percentile(latencies, q), 1) for q in (50, 95, 99)},
+        mean_batch_size = round((after['sentences'] - before['sentences']) / batches, 2) if batches else None,
+        truncated = round(sum(truncated) / len(truncated), 3),
+    )
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(checkpoint, port, server_args, timeout = 300):
+    '''Launch `python -m bo_translate.server` and wait until /health answers. '''
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'bo_translate.server', checkpoint, '--port', str(port), *server_args],
+        cwd = REPO_ROOT, stdout = subprocess.DEVNULL,
+    )
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'the server exited with code {process.returncode}')
+        try:
+            asyncio.run(get('127.0.0.1', port, '/health'))
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f'the server did not answer within {timeout}s')
+
+
+def load_sentences(path, n):
+    with open(path, encoding = 'utf-8') as f:
+        return list(itertools.islice((line.strip() for line in f if line.strip()), n))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog = 'python -m bo_translate.loadtest', description = 'latency and throughput of bo_translate.server')
+    parser.add_argument('checkpoint', nargs = '?', help = 'start servers for this inference checkpoint (one at a time and micro-batched)')
+    parser.add_argument('--url', default = None, help = 'test a running server instead, e.g. http://127.0.0.1:8000')
+    parser.add_argument('--input', default = os.path.join(REPO_ROOT, 'data', 'train.bo'), help = 'Tibetan sentences, one per line')
+    parser.add_argument('--sentences', type = int, default = 200)
+    parser.add_argument('--concurrency', type = int, default = 16, help = 'clients sending requests at the same time')
+    parser.add_argument('--max-batch-size', type = int, default = 32)
+    parser.add_argument('--max-wait-ms', type = float, default = 10)
+    parser.add_argument('--num-beams', type = int, default = None)
+    parser.add_argument('--max-len', type = int, default = 100)
+    parser.add_argument('--max-len-a', type = float, default = None)
+    parser.add_argument('--max-len-b', type = int, default = 10)
+    parser.add_argument('--deadline-ms', type = float, default = None, help = 'latency budget sent with every request')
+    parser.add_argument('--stream', action = 'store_true', help = 'stream the translations and report the time to first token')
+    parser.add_argument('--warmup', type = int, default = 8, help = 'requests sent before measuring')
+    parser.add_argument('--json', default = None, help = 'also write the results to this file')
+    args = parser.parse_args()
+    if (args.checkpoint is None) == (args.url is None):
+        parser.error('give either a checkpoint or --url')
+
+    sentences = load_sentences(args.input, args.sentences)
+    options = dict(max_len = args.max_len)
+    if args.num_beams is not None:
+        options['num_beams'] = args.num_beams
+    if args.max_len_a is not None:
+        options.update(max_len_a = args.max_len_a, max_len_b = args.max_len_b)
+    if args.deadline_ms is not None:
+        options['deadline_ms'] = args.deadline_ms
+
+    def measure(host, port):
+        asyncio.run(run_load(host, port, sentences[:args.warmup], 1, options))
+        return asyncio.run(run_load(host, port, sentences, args.concurrency, options, args.stream))
+
+    results = []
+    if args.url:
+        host, _, port = args.url.split('//', 1)[-1].rstrip('/').partition(':')
+        results.append(dict(server = args.url, **measure(host, int(port or 80))))
+    else:
+        configs = [
+            ('one at a time', ['--max-batch-size', '1', '--max-wait-ms', '0']),
+            (f'micro-batched ({args.max_batch_size}, {args.max_wait_ms:g} ms)', ['--max-batch-size', str(args.max_batch_size), '--max-wait-ms', str(args.max_wait_ms)]),
+        ]
+        for name, server_args in configs:
+            port = free_port()
+            if args.num_beams is not None:
+                server_args = server_args + ['--num-beams', str(args.num_beams)]
+            process = start_server(args.checkpoint, port, server_args + ['--max-len', str(args.max_len)])
+            try:
+                results.append(dict(server = name, **measure('127.0.0.1', port)))
+            finally:
+                process.terminate()
+                process.wait()
+            print(f'{name}: done', flush = True)
+
+    print(f'{len(sentences)} sentences, {args.concurrency} concurrent clients')
+    if args.stream:
+        print_table(results, ['server', 'sentences_per_second', 'ttft_p50_ms', 'ttft_p95_ms', 'ttft_p99_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'truncated'])
+    else:
+        print_table(results, ['server', 'sentences_per_second', 'p50_ms', 'p95_ms', 'p99_ms', 'mean_batch_size', 'truncated'])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(concurrency = args.concurrency, options = options, stream = args.stream, results = results), f, indent = 2)
+        print('Results written to', args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+# =======================================
+##### ONNX export of the inference checkpoints
+# =======================================
+
+'''
+# Export an inference checkpoint as two ONNX graphs for bo_translate.onnx_runtime, e.g.
+#   python -m bo_translate.onnx_export Transformer_From_Scratch/Scratch_inference.safetensors --output-dir Scratch_onnx
+#   python -m bo_translate.onnx_export T5_Transformers/T5_inference.safetensors --output-dir T5_onnx
+# load_translator('Scratch_onnx') then translates on onnxruntime with the same API as the PyTorch backends.
+#
+# encoder.onnx: (src_ids, attention_mask) --> cross_key_<i>, cross_value_<i> of every decoder layer, batch * heads * len(src) * head_dim.
+#   The cross-attention keys and values only depend on the source, so they are computed once per sentence.
+# decoder.onnx: one decoding step, (input_ids: batch * 1, step: the position of input_ids, attention_mask, past_key_<i>,
+#   past_value_<i>, cross_key_<i>, cross_value_<i>) --> logits of the next token (batch * vocab), present_key_<i>, present_value_<i>.
+#   The self-attention keys and values of the earlier steps come in as past_* and go out with the new step appended,
+#   so every step costs one position instead of the whole prefix.
+# The graphs are written by the TorchScript exporter from modules that spell out the layers of the loaded model with its
+# weights: neither nn.TransformerDecoderLayer nor T5's Cache objects trace to explicit key/value inputs, and
+# nn.MultiheadAttention traces to fixed sequence lengths.
+# model.json holds the format, the tokenizer paths and the sizes the runtime needs to start decoding.
+'''
+
+import argparse
+import json
+import math
+import os
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from bo_translate import read_checkpoint_metadata
+
+
+ONNX_OPSET = 17
+
+
+def split_heads(x, num_heads, head_dim):
+    '''batch_size * seq_len * (num_heads * head_dim) --> batch_size * num_heads * seq_len * head_dim '''
+    return x.view(x.size(0), -1, num_heads, head_dim).transpose(1, 2)
+
+
+def attend(q, k, v, bias, scale):
+    '''Attention of q over k / v (batch_size * num_heads * seq_len * head_dim), `bias` is added to the scores. Return batch_size * seq_len * (num_heads * head_dim). '''
+    scores = torch.matmul(q, k.transpose(-1, -2)) * scale
+    if bias is not None:
+        scores = scores + bias
+    output = torch.matmul(F.softmax(scores.float(), dim = -1).type_as(q), v)
+    return output.transpose(1, 2).reshape(q.size(0), -1, q.size(1) * q.size(3))
+
+
+def padding_bias(attention_mask, dtype):
+    '''Additive attention bias over the source, 0 for tokens (attention_mask 1) and the lowest value for padding: batch_size * 1 * 1 * len(src) '''
+    return ((1 - attention_mask.to(dtype)) * torch.finfo(dtype).min)[:, None, None, :]
+
+
+
+# --------------------------
+#### The transformer from scratch
+# --------------------------
+
+def in_projections(attention):
+    '''Query, key and value weights and biases of an nn.MultiheadAttention or a PrunedMultiheadAttention, which share the layout. '''
+    return list(zip(attention.in_proj_weight.chunk(3), attention.in_proj_bias.chunk(3)))
+
+
+def self_attention(attention, x, bias, past = None):
+    '''
+    Self-attention of an nn.MultiheadAttention or PrunedMultiheadAttention written out with matmuls: nn.MultiheadAttention
+    traces to reshapes with the example's sequence length baked in. With `past` (keys, values), x is appended to it and
+    the new keys and values are returned too.
+    '''
+    q, k, v = (split_heads(F.linear(x, w, b), attention.num_heads, attention.head_dim) for w, b in in_projections(attention))
+    if past is not None:
+        k, v = torch.cat((past[0], k), dim = 2), torch.cat((past[1], v), dim = 2)
+    output = attention.out_proj(attend(q, k, v, bias, attention.head_dim ** -0.5))
+    return output if past is None else (output, k, v)
+
+
+class ScratchEncoderGraph(nn.Module):
+    '''MyTransformer.encode() following nn.TransformerEncoderLayer (post-norm), then the cross-attention keys and values of every decoder layer. '''
+    def __init__(self, model):
+        super(ScratchEncoderGraph, self).__init__()
+        if any(layer.norm_first for layer in model.encoder.layers):
+            raise ValueError('only post-norm encoder layers (norm_first = False) are exported')
+        self.model = model
+
+    def forward(self, src_ids, attention_mask):
+        model = self.model
+        x = model.pos_encoder(model.source_embedding(src_ids))    # batch_size * len(src) * d_model
+        bias = padding_bias(attention_mask, x.dtype)
+        for layer in model.encoder.layers:
+            x = layer.norm1(x + self_attention(layer.self_attn, x, bias))
+            x = layer.norm2(x + layer.linear2(layer.activation(layer.linear1(x))))
+        memory = model.encoder.norm(x)
+        cross = []
+        for layer in model.decoder.layers:
+            attention = layer.multihead_attn
+            for w, b in in_projections(attention)[1:]:
+                cross.append(split_heads(F.linear(memory, w, b), attention.num_heads, attention.head_dim))
+        return tuple(cross)
+
+
+class ScratchDecoderStep(nn.Module):
+    '''One step of MyTransformer.decode() for the last position only, following nn.TransformerDecoderLayer (post-norm). '''
+    def __init__(self, model):
+        super(ScratchDecoderStep, self).__init__()
+        if any(layer.norm_first for layer in model.decoder.layers):
+            raise ValueError('only post-norm decoder layers (norm_first = False) are exported')
+        self.model = model
+
+    def forward(self, input_ids, step, attention_mask, *cache):
+        model = self.model
+        num_layers = len(model.decoder.layers)
+        past, cross = cache[:2 * num_layers], cache[2 * num_layers:]
+        x = model.target_embedding(input_ids) * math.sqrt(model.d_model) + model.pos_encoder.pe[0].index_select(0, step)    # batch_size * 1 * d_model
+        cross_bias = padding_bias(attention_mask, x.dtype)
+        present = []
+        for i, layer in enumerate(model.decoder.layers):
+            output, k, v = self_attention(layer.self_attn, x, None, past[2 * i : 2 * i + 2])    # the step sees every earlier position, no causal mask needed
+            present += [k, v]
+            x = layer.norm1(x + output)
+
+            attention = layer.multihead_attn
+            w_q, b_q = in_projections(attention)[0]
+            q = split_heads(F.linear(x, w_q, b_q), attention.num_heads, attention.head_dim)
+            x = layer.norm2(x + attention.out_proj(attend(q, cross[2 * i], cross[2 * i + 1], cross_bias, attention.head_dim ** -0.5)))
+            x = layer.norm3(x + layer.linear2(layer.activation(layer.linear1(x))))
+        logits = model.out(model.decoder.norm(x)[:, 0])
+        return (logits, *present)
+
+
+def scratch_graphs(model):
+    '''The encoder and decoder step modules and the self-attention (num_heads, head_dim) of every decoder layer. '''
+    shapes = [(layer.self_attn.num_heads, layer.self_attn.head_dim) for layer in model.decoder.layers]
+    return ScratchEncoderGraph(model), ScratchDecoderStep(model), shapes
+
+
+
+# --------------------------
+#### T5
+# --------------------------
+
+class T5EncoderGraph(nn.Module):
+    def __init__(self, model):
+        super(T5EncoderGraph, self).__init__()
+        self.model = model
+
+    def forward(self, src_ids, attention_mask):
+        hidden = self.model.encoder(input_ids = src_ids, attention_mask = attention_mask).last_hidden_state
+        cross = []
+        for block in self.model.decoder.block:
+            attention = block.layer[1].EncDecAttention
+            cross += [split_heads(attention.k(hidden), attention.n_heads, attention.key_value_proj_dim), split_heads(attention.v(hidden), attention.n_heads, attention.key_value_proj_dim)]
+        return tuple(cross)
+
+
+class T5DecoderStep(nn.Module):
+    '''
+    One step of T5's decoder for the last position only. T5 does not scale attention scores, and the relative position bias
+    of the first self-attention layer is shared by all layers; the step at `step` sees keys at relative positions -step..0.
+    '''
+    def __init__(self, model):
+        super(T5DecoderStep, self).__init__()
+        self.model = model
+        config = model.config
+        self.scale_outputs = getattr(config, 'scale_decoder_outputs', config.tie_word_embeddings)    # transformers 5.x renamed it
+
+    def forward(self, input_ids, step, attention_mask, *cache):
+        from transformers.models.t5.modeling_t5 import T5Attention    # Imported here because only the T5 export needs it
+        model = self.model
+        blocks = model.decoder.block
+        past, cross = cache[:2 * len(blocks)], cache[2 * len(blocks):]
+        x = model.decoder.embed_tokens(input_ids)    # batch_size * 1 * d_model
+        cross_bias = padding_bias(attention_mask, x.dtype)
+
+        relative = blocks[0].layer[0].SelfAttention
+        relative_position = torch.arange(past[0].size(2) + 1, device = x.device) - step
+        buckets = T5Attention._relative_position_bucket(
+            relative_position, bidirectional = False,
+            num_buckets = relative.relative_attention_num_buckets, max_distance = relative.relative_attention_max_distance
+        )
+        position_bias = relative.relative_attention_bias(buckets).t()[None, :, None, :]    # 1 * num_heads * 1 * (step + 1)
+
+        present = []
+        for i, block in enumerate(blocks):
+            attention = block.layer[0].SelfAttention
+            h = block.layer[0].layer_norm(x)
+            q, k, v = (split_heads(proj(h), attention.n_heads, attention.key_value_proj_dim) for proj in [attention.q, attention.k, attention.v])
+            k = torch.cat((past[2 * i], k), dim = 2)
+            v = torch.cat((past[2 * i + 1], v), dim = 2)
+            present += [k, v]
+            x = x + attention.o(attend(q, k, v, position_bias, 1.0))
+
+            attention = block.layer[1].EncDecAttention
+            q = split_heads(attention.q(block.layer[1].layer_norm(x)), attention.n_heads, attention.key_value_proj_dim)
+            x = x + attention.o(attend(q, cross[2 * i], cross[2 * i + 1], cross_bias, 1.0))
+            x = x + block.layer[2].DenseReluDense(block.layer[2].layer_norm(x))
+        x = model.decoder.final_layer_norm(x)[:, 0]
+        if self.scale_outputs:
+            x = x * model.model_dim ** -0.5
+        return (model.lm_head(x), *present)
+
+
+def t5_graphs(model):
+    '''The encoder and decoder step modules and the self-attention (num_heads, head_dim) of every decoder layer. '''
+    shapes = [(block.layer[0].SelfAttention.n_heads, block.layer[0].SelfAttention.key_value_proj_dim) for block in model.decoder.block]
+    return T5EncoderGraph(model), T5DecoderStep(model), shapes
+
+
+
+# --------------------------
+#### Export
+# --------------------------
+
+def export_onnx(path, output_dir, opset = ONNX_OPSET):
+    '''
+    Export the inference checkpoint at `path` to `output_dir`: encoder.onnx, decoder.onnx and model.json.
+    Return the path of model.json.
+    '''
+    checkpoint_format = read_checkpoint_metadata(path).get('format')
+    if checkpoint_format == 'Scratch-inference':
+        from bo_translate.scratch import load_inference_checkpoint
+        model, srcTokenizerPath, tgtTokenizerPath = load_inference_checkpoint(path, 'cpu')
+        encoder, decoder, shapes = scratch_graphs(model)
+        start_id, repetition_penalty, max_steps = None, 1.0, model.pos_encoder.pe.size(1)    # None: the target <s>
+    elif checkpoint_format == 'T5-inference':
+        from bo_translate.t5 import load_inference_checkpoint
+        model, srcTokenizerPath, tgtTokenizerPath = load_inference_checkpoint(path, 'cpu')
+        encoder, decoder, shapes = t5_graphs(model)
+        start_id, repetition_penalty, max_steps = model.config.decoder_start_token_id, 2.5, None    # repetition_penalty as in T5.generate_translation()
+    else:
+        raise ValueError(f'{path} is not an inference checkpoint (format {checkpoint_format!r}), see save_inference_checkpoint() in Scratch.py / T5.py')
+
+    os.makedirs(output_dir, exist_ok = True)
+    num_layers = len(shapes)
+    cross_names = [f'cross_{kind}_{i}' for i in range(num_layers) for kind in ['key', 'value']]
+    past_names = [f'past_{kind}_{i}' for i in range(num_layers) for kind in ['key', 'value']]
+    present_names = [f'present_{kind}_{i}' for i in range(num_layers) for kind in ['key', 'value']]
+
+    # Example inputs: 2 sentences of 5 source tokens, at step 3
+    src_ids = torch.ones(2, 5, dtype = torch.long)
+    attention_mask = torch.ones(2, 5, dtype = torch.long)
+    input_ids = torch.ones(2, 1, dtype = torch.long)
+    step = torch.tensor([3])
+    past = [torch.zeros(2, heads, 3, head_dim) for heads, head_dim in shapes for _ in range(2)]
+    with torch.no_grad():
+        cross = encoder(src_ids, attention_mask)
+        torch.onnx.export(
+            encoder, (src_ids, attention_mask), os.path.join(output_dir, 'encoder.onnx'),
+            input_names = ['src_ids', 'attention_mask'], output_names = cross_names,
+            dynamic_axes = dict({name: {0: 'batch', 1: 'src_len'} for name in ['src_ids', 'attention_mask']}, **{name: {0: 'batch', 2: 'src_len'} for name in cross_names}),
+            opset_version = opset, dynamo = False,
+        )
+        torch.onnx.export(
+            decoder, (input_ids, step, attention_mask, *past, *cross), os.path.join(output_dir, 'decoder.onnx'),
+            input_names = ['input_ids', 'step', 'attention_mask'] + past_names + cross_names, output_names = ['logits'] + present_names,
+            dynamic_axes = dict(
+                input_ids = {0: 'batch'}, attention_mask = {0: 'batch', 1: 'src_len'}, logits = {0: 'batch'},
+                **{name: {0: 'batch', 2: 'past_len'} for name in past_names},
+                **{name: {0: 'batch', 2: 'src_len'} for name in cross_names},
+                **{name: {0: 'batch', 2: 'present_len'} for name in present_names},
+            ),
+            opset_version = opset, dynamo = False,
+        )
+
+    directory = os.path.abspath(output_dir)
+    config = dict(
+        format = checkpoint_format.replace('-inference', '-onnx'),
+        checkpoint = os.path.relpath(os.path.abspath(path), directory),
+        srcTokenizer = os.path.relpath(srcTokenizerPath, directory),
+        tgtTokenizer = os.path.relpath(tgtTokenizerPath, directory),
+        decoder_layers = [list(shape) for shape in shapes],    # (num_heads, head_dim) of each self-attention
+        decoder_start_id = start_id,
+        repetition_penalty = repetition_penalty,
+        max_steps = max_steps,    # MyTransformer's positional encoding has max_len positions
+        opset = opset,
+    )
+    config_path = os.path.join(output_dir, 'model.json')
+    with open(config_path, 'w') as f:
+        json.dump(config, f, indent = 2)
+    return config_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Export an inference checkpoint as ONNX encoder and decoder step graphs for bo_translate.onnx_runtime')
+    parser.add_argument('checkpoint', help = 'inference checkpoint written by save_inference_checkpoint() in Scratch.py or T5.py')
+    parser.add_argument('--output-dir', required = True, help = 'where encoder.onnx, decoder.onnx and model.json go')
+    parser.add_argument('--opset', type = int, default = ONNX_OPSET)
+    args = parser.parse_args()
+    print('Exported to', export_onnx(args.checkpoint, args.output_dir, args.opset))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+# =======================================
+##### Backend: ONNX Runtime
+# =======================================
+
+'''
+# Decodes with the encoder and decoder step graphs written by bo_translate.onnx_export, for either model, on onnxruntime.
+# Needs onnxruntime, numpy and sentencepiece, but not torch. Greedy search and beam search follow greedy_decode_batch() and
+# beam_decode_ids() in scratch.py step for step, with the decoder's past keys and values carried from step to step instead
+# of decoding the whole prefix again. T5 exports add the repetition penalty of T5.generate_translation(), so greedy search
+# gives the translations of the PyTorch T5 backend; its beam search ranks hypotheses like scratch.py, not like generate().
+'''
+
+import json
+import os
+import time
+
+import numpy as np
+import onnxruntime as ort
+import sentencepiece as spm
+
+from bo_translate import max_target_length
+from bo_translate.streaming import detokenize_stream
+
+
+
+# --------------------------
+#### Decoding
+# --------------------------
+
+def log_softmax(logits):
+    logits = logits - logits.max(axis = -1, keepdims = True)
+    return logits - np.log(np.exp(logits).sum(axis = -1, keepdims = True))
+
+
+def penalize_repetitions(scores, previous, penalty):
+    '''
+    RepetitionPenaltyLogitsProcessor of transformers, in place: the scores of the tokens in each row of `previous` are
+    divided by `penalty` if positive and multiplied by it if negative.
+    '''
+    if penalty == 1.0:
+        return scores
+    for row, ids in enumerate(previous):
+        ids = np.unique(ids)
+        seen = scores[row, ids]
+        scores[row, ids] = np.where(seen < 0, seen * penalty, seen / penalty)
+    return scores
+
+
+class OnnxModel:
+    '''
+    The two sessions of an export directory, run step by step with the self-attention keys and values kept in numpy arrays.
+    `threads` is onnxruntime's intra-op thread count, by default one per core.
+    '''
+    def __init__(self, path, device = None, threads = None):
+        with open(os.path.join(path, 'model.json')) as f:
+            self.config = json.load(f)
+        if device is not None and str(device).startswith('cuda'):
+            providers = ['CUDAExecutionProvider', 'CPUExecutionProvider']
+        else:
+            providers = ['CPUExecutionProvider']
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.encoder = ort.InferenceSession(os.path.join(path, 'encoder.onnx'), options, providers = providers)
+        self.decoder = ort.InferenceSession(os.path.join(path, 'decoder.onnx'), options, providers = providers)
+        self.layers = self.config['decoder_layers']
+        self.output_names = [output.name for output in self.decoder.get_outputs()]
+
+
+    def encode(self, src_ids, attention_mask):
+        '''Cross-attention keys and values of every decoder layer for a padded batch of source ids. '''
+        return self.encoder.run(None, dict(src_ids = src_ids, attention_mask = attention_mask))
+
+
+    def empty_past(self, batch_size):
+        return [np.zeros((batch_size, heads, 0, head_dim), dtype = np.float32) for heads, head_dim in self.layers for _ in range(2)]
+
+
+    def step(self, input_ids, step, attention_mask, past, cross):
+        '''Logits of the token after `input_ids` (batch_size * 1, at position `step`) and the keys and values with that position appended. '''
+        feeds = dict(input_ids = input_ids, step = np.array([step], dtype = np.int64), attention_mask = attention_mask)
+        for i in range(len(self.layers)):
+            feeds[f'past_key_{i}'], feeds[f'past_value_{i}'] = past[2 * i], past[2 * i + 1]
+            feeds[f'cross_key_{i}'], feeds[f'cross_value_{i}'] = cross[2 * i], cross[2 * i + 1]
+        outputs = self.decoder.run(self.output_names, feeds)
+        return outputs[0], outputs[1:]
+
+
+def greedy_decode_batch(model, src_batch, src_pad_id, start_id, tgt_eos_id, max_len = 100, max_lens = None, deadline = None, repetition_penalty = 1.0):
+    '''Same as greedy_decode_batch() in scratch.py: return the generated ids of each sentence, </s> excluded, and whether each was truncated. '''
+    width = max(len(ids) for ids in src_batch)
+    src = np.array([ids + [src_pad_id] * (width - len(ids)) for ids in src_batch], dtype = np.int64)    # batch_size * len(src)
+    attention_mask = (src != src_pad_id).astype(np.int64)
+    cross = model.encode(src, attention_mask)
+    past = model.empty_past(len(src_batch))
+    tgt = np.full((len(src_batch), 1), start_id, dtype = np.int64)    # batch_size * len(tgt)
+    limits = np.array(max_lens or [max_len] * len(src_batch))
+    finished = np.zeros(len(src_batch), dtype = bool)    # generated </s>
+    stopped = np.zeros(len(src_batch), dtype = bool)    # finished or at its length limit
+
+    for i in range(int(limits.max())):
+        logits, past = model.step(tgt[:, -1:], i, attention_mask, past, cross)
+        next_ids = penalize_repetitions(logits, tgt, repetition_penalty).argmax(axis = -1)
+        next_ids[stopped] = tgt_eos_id
+        tgt = np.concatenate((tgt, next_ids[:, None]), axis = 1)
+        finished |= (next_ids == tgt_eos_id) & ~stopped
+        stopped |= finished | (limits <= i + 1)
+        if stopped.all() or (deadline is not None and time.monotonic() >= deadline):
+            break
+
+    generated = []
+    for ids in tgt[:, 1:].tolist():
+        generated.append(ids[:ids.index(tgt_eos_id)] if tgt_eos_id in ids else ids)
+    return generated, [not done for done in finished.tolist()]
+
+
+def greedy_decode_stream(model, src_ids, start_id, tgt_eos_id, max_len = 100, deadline = None, repetition_penalty = 1.0):
+    '''Same as greedy_decode_stream() in scratch.py: yields each token id as it is chosen and returns whether the translation was truncated. '''
+    src = np.array([src_ids], dtype = np.int64)
+    attention_mask = np.ones_like(src)
+    cross = model.encode(src, attention_mask)
+    past = model.empty_past(1)
+    tgt = [start_id]
+    for i in range(max_len):
+        logits, past = model.step(np.array([tgt[-1:]], dtype = np.int64), i, attention_mask, past, cross)
+        generated_id = int(penalize_repetitions(logits, [tgt], repetition_penalty)[0].argmax())
+        tgt.append(generated_id)
+        if generated_id == tgt_eos_id:
+            return False
+        yield generated_id
+        if deadline is not None and time.monotonic() >= deadline:
+            return True
+    return True
+
+
+def beam_decode_ids(model, src_ids, start_id, tgt_eos_id, num_beams = 4, max_len = 100, length_penalty = 0.6, deadline = None, repetition_penalty = 1.0):
+    '''
+    Same as beam_decode_ids() in scratch.py. After every step the past keys and values are reordered to follow the beams
+    that survived; the cross-attention keys and values are repeated per live beam.
+    '''
+    src = np.array([src_ids], dtype = np.int64)    # 1 * len(src)
+    attention_mask = np.ones_like(src)
+    cross = model.encode(src, attention_mask)
+    past = model.empty_past(1)
+    tgt = np.array([[start_id]], dtype = np.int64)    # num_live_beams * len(tgt)
+    beam_scores = np.zeros(1, dtype = np.float32)    # Summed log probs of each live beam
+    finished = []    # (normalized score, token ids) of hypotheses that generated </s>
+
+    expanded = {1: (attention_mask, cross)}    # number of live beams --> the source repeated that many times
+
+    for i in range(max_len):
+        live = tgt.shape[0]
+        if live not in expanded:
+            expanded[live] = (attention_mask.repeat(live, axis = 0), [kv.repeat(live, axis = 0) for kv in cross])
+        logits, past = model.step(tgt[:, -1:], i, expanded[live][0], past, expanded[live][1])
+        log_probs = penalize_repetitions(log_softmax(logits), tgt, repetition_penalty)    # num_live_beams * vocab, penalized after log_softmax like generate()
+        vocab_size = log_probs.shape[1]
+
+        # Take 2 * num_beams candidates so that enough beams survive even if some of them end with </s>
+        flat = (beam_scores[:, None] + log_probs).reshape(-1)
+        candidate_idx = np.argpartition(-flat, 2 * num_beams)[:2 * num_beams]
+        candidate_idx = candidate_idx[np.argsort(-flat[candidate_idx], kind = 'stable')]
+        next_beams, next_tokens, next_scores = [], [], []
+        for idx in candidate_idx.tolist():
+            beam, token, score = idx // vocab_size, idx % vocab_size, float(flat[idx])
+            if token == tgt_eos_id:
+                finished.append((score / (i + 1) ** length_penalty, tgt[beam, 1:].tolist() + [token]))
+            else:
+                next_beams.append(beam)
+                next_tokens.append(token)
+                next_scores.append(score)
+            if len(next_beams) == num_beams:
+                break
+
+        if len(finished) >= num_beams:
+            break
+        tgt = np.concatenate((tgt[next_beams], np.array(next_tokens, dtype = np.int64)[:, None]), axis = 1)
+        past = [kv[next_beams] for kv in past]
+        beam_scores = np.array(next_scores, dtype = np.float32)
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+
+    # Fall back to the live beams if nothing finished within max_len steps or before the deadline
+    if not finished:
+        finished = [(score / (tgt.shape[1] - 1) ** length_penalty, tgt[beam, 1:].tolist()) for beam, score in enumerate(beam_scores.tolist())]
+    return max(finished, key = lambda hypothesis: hypothesis[0])[1]
+
+
+
+# --------------------------
+#### Translator
+# --------------------------
+
+class Translator:
+    '''Translate Tibetan sentences with an ONNX export of either model. `device` 'cuda...' uses onnxruntime's CUDA provider if installed. '''
+    def __init__(self, path, device = None, threads = None):
+        self.model = OnnxModel(path, device, threads)
+        config = self.model.config
+        self.srcTokenizer = spm.SentencePieceProcessor(model_file = os.path.join(path, config['srcTokenizer']))
+        self.tgtTokenizer = spm.SentencePieceProcessor(model_file = os.path.join(path, config['tgtTokenizer']))
+        self.src_pad_id = self.srcTokenizer.piece_to_id('<pad>')
+        self.tgt_eos_id = self.tgtTokenizer.piece_to_id('</s>')
+        self.start_id = self.tgtTokenizer.piece_to_id('<s>') if config['decoder_start_id'] is None else config['decoder_start_id']
+        self.repetition_penalty = config['repetition_penalty']
+        self.max_steps = config['max_steps']
+        self.default_beams = 4 if config['format'] == 'T5-onnx' else 1    # the defaults of the PyTorch backends
+        self.length_offset = 1 if config['format'] == 'T5-onnx' else 0    # generate() counts the decoder start token in max_length
+
+
+    def source_lengths(self, texts):
+        '''Number of source tokens of each sentence. '''
+        return [len(ids) for ids in self.srcTokenizer.encode(list(texts))]
+
+
+    def translate(self, texts, *args, **options):
+        '''Translate a list of sentences, see translate_detailed(). '''
+        return self.translate_detailed(texts, *args, **options)[0]
+
+
+    def step_limit(self, max_len):
+        # The positional encoding of MyTransformer covers max_steps positions, so at most max_steps tokens are fed
+        return max_len if self.max_steps is None else min(max_len, self.max_steps)
+
+
+    def translate_detailed(self, texts, num_beams = None, max_len = 100, length_penalty = 0.6, max_len_a = None, max_len_b = 10, deadline = None):
+        '''
+        Translate a list of sentences like the PyTorch backend of the exported model: num_beams = 1 decodes them greedily as
+        one batch, num_beams > 1 runs beam search one sentence at a time. num_beams defaults to that backend's default.
+        Return the translations and, for each, whether it was truncated (cut off before </s>).
+        '''
+        num_beams = num_beams or self.default_beams
+        src_batch = [self.srcTokenizer.encode(text) for text in texts]
+        translations = [''] * len(texts)
+        truncated = [False] * len(texts)
+        todo = [i for i, ids in enumerate(src_batch) if ids]
+        if not todo:
+            return translations, truncated
+
+        max_len = self.step_limit(max_len)
+        max_lens = [max_target_length(len(src_batch[i]), max_len, max_len_a, max_len_b) - self.length_offset for i in todo]
+        if num_beams == 1:
+            generated, cut = greedy_decode_batch(
+                self.model, [src_batch[i] for i in todo], self.src_pad_id, self.start_id, self.tgt_eos_id, max_len, max_lens, deadline, self.repetition_penalty
+            )
+        else:
+            generated = [
+                [] if deadline is not None and time.monotonic() >= deadline else    # no time left to start this sentence
+                beam_decode_ids(self.model, src_batch[i], self.start_id, self.tgt_eos_id, num_beams, limit, length_penalty, deadline, self.repetition_penalty)
+                for i, limit in zip(todo, max_lens)
+            ]
+            cut = [not ids or ids[-1] != self.tgt_eos_id for ids in generated]
+        for i, ids, was_cut in zip(todo, generated, cut):
+            translations[i] = self.tgtTokenizer.decode(ids)
+            truncated[i] = was_cut
+        return translations, truncated
+
+
+    def translate_stream(self, text, num_beams = None, max_len = 100, length_penalty = 0.6, max_len_a = None, max_len_b = 10, deadline = None):
+        '''Translate one sentence, yielding the translation in chunks as it is generated, like the PyTorch backends. '''
+        num_beams = num_beams or self.default_beams
+        src_ids = self.srcTokenizer.encode(text)
+        if not src_ids:
+            return False
+        if num_beams > 1:
+            translations, truncated = self.translate_detailed([text], num_beams, max_len, length_penalty, max_len_a, max_len_b, deadline)
+            yield translations[0]
+            return truncated[0]
+        limit = max_target_length(len(src_ids), self.step_limit(max_len), max_len_a, max_len_b) - self.length_offset
+        return (yield from detokenize_stream(self.tgtTokenizer, greedy_decode_stream(self.model, src_ids, self.start_id, self.tgt_eos_id, limit, deadline, self.repetition_penalty)))
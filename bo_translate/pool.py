@@ -0,0 +1,218 @@
+'''
+# Multi-process CPU inference: the checkpoint is loaded once, its weights are moved to shared memory and forked worker
+# processes translate with them, each pinned to its own cores with its own intra-op thread count, e.g.
+#   with InferencePool('Transformer_From_Scratch/Scratch_inference.safetensors', workers = 4, threads_per_worker = 2) as pool:
+#       pool.translate(texts)
+# pool.translate() sorts the sentences by length, cuts them into batches of batch_size and spreads the batches over the
+# workers. The weights exist once in memory whatever the number of workers. Linux only (fork and sched_setaffinity).
+#
+# Throughput sweep over workers x threads per worker, from the repository root:
+#   python -m bo_translate.pool Transformer_From_Scratch/Scratch_inference.safetensors --workers 1 2 4 --threads 1 2 4
+'''
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+
+from bo_translate import load_translator
+from bo_translate.reporting import print_table
+
+
+# How often translate_detailed() checks that the workers are still alive while it waits for results
+POLL_SECONDS = 1.0
+
+
+def available_cpus():
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+
+
+def default_cpu_sets(workers, threads_per_worker):
+    '''Consecutive, disjoint core sets of threads_per_worker cores, wrapping around when there are too few cores. '''
+    cpus = available_cpus()
+    return [[cpus[(k * threads_per_worker + j) % len(cpus)] for j in range(threads_per_worker)] for k in range(workers)]
+
+
+def share_weights(model):
+    '''Move every parameter and buffer to shared memory, so forked workers never copy them. Return the bytes shared. '''
+    shared = {}
+    for tensor in itertools.chain(model.parameters(), model.buffers()):
+        tensor.share_memory_()
+        shared[tensor.untyped_storage().data_ptr()] = tensor.untyped_storage().nbytes()    # tied weights count once
+    return sum(shared.values())
+
+
+def pin_current_process(cpus, threads):
+    '''Restrict this process to the cores `cpus` and give torch `threads` intra-op threads. '''
+    import torch
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(threads)
+
+
+def worker_loop(translator, cpus, threads, tasks, results):
+    pin_current_process(cpus, threads)
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        job, texts, options = task
+        try:
+            results.put((job, translator.translate_detailed(texts, **options), None))
+        except Exception as error:
+            results.put((job, None, f'{type(error).__name__}: {error}'))
+
+
+class InferencePool:
+    '''Forked CPU workers sharing one copy of the weights. Same translate() API as the Translators. '''
+    def __init__(self, checkpoint, workers = 2, threads_per_worker = 1, batch_size = 32, cpu_sets = None):
+        self.translator = load_translator(checkpoint, 'cpu')
+        self.shared_bytes = share_weights(self.translator.model)
+        self.batch_size = batch_size
+        self.cpu_sets = cpu_sets or default_cpu_sets(workers, threads_per_worker)
+        context = multiprocessing.get_context('fork')
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.lock = threading.Lock()
+        self.broken = None    # why the pool can no longer translate, once a worker has died
+        self.processes = [
+            context.Process(target = worker_loop, args = (self.translator, cpus, threads_per_worker, self.tasks, self.results), daemon = True)
+            for cpus in self.cpu_sets
+        ]
+        for process in self.processes:
+            process.start()
+
+
+    def source_lengths(self, texts):
+        return self.translator.source_lengths(texts)
+
+
+    def translate(self, texts, **options):
+        '''Translate length-sorted batches of batch_size on the workers and return the translations in input order. '''
+        return self.translate_detailed(texts, **options)[0]
+
+
+    def translate_detailed(self, texts, **options):
+        '''translate() plus whether each translation was truncated. A `deadline` works across processes (time.monotonic()). '''
+        lengths = self.source_lengths(texts)
+        order = sorted(range(len(texts)), key = lambda i: lengths[i])
+        batches = [order[start : start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+        translations = [None] * len(texts)
+        truncated = [False] * len(texts)
+        with self.lock:    # one caller at a time, so results cannot be mixed up
+            if self.broken:
+                raise RuntimeError(self.broken)
+            for job, batch in enumerate(batches):
+                self.tasks.put((job, [texts[i] for i in batch], options))
+            errors = []
+            for _ in batches:
+                job, outputs, error = self.next_result()
+                if error is not None:
+                    errors.append(error)
+                    continue
+                for i, translation, was_cut in zip(batches[job], *outputs):
+                    translations[i] = translation
+                    truncated[i] = was_cut
+        if errors:
+            raise RuntimeError(f'{len(errors)} of {len(batches)} batches failed, first: {errors[0]}')
+        return translations, truncated
+
+
+    def next_result(self):
+        '''
+        The next (job, outputs, error) from the workers. A worker killed mid-batch (the OOM killer, a segfault) never
+        answers, so instead of waiting forever, check every POLL_SECONDS that all workers are alive. Once one has died, its
+        batch is lost and results still queued could belong to this call, so the pool refuses all further work.
+        '''
+        while True:
+            try:
+                return self.results.get(timeout = POLL_SECONDS)
+            except queue.Empty:
+                dead = [(k, process.exitcode) for k, process in enumerate(self.processes) if not process.is_alive()]
+                if dead:
+                    self.broken = 'inference pool worker(s) died: ' + ', '.join(f'worker {k} with exit code {code}' for k, code in dead)
+                    raise RuntimeError(self.broken)
+
+
+    def close(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def process_megabytes(pids):
+    '''Unique (USS) and proportional (PSS) memory of processes in MB, None without psutil. '''
+    try:
+        import psutil    # Imported here because only the benchmark needs it
+    except ImportError:
+        return None, None
+    uss = pss = 0
+    for pid in pids:
+        info = psutil.Process(pid).memory_full_info()
+        uss += info.uss
+        pss += getattr(info, 'pss', info.uss)
+    return round(uss / 2**20, 1), round(pss / 2**20, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog = 'python -m bo_translate.pool', description = 'throughput sweep of workers x threads per worker')
+    parser.add_argument('checkpoint')
+    parser.add_argument('--workers', type = int, nargs = '+', default = [1, 2, 4])
+    parser.add_argument('--threads', type = int, nargs = '+', default = [1, 2, 4], help = 'intra-op threads per worker')
+    parser.add_argument('--input', default = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'train.bo'))
+    parser.add_argument('--sentences', type = int, default = 256)
+    parser.add_argument('--batch-size', type = int, default = 16)
+    parser.add_argument('--num-beams', type = int, default = None)
+    parser.add_argument('--max-len', type = int, default = 100)
+    parser.add_argument('--oversubscribe', action = 'store_true', help = 'also run configs with more threads in total than cores')
+    parser.add_argument('--json', default = None, help = 'also write the results to this file')
+    args = parser.parse_args()
+
+    with open(args.input, encoding = 'utf-8') as f:
+        texts = list(itertools.islice((line.strip() for line in f if line.strip()), args.sentences))
+    options = dict(max_len = args.max_len)
+    if args.num_beams is not None:
+        options['num_beams'] = args.num_beams
+    cores = len(available_cpus())
+
+    results = []
+    for workers, threads in itertools.product(args.workers, args.threads):
+        if workers * threads > cores and not args.oversubscribe:
+            print(f'skipping {workers} x {threads}: more than {cores} cores', file = sys.stderr)
+            continue
+        with InferencePool(args.checkpoint, workers, threads, args.batch_size) as pool:
+            pool.translate(texts[: args.batch_size * workers], **options)    # warm-up: every worker runs a batch
+            start = time.perf_counter()
+            pool.translate(texts, **options)
+            seconds = time.perf_counter() - start
+            uss, pss = process_megabytes([process.pid for process in pool.processes])
+            results.append(dict(
+                workers = workers, threads = threads, sentences_per_second = round(len(texts) / seconds, 2),
+                weights_mb = round(pool.shared_bytes / 2**20, 1), workers_uss_mb = uss, workers_pss_mb = pss,
+            ))
+        print(results[-1], file = sys.stderr, flush = True)
+
+    print(f'{len(texts)} sentences, batch size {args.batch_size}, {cores} cores. Weights are shared: USS is what each worker adds on top.')
+    print_table(results, ['workers', 'threads', 'sentences_per_second', 'weights_mb', 'workers_uss_mb', 'workers_pss_mb'])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(cores = cores, batch_size = args.batch_size, options = options, results = results), f, indent = 2)
+        print('Results written to', args.json)
+
+
+if __name__ == '__main__':
+    main()
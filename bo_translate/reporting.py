@@ -0,0 +1,32 @@
+# =======================================
+##### Percentiles, tables and BLEU for the reports of every benchmark
+# =======================================
+
+'''
+# One definition of each, so that e.g. the p99 of latency.py, loadtest.py, the server's /metrics and the training-side
+# benchmarks all mean the same thing. Only the standard library is imported; sacrebleu only when corpus_bleu() runs.
+'''
+
+import math
+
+
+def percentile(values, q):
+    '''Nearest-rank percentile of a list of numbers (q in 0-100), None for an empty list. Always one of the values. '''
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values), max(1, math.ceil(q / 100 * len(values)))) - 1]
+
+
+def print_table(rows, columns):
+    '''Print a list of dicts as right-aligned columns, one row per dict. '''
+    widths = [max(len(col), *(len(f'{row[col]}') for row in rows)) for col in columns]
+    print('  '.join(col.rjust(width) for col, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(f'{row[col]}'.rjust(width) for col, width in zip(columns, widths)))
+
+
+def corpus_bleu(hypotheses, references):
+    # Same scorer as the Fairseq pipeline. Imported here because only the benchmarks need it
+    import sacrebleu
+    return sacrebleu.corpus_bleu(hypotheses, [references]).score
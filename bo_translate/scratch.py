@@ -0,0 +1,567 @@
+# =======================================
+##### Backend: the transformer from scratch
+# =======================================
+
+'''
+# MyTransformer and its checkpoint and quantization helpers, defined once here: Transformer_From_Scratch/Scratch.py and
+# Scratch_get_results.py import them. Importing this module reads neither the corpus nor the tokenizers.
+# Translator decodes with a checkpoint written by save_inference_checkpoint(). Needs torch, sentencepiece and safetensors.
+'''
+
+import contextlib
+import json
+import math
+import os
+import time
+from typing import Optional
+
+import sentencepiece as spm
+import torch
+from torch import nn, Tensor
+from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
+
+from bo_translate import max_target_length
+from bo_translate.streaming import detokenize_stream
+
+
+# --------------------------
+#### Model
+# --------------------------
+
+class PositionalEncoding(nn.Module):   
+    def __init__(self, hparams): 
+        super(PositionalEncoding, self).__init__()
+        self.dropout = nn.Dropout(p = hparams['dropout'])
+        self.d_model = hparams['d_model']
+        pe = torch.zeros(hparams['max_len'], self.d_model)    # positional encoding 
+        position = torch.arange(0, hparams['max_len']).unsqueeze(1)
+        div_term = torch.exp(
+            torch.arange(0, self.d_model, 2).float() * (
+                -math.log(10000.0) / self.d_model
+            )
+        )    # What for? 
+        pe[:, 0::2] = torch.sin(position * div_term)    # even dimensions
+        pe[:, 1::2] = torch.cos(position * div_term)    # odd dimensions
+        pe = pe.unsqueeze(0)    # 1 * max_len * d_model, broadcast over the batch dimension (batch first)
+        self.register_buffer('pe', pe)
+        
+    def forward(self, x): 
+        x = x * math.sqrt(self.d_model)    # What for        
+        x = x + self.pe[:, :x.size(1)]
+        return self.dropout(x)
+
+
+
+class PrunedMultiheadAttention(nn.Module): 
+    '''
+    nn.MultiheadAttention after structured pruning: `num_heads` heads of `head_dim` features, so num_heads * head_dim can be 
+    less than embed_dim. The parameters have the names and layout of nn.MultiheadAttention (in_proj_weight stacks the q, k 
+    and v projections), so the rows and columns of the kept heads are copied over as they are. 
+    PyTorch's fused paths assume num_heads * head_dim == embed_dim; _qkv_same_embed_dim = False makes 
+    nn.TransformerEncoderLayer fall back to calling forward(). 
+    '''
+    batch_first = True
+    _qkv_same_embed_dim = False
+    
+    def __init__(self, embed_dim, num_heads, head_dim, dropout): 
+        super(PrunedMultiheadAttention, self).__init__()
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.head_dim = head_dim
+        self.dropout = dropout
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * num_heads * head_dim, embed_dim))
+        self.in_proj_bias = nn.Parameter(torch.zeros(3 * num_heads * head_dim))
+        self.out_proj = nn.Linear(num_heads * head_dim, embed_dim)
+        
+    def forward(self, query, key, value, key_padding_mask = None, need_weights = False, attn_mask = None, average_attn_weights = True, is_causal = False): 
+        # Same arguments and return value as nn.MultiheadAttention, without the attention weights. Masks are True (or -inf) where hidden 
+        batch_size = query.size(0)
+        w_q, w_k, w_v = self.in_proj_weight.chunk(3)
+        b_q, b_k, b_v = self.in_proj_bias.chunk(3)
+        q, k, v = (
+            F.linear(x, w, b).view(batch_size, -1, self.num_heads, self.head_dim).transpose(1, 2)    # batch_size * num_heads * seq_len * head_dim 
+            for x, w, b in [(query, w_q, b_q), (key, w_k, b_k), (value, w_v, b_v)]
+        )
+        mask = None
+        for hidden in [attn_mask, None if key_padding_mask is None else key_padding_mask[:, None, None, :]]: 
+            if hidden is not None: 
+                if hidden.dtype == torch.bool: 
+                    hidden = torch.zeros(hidden.shape, dtype = q.dtype, device = q.device).masked_fill(hidden, float('-inf'))
+                mask = hidden if mask is None else mask + hidden
+        output = F.scaled_dot_product_attention(
+            q, k, v, attn_mask = mask, dropout_p = self.dropout if self.training else 0.0, is_causal = is_causal and mask is None
+        )
+        output = output.transpose(1, 2).reshape(batch_size, -1, self.num_heads * self.head_dim)
+        return self.out_proj(output), None
+
+
+
+class MyTransformer(nn.Module): 
+    def __init__(self, hparams) -> None: 
+        super(MyTransformer, self).__init__()
+        
+        self.source_embedding = nn.Embedding(
+            hparams['source_vocab_length'], hparams['d_model']
+        )
+        self.pos_encoder = PositionalEncoding(hparams)
+        encoder_layer = nn.TransformerEncoderLayer(
+            hparams['d_model'], hparams['nhead'], 
+            hparams['dim_feedforward'], hparams['dropout'], 
+            hparams['activation'], batch_first = True    # Tensors are batch_size * seq_len * d_model everywhere
+        )
+        encoder_norm = nn.LayerNorm(hparams['d_model'])    # What for? 
+        self.encoder = nn.TransformerEncoder(
+            encoder_layer, hparams['num_encoder_layers'], encoder_norm
+        )
+        
+        self.target_embedding = nn.Embedding(
+            hparams['target_vocab_length'], hparams['d_model']
+        )
+        decoder_layer = nn.TransformerDecoderLayer(
+            hparams['d_model'], hparams['nhead'], 
+            hparams['dim_feedforward'], hparams['dropout'], 
+            hparams['activation'], batch_first = True    # Tensors are batch_size * seq_len * d_model everywhere
+        )
+        decoder_norm = nn.LayerNorm(hparams['d_model'])
+        self.decoder = nn.TransformerDecoder(
+            decoder_layer, hparams['num_decoder_layers'], decoder_norm
+        )
+        
+        self.out = nn.Linear(hparams['d_model'], hparams['target_vocab_length'])   # The original examples wrote nn.Linear(512, target_vocab_length). I suspect this is a typo as hard-coding numbers is not really cool 
+        
+        if hparams.get('pruned_layers'):    # Older saved hparams have no such key 
+            resize_pruned_layers(self, hparams)
+        self._reset_parameters()
+        self.d_model = hparams['d_model']
+        self.nhead = hparams['nhead']
+        # Recompute each layer's activations in backward instead of storing them. Older saved hparams have no such key 
+        self.activation_checkpointing = hparams.get('activation_checkpointing', False)
+        
+        
+    def forward(self, src: Tensor, tgt: Tensor,
+                src_mask: Optional[Tensor] = None, 
+                tgt_mask: Optional[Tensor] = None, 
+                memory_mask: Optional[Tensor] = None, 
+                src_key_padding_mask: Optional[Tensor] = None, 
+                tgt_key_padding_mask: Optional[Tensor] = None, 
+                memory_key_padding_mask: Optional[Tensor] = None
+               ) -> Tensor: 
+        # src: batch_size * len(src), tgt: batch_size * len(tgt)
+        if src.size(0) != tgt.size(0): 
+            raise RuntimeError('The batch number of src and tgt must be equal')
+            
+        memory = self.encode(src, src_mask = src_mask, src_key_padding_mask = src_key_padding_mask)
+        output = self.decode(
+            tgt, memory, tgt_mask = tgt_mask, 
+            memory_mask = memory_mask, 
+            tgt_key_padding_mask = tgt_key_padding_mask, 
+            memory_key_padding_mask = memory_key_padding_mask
+        )
+        return output
+    
+    
+    def encode(self, src: Tensor, 
+               src_mask: Optional[Tensor] = None, 
+               src_key_padding_mask: Optional[Tensor] = None
+              ) -> Tensor: 
+        r'''Run the encoder stack once and return the memory (batch_size * len(src) * d_model). 
+        In eval mode without autograd, nn.TransformerEncoder takes PyTorch's fused fast path, 
+        and padded batches are packed into nested tensors when `src_key_padding_mask` is given. '''
+        src = self.source_embedding(src)
+        src = self.pos_encoder(src)
+        if self.checkpointing_active(): 
+            return self.run_checkpointed(self.encoder, src, src_mask, src_key_padding_mask)
+        return self.encoder(src, mask = src_mask, src_key_padding_mask = src_key_padding_mask)
+    
+    
+    def decode(self, tgt: Tensor, memory: Tensor, 
+               tgt_mask: Optional[Tensor] = None, 
+               memory_mask: Optional[Tensor] = None, 
+               tgt_key_padding_mask: Optional[Tensor] = None, 
+               memory_key_padding_mask: Optional[Tensor] = None
+              ) -> Tensor: 
+        r'''Run the decoder stack over an encoded memory and return logits (batch_size * len(tgt) * target_vocab_length). '''
+        tgt = self.target_embedding(tgt)
+        tgt = self.pos_encoder(tgt)
+        if self.checkpointing_active(): 
+            output = self.run_checkpointed(self.decoder, tgt, memory, tgt_mask, memory_mask, tgt_key_padding_mask, memory_key_padding_mask)
+        else: 
+            output = self.decoder(
+                tgt, memory, tgt_mask = tgt_mask, 
+                memory_mask = memory_mask, 
+                tgt_key_padding_mask = tgt_key_padding_mask, 
+                memory_key_padding_mask = memory_key_padding_mask
+            )
+        output = self.out(output)
+        return output
+    
+    
+    def checkpointing_active(self): 
+        # Only worth it when backward will run. Eval and decoding keep the fused fast path 
+        return self.activation_checkpointing and self.training and torch.is_grad_enabled()
+    
+    
+    def run_checkpointed(self, stack, x, *layer_args): 
+        r'''Run the layers of an nn.TransformerEncoder / nn.TransformerDecoder one by one under activation checkpointing. 
+        Only each layer's input is kept for backward; everything inside the layer (attention weights, the 
+        dim_feedforward-wide hidden activations, dropout masks) is recomputed, trading ~1 extra forward pass for memory. 
+        `layer_args` are passed positionally to every layer, in the order of its forward(). '''
+        for layer in stack.layers: 
+            x = checkpoint(layer, x, *layer_args, use_reentrant = False)
+        if stack.norm is not None: 
+            x = stack.norm(x)
+        return x
+        
+    
+    def _reset_parameters(self): 
+        r'''Initiate parameters in the transformer model'''
+        # How work? 
+        for p in self.parameters(): 
+            if p.dim() > 1: 
+                torch.nn.init.xavier_uniform_(p)
+
+
+def resize_pruned_layers(model, hparams): 
+    '''
+    Rebuild the attention and feedforward blocks of every layer with the sizes in hparams['pruned_layers'], written by 
+    prune_model(): {'encoder': [{'self_attn': heads, 'dim_feedforward': width}, ...], 'decoder': [{'self_attn': heads, 
+    'multihead_attn': heads, 'dim_feedforward': width}, ...]}. Attention blocks that kept all heads stay nn.MultiheadAttention. 
+    '''
+    d_model, nhead = hparams['d_model'], hparams['nhead']
+    for stack, layer_sizes in [(model.encoder, hparams['pruned_layers']['encoder']), (model.decoder, hparams['pruned_layers']['decoder'])]: 
+        for layer, sizes in zip(stack.layers, layer_sizes): 
+            for name in ['self_attn', 'multihead_attn']: 
+                if name in sizes and sizes[name] < nhead: 
+                    setattr(layer, name, PrunedMultiheadAttention(d_model, sizes[name], d_model // nhead, hparams['dropout']))
+            layer.linear1 = nn.Linear(d_model, sizes['dim_feedforward'])
+            layer.linear2 = nn.Linear(sizes['dim_feedforward'], d_model)
+    if any(isinstance(layer.self_attn, PrunedMultiheadAttention) for layer in model.encoder.layers): 
+        model.encoder.use_nested_tensor = False    # Nested tensors need the fast path in every layer 
+
+
+def generate_np_mask(size, device): 
+    '''
+    # Causal ("no peeking") mask for the decoder self-attention, like Fig.3(b) in the T5 paper. 
+    # True --> the position is hidden, i.e. token i can only attend to tokens 0..i 
+    # Boolean like the key padding masks, so PyTorch does not have to merge a float mask with a bool mask 
+    '''
+    return torch.triu(torch.ones(size, size, dtype = torch.bool, device = device), diagonal = 1)
+
+
+def convert_seq_first_state_dict(state_dict): 
+    '''
+    Convert a state_dict saved by the sequence-first MyTransformer (e.g. Scratch_checkpoint_best_epoch=34.pt) to the batch-first layout. 
+    The attention, feedforward and embedding weights have the same shapes in both layouts. 
+    Only the positional encoding buffer changes from max_len * 1 * d_model to 1 * max_len * d_model. 
+    State dicts that are already batch first are returned unchanged. 
+    '''
+    state_dict = dict(state_dict)
+    pe = state_dict['pos_encoder.pe']
+    if pe.dim() == 3 and pe.size(1) == 1 and pe.size(0) != 1: 
+        state_dict['pos_encoder.pe'] = pe.transpose(0, 1).contiguous()
+    return state_dict
+
+
+@contextlib.contextmanager
+def bf16_autocast(enabled, device_type): 
+    '''
+    Run the block under bf16 autocast when `enabled`: matmuls run in bf16 while the weights stay fp32. 
+    PyTorch's fused encoder fast path only checks for CUDA autocast and fails on bf16 inputs under CPU autocast, 
+    so the fast path is switched off inside the block. 
+    '''
+    if not enabled: 
+        yield
+        return
+    fastpath_enabled = torch.backends.mha.get_fastpath_enabled()
+    torch.backends.mha.set_fastpath_enabled(False)
+    try: 
+        with torch.autocast(device_type = device_type, dtype = torch.bfloat16): 
+            yield
+    finally: 
+        torch.backends.mha.set_fastpath_enabled(fastpath_enabled)
+
+
+'''
+# Post-training dynamic int8 quantization for CPU inference
+# Weights are stored as int8 and activations are quantized on the fly, so no calibration data is needed 
+'''
+
+def quantize_dynamic_int8(model): 
+    '''
+    Return an int8 copy of `model` on the CPU. Only the nn.Linear layers that run once per generated token are quantized: 
+    the decoder feedforward layers and the output projection (the largest matmul, d_model * target_vocab_length). 
+    The encoder runs once per sentence and keeps fp32 weights, because PyTorch's fused encoder fast path does not accept quantized layers. 
+    nn.MultiheadAttention projections are not plain nn.Linear layers and stay fp32 for the same reason. 
+    '''
+    qconfig_spec = {
+        name: torch.ao.quantization.default_dynamic_qconfig 
+        for name, module in model.named_modules() 
+        if type(module) is nn.Linear and not name.startswith('encoder.')
+    }
+    return torch.ao.quantization.quantize_dynamic(model.to('cpu').eval(), qconfig_spec, dtype = torch.qint8)
+
+
+def save_quantized_model(model, hparams, path): 
+    '''Save an int8 model together with the hparams needed to rebuild it. '''
+    torch.save({'hparams': hparams, 'state_dict': model.state_dict()}, path)
+
+
+def load_quantized_model(path): 
+    '''Load an artifact written by save_quantized_model(), no fp32 checkpoint needed. CPU only. '''
+    artifact = torch.load(path, map_location = 'cpu')
+    model = quantize_dynamic_int8(MyTransformer(artifact['hparams']))
+    model.load_state_dict(artifact['state_dict'])
+    return model
+
+
+def save_inference_checkpoint(model, hparams, path, tokenizer_paths, dtype = torch.float32): 
+    '''
+    Save everything inference needs in one safetensors file: the weights (floating point ones stored in `dtype`, 
+    fp32 or bf16 to halve the file), and as metadata the hparams to build the model and the tokenizer paths 
+    (`tokenizer_paths`: source, target), relative to the checkpoint so the folder can be moved as a whole. 
+    '''
+    from safetensors.torch import save_file    # Imported here because only inference checkpoints need it
+    srcTokenizerPath, tgtTokenizerPath = tokenizer_paths
+    directory = os.path.dirname(os.path.abspath(path))
+    tensors = {name: (tensor.to(dtype) if tensor.is_floating_point() else tensor).contiguous() for name, tensor in model.state_dict().items()}
+    save_file(tensors, path, metadata = {
+        'format': 'Scratch-inference', 
+        'hparams': json.dumps(hparams), 
+        'srcTokenizer': os.path.relpath(srcTokenizerPath, directory), 
+        'tgtTokenizer': os.path.relpath(tgtTokenizerPath, directory), 
+    })
+
+
+@contextlib.contextmanager
+def skip_weight_init(): 
+    '''
+    Turn the nn.init functions into no-ops while building a model whose weights are loaded right after. 
+    (Building on the meta device would avoid the allocations too, but its first use imports torch._refs, which costs more.) 
+    '''
+    names = ['uniform_', 'normal_', 'constant_', 'zeros_', 'ones_', 'xavier_uniform_', 'xavier_normal_', 'kaiming_uniform_', 'kaiming_normal_']
+    init_functions = {name: getattr(nn.init, name) for name in names}
+    for name in names: 
+        setattr(nn.init, name, lambda tensor, *args, **kwargs: tensor)
+    try: 
+        yield
+    finally: 
+        for name, function in init_functions.items(): 
+            setattr(nn.init, name, function)
+
+
+def load_inference_checkpoint(path, device, dtype = torch.float32): 
+    '''
+    Load a checkpoint written by save_inference_checkpoint() in a single pass, fully offline. The model is built without 
+    initializing its weights and then takes over the tensors, which are memory-mapped from the file on CPU. 
+    Weights are cast to `dtype`, or kept as stored with dtype = None. 
+    Return the model in eval mode and the source and target tokenizer paths. 
+    '''
+    from safetensors import safe_open
+    with safe_open(path, framework = 'pt', device = str(device)) as f: 
+        metadata = f.metadata()
+        tensors = {name: f.get_tensor(name) for name in f.keys()}
+    if metadata.get('format') != 'Scratch-inference': 
+        raise ValueError(f'{path} is not a checkpoint written by save_inference_checkpoint()')
+    if dtype is not None: 
+        tensors = {name: tensor.to(dtype) if tensor.is_floating_point() else tensor for name, tensor in tensors.items()}
+    
+    with skip_weight_init(): 
+        model = MyTransformer(json.loads(metadata['hparams']))
+    model.load_state_dict(tensors, assign = True)
+    
+    directory = os.path.dirname(os.path.abspath(path))
+    return model.eval(), os.path.normpath(os.path.join(directory, metadata['srcTokenizer'])), os.path.normpath(os.path.join(directory, metadata['tgtTokenizer']))
+
+
+# --------------------------
+#### Decoding
+# --------------------------
+
+def greedy_decode_batch(model, src_batch, src_pad_id, tgt_bos_id, tgt_eos_id, max_len = 100, max_lens = None, deadline = None): 
+    '''
+    Greedy decoding of several sentences at once. `src_batch` is a list of source token id lists, padded here 
+    and masked with src_key_padding_mask / memory_key_padding_mask. Every step decodes all unfinished sentences 
+    as one batch; a sentence that generated </s> or reached its length (`max_lens`, one per sentence, default max_len) 
+    keeps getting </s> until the longest one is done. Past `deadline` (time.monotonic()) decoding stops after the 
+    current step and every sentence keeps what it has so far. 
+    Return the generated ids of each sentence, </s> excluded, and whether each was truncated, i.e. stopped before </s>. 
+    '''
+    model_device = next(model.parameters()).device
+    width = max(len(ids) for ids in src_batch)
+    src = torch.LongTensor([ids + [src_pad_id] * (width - len(ids)) for ids in src_batch]).to(model_device)    # batch_size * len(src)
+    src_key_padding_mask = src == src_pad_id
+    tgt = torch.full((len(src_batch), 1), tgt_bos_id, dtype = torch.long, device = model_device)    # batch_size * len(tgt)
+    limits = torch.tensor(max_lens or [max_len] * len(src_batch), device = model_device)
+    finished = torch.zeros(len(src_batch), dtype = torch.bool, device = model_device)    # generated </s> 
+    stopped = torch.zeros(len(src_batch), dtype = torch.bool, device = model_device)    # finished or at its length limit 
+    
+    with torch.inference_mode(): 
+        memory = model.encode(src, src_key_padding_mask = src_key_padding_mask)
+        for i in range(int(limits.max())): 
+            pred = model.decode(
+                tgt, memory, tgt_mask = generate_np_mask(tgt.size(1), model_device), 
+                memory_key_padding_mask = src_key_padding_mask
+            )
+            next_ids = pred[:, -1].argmax(dim = -1).masked_fill(stopped, tgt_eos_id)
+            tgt = torch.cat((tgt, next_ids.unsqueeze(1)), dim = 1)
+            finished |= (next_ids == tgt_eos_id) & ~stopped
+            stopped |= finished | (limits <= i + 1)
+            if stopped.all() or (deadline is not None and time.monotonic() >= deadline): 
+                break 
+    
+    generated = []
+    for ids in tgt[:, 1:].tolist(): 
+        generated.append(ids[:ids.index(tgt_eos_id)] if tgt_eos_id in ids else ids)
+    return generated, [not done for done in finished.tolist()]
+
+
+def greedy_decode_stream(model, src_ids, tgt_bos_id, tgt_eos_id, max_len = 100, deadline = None): 
+    '''
+    Greedy decoding of one sentence as a generator: yields each token id as soon as it is chosen, </s> excluded, 
+    and returns whether the translation was truncated (max_len or `deadline` reached before </s>). 
+    Inference mode is entered per step rather than around the loop, so it never leaks into the consumer between tokens. 
+    '''
+    model_device = next(model.parameters()).device
+    src = torch.LongTensor([src_ids]).to(model_device)    # 1 * len(src)
+    tgt = torch.LongTensor([[tgt_bos_id]]).to(model_device)    # 1 * len(tgt)
+    with torch.inference_mode(): 
+        memory = model.encode(src)
+    for i in range(max_len): 
+        with torch.inference_mode(): 
+            pred = model.decode(tgt, memory, tgt_mask = generate_np_mask(tgt.size(1), model_device))
+            generated_id = pred[0, -1].argmax().item()
+            tgt = torch.cat((tgt, torch.LongTensor([[generated_id]]).to(model_device)), dim = 1)
+        if generated_id == tgt_eos_id: 
+            return False
+        yield generated_id
+        if deadline is not None and time.monotonic() >= deadline: 
+            return True
+    return True
+
+
+def beam_decode_ids(model, src_ids, tgt_bos_id, tgt_eos_id, num_beams = 4, max_len = 100, length_penalty = 0.6, deadline = None): 
+    '''
+    Beam search. All live beams are decoded together as one batch against the same encoder memory. 
+    Finished hypotheses are ranked by sum(log prob) / len ** length_penalty, and the search stops 
+    once `num_beams` hypotheses are finished (like `early_stopping = True` in T5's generate()), 
+    or after the step during which `deadline` (time.monotonic()) passed. 
+    The best hypothesis ends with </s> unless none finished, in which case it is the best live beam, truncated. 
+    '''
+    model.eval()
+    model_device = next(model.parameters()).device
+    src = torch.LongTensor([src_ids]).to(model_device)    # 1 * len(src)
+    tgt = torch.LongTensor([[tgt_bos_id]]).to(model_device)    # num_live_beams * len(tgt)
+    beam_scores = torch.zeros(1, device = model_device)    # Summed log probs of each live beam 
+    finished = []    # (normalized score, token ids) of hypotheses that generated </s> 
+    
+    with torch.inference_mode(): 
+        memory = model.encode(src)
+        
+        for i in range(max_len): 
+            np_mask = generate_np_mask(tgt.size(1), model_device)
+            pred = model.decode(tgt, memory.expand(tgt.size(0), -1, -1), tgt_mask = np_mask)
+            log_probs = F.log_softmax(pred[:, -1].float(), dim = -1)    # num_live_beams * vocab
+            vocab_size = log_probs.size(1)
+            
+            # Take 2 * num_beams candidates so that enough beams survive even if some of them end with </s> 
+            candidate_scores, candidate_idx = (beam_scores.unsqueeze(1) + log_probs).view(-1).topk(2 * num_beams)
+            next_tgt, next_scores = [], []
+            for score, idx in zip(candidate_scores.tolist(), candidate_idx.tolist()): 
+                beam, token = idx // vocab_size, idx % vocab_size
+                if token == tgt_eos_id: 
+                    finished.append((score / (i + 1) ** length_penalty, tgt[beam, 1:].tolist() + [token]))
+                else: 
+                    next_tgt.append(torch.cat((tgt[beam], torch.LongTensor([token]).to(model_device))))
+                    next_scores.append(score)
+                if len(next_tgt) == num_beams: 
+                    break 
+            
+            if len(finished) >= num_beams: 
+                break 
+            tgt = torch.stack(next_tgt)
+            beam_scores = torch.tensor(next_scores, device = model_device)
+            if deadline is not None and time.monotonic() >= deadline: 
+                break 
+    
+    # Fall back to the live beams if nothing finished within max_len steps or before the deadline 
+    if not finished: 
+        finished = [(score / (tgt.size(1) - 1) ** length_penalty, tgt[beam, 1:].tolist()) for beam, score in enumerate(beam_scores.tolist())]
+    return max(finished, key = lambda hypothesis: hypothesis[0])[1]
+
+
+# --------------------------
+#### Translator
+# --------------------------
+
+class Translator: 
+    '''Translate Tibetan sentences with a MyTransformer inference checkpoint. '''
+    def __init__(self, path, device = None): 
+        self.device = torch.device(device or ('cuda:0' if torch.cuda.is_available() else 'cpu'))
+        self.model, srcTokenizerPath, tgtTokenizerPath = load_inference_checkpoint(path, self.device)
+        self.srcTokenizer = spm.SentencePieceProcessor(model_file = srcTokenizerPath)
+        self.tgtTokenizer = spm.SentencePieceProcessor(model_file = tgtTokenizerPath)
+        self.src_pad_id = self.srcTokenizer.piece_to_id('<pad>')
+        self.tgt_bos_id = self.tgtTokenizer.piece_to_id('<s>')
+        self.tgt_eos_id = self.tgtTokenizer.piece_to_id('</s>')
+    
+    
+    def source_lengths(self, texts): 
+        '''Number of source tokens of each sentence. '''
+        return [len(ids) for ids in self.srcTokenizer.encode(list(texts))]
+    
+    
+    def translate(self, texts, *args, **options): 
+        '''Translate a list of sentences, see translate_detailed(). '''
+        return self.translate_detailed(texts, *args, **options)[0]
+    
+    
+    def translate_detailed(self, texts, num_beams = 1, max_len = 100, length_penalty = 0.6, max_len_a = None, max_len_b = 10, deadline = None): 
+        '''
+        Translate a list of sentences. num_beams = 1 decodes them greedily as one batch, 
+        num_beams > 1 runs beam search one sentence at a time. Empty sentences translate to ''. 
+        Each sentence gets at most max_target_length(len(src), max_len, max_len_a, max_len_b) tokens, and decoding 
+        stops after the step during which `deadline` (time.monotonic()) passed, keeping the best hypotheses so far. 
+        Beam search sentences not started by the deadline translate to ''. 
+        Return the translations and, for each, whether it was truncated (cut off before </s>). 
+        '''
+        src_batch = [self.srcTokenizer.encode(text) for text in texts]
+        translations = [''] * len(texts)
+        truncated = [False] * len(texts)
+        todo = [i for i, ids in enumerate(src_batch) if ids]
+        if not todo: 
+            return translations, truncated
+        
+        max_lens = [max_target_length(len(src_batch[i]), max_len, max_len_a, max_len_b) for i in todo]
+        if num_beams == 1: 
+            generated, cut = greedy_decode_batch(
+                self.model, [src_batch[i] for i in todo], self.src_pad_id, self.tgt_bos_id, self.tgt_eos_id, max_len, max_lens, deadline
+            )
+        else: 
+            generated = [
+                [] if deadline is not None and time.monotonic() >= deadline else    # no time left to start this sentence 
+                beam_decode_ids(self.model, src_batch[i], self.tgt_bos_id, self.tgt_eos_id, num_beams, limit, length_penalty, deadline) 
+                for i, limit in zip(todo, max_lens)
+            ]
+            cut = [not ids or ids[-1] != self.tgt_eos_id for ids in generated]
+        for i, ids, was_cut in zip(todo, generated, cut): 
+            translations[i] = self.tgtTokenizer.decode(ids)
+            truncated[i] = was_cut
+        return translations, truncated
+    
+    
+    def translate_stream(self, text, num_beams = 1, max_len = 100, length_penalty = 0.6, max_len_a = None, max_len_b = 10, deadline = None): 
+        '''
+        Translate one sentence, yielding the translation in chunks as it is generated; the chunks join up to 
+        translate([text])[0]. Beam search only knows the best hypothesis at the end, so num_beams > 1 yields it once. 
+        Returns whether the translation was truncated, like translate_detailed(). 
+        '''
+        src_ids = self.srcTokenizer.encode(text)
+        if not src_ids: 
+            return False
+        if num_beams > 1: 
+            translations, truncated = self.translate_detailed([text], num_beams, max_len, length_penalty, max_len_a, max_len_b, deadline)
+            yield translations[0]
+            return truncated[0]
+        limit = max_target_length(len(src_ids), max_len, max_len_a, max_len_b)
+        return (yield from detokenize_stream(self.tgtTokenizer, greedy_decode_stream(self.model, src_ids, self.tgt_bos_id, self.tgt_eos_id, limit, deadline)))
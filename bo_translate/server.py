@@ -0,0 +1,426 @@
+'''
+# HTTP/JSON translation server with micro-batching, e.g. from the repository root
+#   python -m bo_translate.server Transformer_From_Scratch/Scratch_inference.safetensors --port 8000
+#   curl -d '{"text": "བཀྲ་ཤིས་བདེ་ལེགས།"}' http://127.0.0.1:8000/translate
+#
+# POST /translate   {"text": "..."} or {"texts": [...]}, optionally "num_beams", "max_len", "max_len_a", "max_len_b"
+#                   and "deadline_ms" --> {"translation": "...", "truncated": false} or {"translations": [...], "truncated": [...]}
+#                   {"text": "...", "stream": true} --> chunked NDJSON, {"text": chunk} lines as the tokens are generated
+#                   and a last {"done": true, "translation": ..., "truncated": ..., "time_to_first_token_ms": ...} line.
+#                   Greedy decoding streams token by token, beam search sends the translation in one chunk (pass
+#                   "num_beams": 1 for T5).
+# GET  /health      --> {"status": "ok", ...}
+# GET  /metrics     --> request, batch and latency counters, plus cache and translation memory hit rates when enabled
+#
+# Each sentence is queued on its own. The batcher waits up to --max-wait-ms after the first queued sentence for more,
+# sorts what it collected by length and translates it in batches of up to --max-batch-size on one worker thread,
+# so the event loop keeps accepting requests while the model runs. Sentences only share a batch when their decoding
+# options match. --max-batch-size 1 --max-wait-ms 0 gives the old one-sentence-at-a-time behaviour.
+#
+# "deadline_ms" (default --deadline-ms) is a latency budget counted from the moment the sentence is queued: decoding
+# stops at the first step boundary past it and answers with the best hypothesis so far, flagged "truncated". A batch
+# stops at the earliest deadline of its sentences. "max_len_a" / "max_len_b" (default --max-len-a / --max-len-b) cap
+# each translation at max_len_a * source tokens + max_len_b, so a degenerate repeating output ends early too.
+'''
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import time
+
+from bo_translate import load_translator, read_checkpoint_metadata
+from bo_translate.cache import add_cache_arguments, cached_from_arguments
+from bo_translate.reporting import percentile
+from bo_translate.streaming import stream_translation
+from bo_translate.translation_memory import add_memory_arguments, memory_from_arguments
+
+
+# --------------------------
+#### Micro-batching
+# --------------------------
+
+class MicroBatcher:
+    '''
+    Coalesce single-sentence requests into length-sorted batches for translator.translate().
+    Sentences arriving within max_wait_ms of the first queued one (or while the previous batch runs) are collected,
+    up to max_pending of them, grouped by decoding options, sorted by source length in tokens and cut into batches of max_batch_size.
+    '''
+    def __init__(self, translator, max_batch_size = 32, max_wait_ms = 10, max_pending = None, latency_window = 1000):
+        self.translator = translator
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_pending = max_pending or 4 * max_batch_size
+        self.queue = asyncio.Queue()
+        self.worker = concurrent.futures.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'translate')    # one model, one thread
+        self.started = time.time()
+        self.stats = collections.Counter()
+        self.batch_sizes = collections.Counter()
+        self.latencies = collections.deque(maxlen = latency_window)    # seconds from queued to translated, most recent sentences
+        self.first_chunk_latencies = collections.deque(maxlen = latency_window)    # seconds to the first chunk, streamed requests
+
+
+    async def translate(self, text, options):
+        '''Queue one sentence and wait for its translation and whether it was truncated. '''
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((time.perf_counter(), text, options, future))
+        return await future
+
+
+    async def collect(self):
+        '''Wait for the first sentence, then gather more until the wait window closes or max_pending are queued. '''
+        pending = [await self.queue.get()]
+        deadline = pending[0][0] + self.max_wait
+        while len(pending) < self.max_pending:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0 or self.max_batch_size == 1:
+                break
+            try:
+                pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        while len(pending) < self.max_pending and not self.queue.empty():
+            pending.append(self.queue.get_nowait())    # sentences that queued up while the previous batch ran
+        return pending
+
+
+    def batches(self, pending):
+        '''
+        Group by decoding options, sort each group by source length in tokens, which is what padding costs, and cut it
+        into batches. Tokenizing a few hundred sentences takes well under a millisecond, so it runs on the event loop.
+        '''
+        groups = collections.defaultdict(list)
+        for item in pending:
+            groups[tuple(sorted(item[2].items()))].append(item)
+        for items in groups.values():
+            lengths = self.translator.source_lengths([item[1] for item in items])
+            items = [items[i] for i in sorted(range(len(items)), key = lambda i: lengths[i])]
+            for start in range(0, len(items), self.max_batch_size):
+                yield items[start : start + self.max_batch_size]
+
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = await self.collect()
+            for batch in self.batches(pending):
+                batch = [item for item in batch if not item[3].cancelled()]    # the client went away
+                if not batch:
+                    continue
+                texts = [item[1] for item in batch]
+                options = dict(batch[0][2])
+                start = time.perf_counter()
+                budget = options.pop('deadline_ms', None)
+                if budget is not None:    # the earliest deadline of the batch, on the clock the translators use
+                    options['deadline'] = time.monotonic() + min(item[0] for item in batch) + budget / 1000 - start
+                try:
+                    translations, truncated = await loop.run_in_executor(self.worker, lambda: self.translator.translate_detailed(texts, **options))
+                except Exception as error:
+                    self.stats['failed_batches'] += 1
+                    for item in batch:
+                        if not item[3].done():
+                            item[3].set_exception(error)
+                    continue
+                end = time.perf_counter()
+                self.stats['batches'] += 1
+                self.stats['sentences'] += len(batch)
+                self.stats['truncated'] += sum(truncated)
+                self.stats['busy_seconds'] += end - start
+                self.batch_sizes[len(batch)] += 1
+                for item, translation, was_cut in zip(batch, translations, truncated):
+                    self.latencies.append(end - item[0])
+                    if not item[3].done():
+                        item[3].set_result((translation, was_cut))
+
+
+    def metrics(self):
+        latencies = list(self.latencies)
+        first_chunk_latencies = list(self.first_chunk_latencies)
+        uptime = time.time() - self.started
+        return dict(
+            uptime_seconds = round(uptime, 3),
+            requests = self.stats['requests'],
+            failed_requests = self.stats['failed_requests'],
+            sentences = self.stats['sentences'],
+            truncated = self.stats['truncated'],
+            batches = self.stats['batches'],
+            failed_batches = self.stats['failed_batches'],
+            mean_batch_size = round(self.stats['sentences'] / self.stats['batches'], 3) if self.stats['batches'] else None,
+            batch_sizes = {str(size): count for size, count in sorted(self.batch_sizes.items())},
+            queue_depth = self.queue.qsize(),
+            worker_busy_fraction = round(self.stats['busy_seconds'] / uptime, 3) if uptime else None,
+            latency_ms = {f'p{q}': None if percentile(latencies, q) is None else round(1000 * percentile(latencies, q), 2) for q in (50, 95, 99)},
+            streams = self.stats['streams'],
+            time_to_first_token_ms = {
+                f'p{q}': None if percentile(first_chunk_latencies, q) is None else round(1000 * percentile(first_chunk_latencies, q), 2) for q in (50, 95, 99)
+            },
+            max_batch_size = self.max_batch_size,
+            max_wait_ms = 1000 * self.max_wait,
+        )
+
+
+# --------------------------
+#### HTTP
+# --------------------------
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+MAX_BODY_BYTES = 1 << 20
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+async def read_request(reader):
+    '''Parse one HTTP/1.1 request. Return (method, path, body bytes, keep-alive), or None once the client closed the connection. '''
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, target, _ = request_line.decode('latin-1').split(' ', 2)
+    except ValueError:
+        raise HTTPError(400, 'malformed request line')
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0) or 0)
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(413, f'request body over {MAX_BODY_BYTES} bytes')
+    body = await reader.readexactly(length) if length else b''
+    return method.upper(), target.split('?', 1)[0], body, headers.get('connection', '').lower() != 'close'
+
+
+def write_response(writer, status, payload, keep_alive):
+    body = json.dumps(payload, ensure_ascii = False).encode('utf-8')
+    head = (
+        f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+        f'Content-Type: application/json; charset=utf-8\r\n'
+        f'Content-Length: {len(body)}\r\n'
+        f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'
+    )
+    writer.write(head.encode('latin-1') + body)
+
+
+def write_stream_head(writer, keep_alive):
+    writer.write((
+        f'HTTP/1.1 200 OK\r\n'
+        f'Content-Type: application/x-ndjson; charset=utf-8\r\n'
+        f'Transfer-Encoding: chunked\r\n'
+        f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'
+    ).encode('latin-1'))
+
+
+def write_stream_line(writer, payload):
+    '''One json line as one HTTP chunk. '''
+    line = json.dumps(payload, ensure_ascii = False).encode('utf-8') + b'\n'
+    writer.write(f'{len(line):x}\r\n'.encode('latin-1') + line + b'\r\n')
+
+
+def next_chunk(chunks):
+    '''(False, the next chunk), or (True, whether the translation was truncated) once the stream has ended. '''
+    try:
+        return False, next(chunks)
+    except StopIteration as stop:
+        return True, bool(stop.value)
+
+
+class TranslationServer:
+    def __init__(self, translator, checkpoint, default_options, **batcher_options):
+        self.batcher = MicroBatcher(translator, **batcher_options)
+        self.checkpoint = checkpoint
+        self.checkpoint_format = read_checkpoint_metadata(checkpoint).get('format')
+        self.default_options = default_options
+
+
+    def parse_translate_request(self, body):
+        '''Validate a /translate body. Return it with the sentences and the decoding options. '''
+        try:
+            request = json.loads(body or b'{}')
+        except ValueError:
+            raise HTTPError(400, 'body is not json')
+        if not isinstance(request, dict) or ('text' in request) == ('texts' in request):
+            raise HTTPError(400, 'expected {"text": "..."} or {"texts": [...]}')
+        texts = [request['text']] if 'text' in request else request['texts']
+        if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+            raise HTTPError(400, 'texts must be strings')
+        options = dict(self.default_options)
+        for name in ('num_beams', 'max_len'):
+            if name in request:
+                if not isinstance(request[name], int) or request[name] < 1:
+                    raise HTTPError(400, f'{name} must be a positive integer')
+                options[name] = request[name]
+        for name in ('max_len_a', 'max_len_b', 'deadline_ms'):
+            if name in request:
+                if not isinstance(request[name], (int, float)) or isinstance(request[name], bool) or request[name] < 0:
+                    raise HTTPError(400, f'{name} must be a non-negative number')
+                options[name] = request[name]
+        if 'max_len_b' in options and 'max_len_a' not in options:
+            options['max_len_a'] = 0
+        if request.get('stream') and 'text' not in request:
+            raise HTTPError(400, 'only {"text": "...", "stream": true} can be streamed')
+        return request, texts, options
+
+
+    async def translate(self, request, texts, options):
+        self.batcher.stats['requests'] += 1
+        results = await asyncio.gather(*(self.batcher.translate(text.strip(), options) for text in texts))
+        translations, truncated = [translation for translation, _ in results], [was_cut for _, was_cut in results]
+        if 'text' in request:
+            return {'translation': translations[0], 'truncated': truncated[0]}
+        return {'translations': translations, 'truncated': truncated}
+
+
+    async def stream(self, writer, text, options, keep_alive):
+        '''
+        Send the translation as it is generated, as chunked NDJSON: {"text": chunk} lines, then
+        {"done": true, "translation": ..., "truncated": ..., "time_to_first_token_ms": ..., "total_ms": ...} or {"error": ...}.
+        Each decoding step runs on the worker thread, in turn with the batches, so the model stays single-threaded.
+        '''
+        loop = asyncio.get_running_loop()
+        self.batcher.stats['requests'] += 1
+        self.batcher.stats['streams'] += 1
+        write_stream_head(writer, keep_alive)
+        start = time.perf_counter()
+        first_chunk = None
+        options = dict(options)
+        budget = options.pop('deadline_ms', None)
+        if budget is not None:
+            options['deadline'] = time.monotonic() + budget / 1000
+        chunks = stream_translation(self.batcher.translator, text.strip(), options)
+        parts = []
+        try:
+            while True:
+                ended, chunk = await loop.run_in_executor(self.batcher.worker, next_chunk, chunks)
+                if ended:
+                    truncated = chunk
+                    break
+                if first_chunk is None:
+                    first_chunk = time.perf_counter() - start
+                parts.append(chunk)
+                write_stream_line(writer, {'text': chunk})
+                await writer.drain()
+            total = time.perf_counter() - start
+            first_chunk = total if first_chunk is None else first_chunk
+            self.batcher.first_chunk_latencies.append(first_chunk)
+            self.batcher.stats['truncated'] += truncated
+            write_stream_line(writer, {
+                'done': True, 'translation': ''.join(parts), 'truncated': truncated,
+                'time_to_first_token_ms': round(1000 * first_chunk, 2), 'total_ms': round(1000 * total, 2),
+            })
+        except ConnectionError:
+            raise
+        except Exception as error:
+            self.batcher.stats['failed_requests'] += 1
+            write_stream_line(writer, {'error': f'{type(error).__name__}: {error}'})
+        finally:
+            await loop.run_in_executor(self.batcher.worker, chunks.close)
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                keep_alive, path = False, None
+                try:
+                    request = await read_request(reader)
+                    if request is None:
+                        break
+                    method, path, body, keep_alive = request
+                    if path == '/translate':
+                        if method != 'POST':
+                            raise HTTPError(405, 'use POST')
+                        request, texts, options = self.parse_translate_request(body)
+                        if request.get('stream'):
+                            await self.stream(writer, texts[0], options, keep_alive)
+                            if keep_alive:
+                                continue
+                            break
+                        status, payload = 200, await self.translate(request, texts, options)
+                    elif path == '/health':
+                        status, payload = 200, {'status': 'ok', 'checkpoint': self.checkpoint, 'format': self.checkpoint_format}
+                    elif path == '/metrics':
+                        status, payload = 200, self.batcher.metrics()
+                        if hasattr(self.batcher.translator, 'metrics'):
+                            payload['lookups'] = self.batcher.translator.metrics()
+                    else:
+                        raise HTTPError(404, f'no endpoint {path}')
+                except HTTPError as error:
+                    status, payload = error.status, {'error': str(error)}
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except Exception as error:
+                    status, payload = 500, {'error': f'{type(error).__name__}: {error}'}
+                if status != 200 and path == '/translate':
+                    self.batcher.stats['failed_requests'] += 1
+                write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+    async def serve(self, host, port):
+        batcher = asyncio.create_task(self.batcher.run())
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f'Serving {self.checkpoint} ({self.checkpoint_format}) on http://{host}:{port} '
+              f'with max_batch_size = {self.batcher.max_batch_size}, max_wait_ms = {1000 * self.batcher.max_wait:g}', flush = True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.batcher.worker.shutdown(wait = False)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog = 'python -m bo_translate.server', description = 'HTTP/JSON translation server with micro-batching')
+    parser.add_argument('checkpoint', help = 'inference checkpoint (*.safetensors) written by save_inference_checkpoint()')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8000)
+    parser.add_argument('--max-batch-size', type = int, default = 32)
+    parser.add_argument('--max-wait-ms', type = float, default = 10, help = 'how long the first queued sentence waits for others')
+    parser.add_argument('--num-beams', type = int, default = None, help = 'default: greedy for Scratch, 4 for T5')
+    parser.add_argument('--max-len', type = int, default = 100)
+    parser.add_argument('--max-len-a', type = float, default = None, help = 'cap translations at max_len_a * source tokens + max_len_b')
+    parser.add_argument('--max-len-b', type = int, default = 10)
+    parser.add_argument('--deadline-ms', type = float, default = None, help = 'default latency budget per sentence, from queueing to answer')
+    parser.add_argument('--device', default = None)
+    parser.add_argument('--compile', choices = ['torchscript', 'inductor'], default = None, help = 'run greedy decoding of a Scratch checkpoint compiled')
+    parser.add_argument('--compile-cache', default = None, help = 'directory that keeps the compiled buckets across starts')
+    add_cache_arguments(parser)
+    add_memory_arguments(parser)
+    args = parser.parse_args()
+
+    translator = load_translator(args.checkpoint, args.device)
+    if args.compile:
+        from bo_translate.compiled import compiled_from_arguments    # Imported here because it needs torch, which ONNX checkpoints do without
+        translator = compiled_from_arguments(translator, args.checkpoint, args)
+    translator = cached_from_arguments(memory_from_arguments(translator, args), args.checkpoint, args)
+    default_options = dict(max_len = args.max_len)
+    if args.num_beams is not None:
+        default_options['num_beams'] = args.num_beams
+    if args.max_len_a is not None:
+        default_options.update(max_len_a = args.max_len_a, max_len_b = args.max_len_b)
+    if args.deadline_ms is not None:
+        default_options['deadline_ms'] = args.deadline_ms
+    server = TranslationServer(translator, args.checkpoint, default_options, max_batch_size = args.max_batch_size, max_wait_ms = args.max_wait_ms)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
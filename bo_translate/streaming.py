@@ -0,0 +1,98 @@
+'''
+# Incremental detokenization for token-by-token output.
+#
+# Decoding token by token (tokenizer.decode([id]) per token) gets word boundaries wrong: the '▁' that starts a
+# SentencePiece word becomes a space only between words, and a character split into byte pieces (<0xE0><0xBD>...) only
+# decodes once all of its bytes are there. IncrementalDetokenizer emits what each new token adds to the decoded text,
+# so the chunks always join up to tokenizer.decode(all ids).
+'''
+
+import time
+
+
+class IncrementalDetokenizer:
+    '''
+    Feed token ids with add(), which returns the text they add ('' while a character is incomplete). After the last
+    token, flush() returns anything held back. `tokenizer` needs decode(list of ids) -> str, like SentencePieceProcessor.
+    Every add() decodes all ids so far: for sentence-length outputs this costs microseconds next to a decoder step, and
+    unlike decoding a window of recent tokens it cannot misplace the space of a lone '▁' piece.
+    '''
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.ids = []
+        self.emitted = ''
+
+
+    def add(self, token_id):
+        self.ids.append(token_id)
+        text = self.tokenizer.decode(self.ids)
+        if text.endswith('\ufffd'):
+            return ''    # an incomplete UTF-8 sequence, wait for its remaining bytes
+        return self.take(text)
+
+
+    def flush(self):
+        return self.take(self.tokenizer.decode(self.ids))
+
+
+    def take(self, text):
+        chunk = text[len(self.emitted) :] if text.startswith(self.emitted) else ''
+        if chunk:
+            self.emitted = text
+        return chunk
+
+
+def detokenize_stream(tokenizer, token_ids):
+    '''Turn an iterable of token ids into an iterator of non-empty text chunks. Return what the token ids generator returns. '''
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    token_ids = iter(token_ids)
+    while True:
+        try:
+            token_id = next(token_ids)
+        except StopIteration as stop:
+            result = stop.value
+            break
+        chunk = detokenizer.add(token_id)
+        if chunk:
+            yield chunk
+    chunk = detokenizer.flush()
+    if chunk:
+        yield chunk
+    return result
+
+
+def stream_translation(translator, text, options):
+    '''
+    translator.translate_stream(text), or the whole translation as one chunk for translators that cannot stream.
+    Return whether the translation was truncated.
+    '''
+    if hasattr(translator, 'translate_stream'):
+        return bool((yield from translator.translate_stream(text, **options)))
+    translations, truncated = translator.translate_detailed([text], **options)
+    if translations[0]:
+        yield translations[0]
+    return truncated[0]
+
+
+def record_chunks(chunks, parts):
+    '''Yield from `chunks`, appending each chunk to the list `parts`, and return what `chunks` returns. '''
+    while True:
+        try:
+            chunk = next(chunks)
+        except StopIteration as stop:
+            return stop.value
+        parts.append(chunk)
+        yield chunk
+
+
+def time_to_first_chunk(chunks):
+    '''Consume a chunk iterator. Return (text, seconds to the first chunk, seconds in total). '''
+    start = time.perf_counter()
+    first = None
+    text = []
+    for chunk in chunks:
+        if first is None:
+            first = time.perf_counter() - start
+        text.append(chunk)
+    total = time.perf_counter() - start
+    return ''.join(text), total if first is None else first, total
@@ -0,0 +1,336 @@
+# =======================================
+##### Backend: fine-tuned T5
+# =======================================
+
+'''
+# The right-sized vocabularies and the checkpoint and quantization helpers of the fine-tuned T5, defined once here:
+# T5_Transformers/T5.py and T5_get_results.py import them. Importing this module reads neither the corpus nor the tokenizers.
+# Translator loads a checkpoint written by save_inference_checkpoint() and generates like T5.generate_translation(), for a
+# whole batch at once. Needs torch, sentencepiece, safetensors and transformers, but neither the hub nor the pretrained
+# t5-small weights.
+'''
+
+import json
+import os
+import queue
+import threading
+import time
+
+import sentencepiece as spm
+import torch
+from torch import nn
+from transformers import T5Config, T5ForConditionalGeneration
+from transformers.generation.stopping_criteria import StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
+
+from bo_translate import max_target_length
+from bo_translate.streaming import detokenize_stream
+
+
+
+# --------------------------
+#### Model
+# --------------------------
+
+def right_size_vocabularies(model, src_rows, tgt_rows): 
+    '''
+    t5-small shares one 32,128-row embedding between the encoder, the decoder and the LM head, but our tokenizers have 
+    their own vocabularies (bo.model: 32,000 pieces, en.model: 25,000). Give the encoder its own embedding with one row per 
+    source piece, and shrink the shared decoder embedding, which the LM head stays tied to, to one row per target piece. 
+    The softmax then only covers real target pieces, so generate() can no longer produce ids the tokenizer cannot decode. 
+    `src_rows[i]` / `tgt_rows[i]` is the row of the current shared embedding piece i starts from, 
+    or -1 for a fresh row drawn around the mean of the current rows. 
+    '''
+    old = model.shared.weight.detach()
+    
+    def embedding(rows): 
+        rows = torch.as_tensor(list(rows), dtype = torch.long, device = old.device)
+        weight = old.mean(0) + old.std(0) * torch.randn(len(rows), old.size(1), device = old.device)
+        weight[rows >= 0] = old[rows[rows >= 0]]
+        return nn.Embedding.from_pretrained(weight, freeze = False)
+    
+    model.set_input_embeddings(embedding(tgt_rows))    # Sets model.shared and the decoder's input embedding 
+    model.encoder.set_input_embeddings(embedding(src_rows))
+    untie_source_embedding(model)
+    model.lm_head = nn.Linear(model.config.d_model, len(tgt_rows), bias = False).to(old.device)
+    model.lm_head.weight = model.shared.weight    # Still tied as in t5-small, which is why the decoder output is scaled by d_model**-0.5 
+    model.config.vocab_size = len(tgt_rows)
+    model.config.source_vocab_size = len(src_rows)    # Kept in the config so save_quantized_model() artifacts can be rebuilt 
+    model.tie_weights()
+    assert model.encoder.embed_tokens.num_embeddings == len(src_rows), 'tie_weights() replaced the source embedding'
+    return model
+
+
+def untie_source_embedding(model): 
+    '''
+    T5ForConditionalGeneration._tied_weights_keys ties the encoder embedding to model.shared as well. Drop that pair from 
+    this model's own mapping: otherwise tie_weights() (run by from_pretrained(), resize_token_embeddings(), ...) puts the 
+    target-sized model.shared back into the encoder, and Tibetan ids past the English vocabulary fail with an IndexError. 
+    '''
+    for attribute in ['_tied_weights_keys', 'all_tied_weights_keys']: 
+        mapping = getattr(model, attribute, None)
+        if isinstance(mapping, dict): 
+            setattr(model, attribute, {target: source for target, source in mapping.items() if not target.startswith('encoder.')})
+
+
+def convert_full_vocab_state_dict(state_dict, source_vocab_size, target_vocab_size): 
+    '''
+    Checkpoints fine-tuned before right_size_vocabularies() (e.g. T5_checkpoint_best_epoch=44.pt) have t5-small's 32,128-row 
+    embedding, indexed directly by our piece ids. Keep its first `source_vocab_size` rows for the encoder and its first 
+    `target_vocab_size` rows for the decoder and LM head. Right-sized checkpoints are returned unchanged. 
+    '''
+    state_dict = dict(state_dict)
+    state_dict.setdefault('encoder.embed_tokens.weight', state_dict['shared.weight'])
+    sizes = {
+        'shared.weight': target_vocab_size, 
+        'encoder.embed_tokens.weight': source_vocab_size, 
+        'decoder.embed_tokens.weight': target_vocab_size, 
+        'lm_head.weight': target_vocab_size, 
+    }
+    for key, size in sizes.items(): 
+        if key in state_dict: 
+            state_dict[key] = state_dict[key][:size]
+    return state_dict
+
+
+'''
+# Post-training dynamic int8 quantization for CPU inference
+# Weights are stored as int8 and activations are quantized on the fly, so no calibration data is needed 
+'''
+
+def quantize_dynamic_int8(model): 
+    '''
+    Return an int8 copy of `model` on the CPU. Every nn.Linear is quantized: 
+    the attention projections (q, k, v, o), the feedforward layers (wi, wo) and the LM head. 
+    The shared embedding and the layer norms stay fp32. 
+    t5-small ties the LM head to the shared embedding, so the int8 LM head is an extra (4x smaller) copy of that matrix. 
+    '''
+    return torch.ao.quantization.quantize_dynamic(model.to('cpu').eval(), {nn.Linear}, dtype = torch.qint8)
+
+
+def save_quantized_model(model, path): 
+    '''Save an int8 model together with the config needed to rebuild it. '''
+    torch.save({'config': model.config.to_dict(), 'state_dict': model.state_dict()}, path)
+
+
+def load_quantized_model(path): 
+    '''Load an artifact written by save_quantized_model(). Needs neither the fp32 checkpoint nor the pretrained t5-small weights. CPU only. '''
+    artifact = torch.load(path, map_location = 'cpu')
+    config = T5Config.from_dict(artifact['config'])
+    model = T5ForConditionalGeneration(config)
+    if hasattr(config, 'source_vocab_size'):    # Artifacts saved before the vocabularies were right-sized don't have it 
+        right_size_vocabularies(model, [-1] * config.source_vocab_size, [-1] * config.vocab_size)    # Fresh rows, the state_dict overwrites them 
+    model = quantize_dynamic_int8(model)
+    model.load_state_dict(artifact['state_dict'])
+    return model
+
+
+def save_inference_checkpoint(model, path, tokenizer_paths, dtype = torch.float32): 
+    '''
+    Save everything inference needs in one safetensors file: the weights (floating point ones stored in `dtype`, 
+    fp32 or bf16 to halve the file), and as metadata the T5 config and the tokenizer paths (`tokenizer_paths`: source, 
+    target), relative to the checkpoint so the folder can be moved as a whole. Loading it needs neither the hub nor the 
+    pretrained t5-small weights. Tied weights (the LM head and the decoder embedding are model.shared) are stored once. 
+    '''
+    from safetensors.torch import save_file    # Imported here because only inference checkpoints need it
+    srcTokenizerPath, tgtTokenizerPath = tokenizer_paths
+    directory = os.path.dirname(os.path.abspath(path))
+    tensors, tied, names = {}, {}, {}
+    for name, tensor in model.state_dict().items(): 
+        storage = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape))
+        if storage in names: 
+            tied[name] = names[storage]
+            continue
+        names[storage] = name
+        tensors[name] = (tensor.to(dtype) if tensor.is_floating_point() else tensor).contiguous()
+    save_file(tensors, path, metadata = {
+        'format': 'T5-inference', 
+        'config': json.dumps(model.config.to_dict()), 
+        'tied': json.dumps(tied), 
+        'srcTokenizer': os.path.relpath(srcTokenizerPath, directory), 
+        'tgtTokenizer': os.path.relpath(tgtTokenizerPath, directory), 
+    })
+
+
+def load_inference_checkpoint(path, device, dtype = torch.float32): 
+    '''
+    Load a checkpoint written by save_inference_checkpoint() in a single pass, fully offline. The model is built from the 
+    saved config on the meta device (no weight init, no allocation) and then takes over the tensors, which are 
+    memory-mapped from the file on CPU. Weights are cast to `dtype`, or kept as stored with dtype = None. 
+    Return the model in eval mode and the source and target tokenizer paths. 
+    '''
+    from safetensors import safe_open
+    with safe_open(path, framework = 'pt', device = str(device)) as f: 
+        metadata = f.metadata()
+        tensors = {name: f.get_tensor(name) for name in f.keys()}
+    if metadata.get('format') != 'T5-inference': 
+        raise ValueError(f'{path} is not a checkpoint written by save_inference_checkpoint()')
+    if dtype is not None: 
+        tensors = {name: tensor.to(dtype) if tensor.is_floating_point() else tensor for name, tensor in tensors.items()}
+    for name, source in json.loads(metadata['tied']).items(): 
+        tensors[name] = tensors[source]
+    
+    config = T5Config.from_dict(json.loads(metadata['config']))
+    with torch.device('meta'): 
+        model = T5ForConditionalGeneration(config)
+        model.encoder.set_input_embeddings(nn.Embedding(config.source_vocab_size, config.d_model))    # As in right_size_vocabularies()
+    untie_source_embedding(model)
+    model.load_state_dict(tensors, assign = True)
+    
+    directory = os.path.dirname(os.path.abspath(path))
+    return model.eval(), os.path.normpath(os.path.join(directory, metadata['srcTokenizer'])), os.path.normpath(os.path.join(directory, metadata['tgtTokenizer']))
+
+
+
+# --------------------------
+#### Translator
+# --------------------------
+
+class TokenStreamer(BaseStreamer): 
+    '''Hand the token ids generate() produces to another thread through a queue, None at the end. '''
+    def __init__(self): 
+        self.queue = queue.Queue()
+        self.started = False
+    
+    
+    def put(self, value): 
+        if not self.started:    # the first call passes the decoder start token 
+            self.started = True
+            return 
+        self.queue.put(value.view(-1).tolist())
+    
+    
+    def end(self): 
+        self.queue.put(None)
+
+
+
+class LimitsCriteria(StoppingCriteria): 
+    '''
+    Stop each sentence of the batch at its own length (`max_lens`, counting the decoder start token like max_length), 
+    and the whole batch once `deadline` (time.monotonic()) has passed. Beam search calls it with all candidate beams 
+    of a sentence next to each other, so the limits are repeated per beam. 
+    '''
+    def __init__(self, max_lens, deadline = None): 
+        self.max_lens = torch.tensor(max_lens)
+        self.deadline = deadline
+    
+    
+    def __call__(self, input_ids, scores, **kwargs): 
+        if self.deadline is not None and time.monotonic() >= self.deadline: 
+            return torch.ones(input_ids.size(0), dtype = torch.bool, device = input_ids.device)
+        max_lens = self.max_lens.to(input_ids.device).repeat_interleave(input_ids.size(0) // self.max_lens.numel())
+        return input_ids.size(1) >= max_lens
+
+
+
+class Translator: 
+    '''Translate Tibetan sentences with a fine-tuned T5 inference checkpoint. '''
+    def __init__(self, path, device = None): 
+        self.device = torch.device(device or ('cuda:0' if torch.cuda.is_available() else 'cpu'))
+        self.model, srcTokenizerPath, tgtTokenizerPath = load_inference_checkpoint(path, self.device)
+        self.srcTokenizer = spm.SentencePieceProcessor(model_file = srcTokenizerPath)
+        self.tgtTokenizer = spm.SentencePieceProcessor(model_file = tgtTokenizerPath)
+        self.src_pad_id = self.srcTokenizer.piece_to_id('<pad>')
+        self.tgt_eos_id = self.tgtTokenizer.piece_to_id('</s>')
+        self.tgt_pad_id = self.tgtTokenizer.piece_to_id('<pad>')
+    
+    
+    def source_lengths(self, texts): 
+        '''Number of source tokens of each sentence. '''
+        return [len(ids) for ids in self.srcTokenizer.encode(list(texts))]
+    
+    
+    def generate_options(self, src_ids, num_beams, max_len, length_penalty, max_lens = None, deadline = None): 
+        '''
+        generate() keyword arguments, the settings of T5.generate_translation(). 
+        `max_lens` (one per sentence, at most max_len) and `deadline` add a LimitsCriteria. 
+        '''
+        options = dict(
+            attention_mask = (src_ids != self.src_pad_id).long(), 
+            max_length = max_len if max_lens is None else max(max_lens), 
+            bos_token_id = None, 
+            eos_token_id = self.tgt_eos_id, 
+            pad_token_id = self.tgt_pad_id, 
+            num_beams = num_beams, 
+            repetition_penalty = 2.5, 
+        )
+        if num_beams > 1:    # beam search only, greedy search warns about them 
+            options.update(length_penalty = length_penalty, early_stopping = True)
+        if deadline is not None or (max_lens is not None and min(max_lens) < options['max_length']): 
+            options['stopping_criteria'] = StoppingCriteriaList([LimitsCriteria(max_lens or [max_len] * src_ids.size(0), deadline)])
+        return options
+    
+    
+    def translate(self, texts, *args, **options): 
+        '''Translate a list of sentences, see translate_detailed(). '''
+        return self.translate_detailed(texts, *args, **options)[0]
+    
+    
+    def translate_detailed(self, texts, num_beams = 4, max_len = 100, length_penalty = 0.6, max_len_a = None, max_len_b = 10, deadline = None): 
+        '''
+        Translate a list of sentences as one padded batch with the generate() settings of T5.generate_translation(). 
+        Empty sentences translate to ''. Each sentence gets at most max_target_length(len(src), max_len, max_len_a, max_len_b) 
+        tokens, and generate() stops after the step during which `deadline` (time.monotonic()) passed, returning the best 
+        hypotheses so far. Return the translations and, for each, whether it was truncated (cut off before </s>). 
+        '''
+        src_batch = [self.srcTokenizer.encode(text) for text in texts]
+        translations = [''] * len(texts)
+        truncated = [False] * len(texts)
+        todo = [i for i, ids in enumerate(src_batch) if ids]
+        if not todo: 
+            return translations, truncated
+        
+        width = max(len(src_batch[i]) for i in todo)
+        src_ids = torch.LongTensor([src_batch[i] + [self.src_pad_id] * (width - len(src_batch[i])) for i in todo]).to(self.device)
+        max_lens = [max_target_length(len(src_batch[i]), max_len, max_len_a, max_len_b) for i in todo]
+        with torch.inference_mode(): 
+            outs = self.model.generate(src_ids, **self.generate_options(src_ids, num_beams, max_len, length_penalty, max_lens, deadline))
+        for i, ids in zip(todo, outs.tolist()): 
+            translations[i] = self.tgtTokenizer.decode(ids)    # <pad> and </s> are control pieces, decode() drops them 
+            truncated[i] = self.tgt_eos_id not in ids
+        return translations, truncated
+    
+    
+    def translate_stream(self, text, num_beams = 4, max_len = 100, length_penalty = 0.6, max_len_a = None, max_len_b = 10, deadline = None): 
+        '''
+        Translate one sentence, yielding the translation in chunks as it is generated; the chunks join up to 
+        translate([text])[0]. generate() only streams greedy search, so num_beams > 1 yields the translation once. 
+        generate() runs on its own thread and hands each token over through a TokenStreamer. 
+        Returns whether the translation was truncated, like translate_detailed(). 
+        '''
+        src_ids = self.srcTokenizer.encode(text)
+        if not src_ids: 
+            return False
+        if num_beams > 1: 
+            translations, truncated = self.translate_detailed([text], num_beams, max_len, length_penalty, max_len_a, max_len_b, deadline)
+            yield translations[0]
+            return truncated[0]
+        
+        max_lens = [max_target_length(len(src_ids), max_len, max_len_a, max_len_b)]
+        src_ids = torch.LongTensor([src_ids]).to(self.device)
+        streamer = TokenStreamer()
+        errors = []
+        def run(): 
+            try: 
+                with torch.inference_mode(): 
+                    self.model.generate(src_ids, streamer = streamer, **self.generate_options(src_ids, 1, max_len, length_penalty, max_lens, deadline))
+            except Exception as error: 
+                errors.append(error)
+                streamer.end()
+        thread = threading.Thread(target = run, daemon = True)
+        thread.start()
+        
+        finished = []
+        def token_ids(): 
+            while True: 
+                ids = streamer.queue.get()
+                if ids is None: 
+                    return 
+                finished.extend(token_id for token_id in ids if token_id == self.tgt_eos_id)
+                yield from (token_id for token_id in ids if token_id not in (self.tgt_eos_id, self.tgt_pad_id))
+        yield from detokenize_stream(self.tgtTokenizer, token_ids())
+        thread.join()
+        if errors: 
+            raise errors[0]
+        return not finished
@@ -0,0 +1,365 @@
+'''
+# Translation memory over the parallel corpus: exact and fuzzy matches of a Tibetan sentence in train.bo,
+# answered with the train.en line, e.g. from the repository root
+#   python -m bo_translate.translation_memory build data/train.bo data/train.en --output tm_index
+#   python -m bo_translate.translation_memory query tm_index --threshold 0.8 < sentences.bo
+#
+# Sentences are compared as sequences of syllables (split at tsek and shad). The index directory holds
+#   exact.bin     sorted uint64 (crc32 of the syllables << 32 | line), for exact matches
+#   grams.bin     sorted uint64 (crc32 of a syllable bigram << 32 | line), an inverted index for fuzzy candidates
+#   bo.offsets / en.offsets    uint64 byte offset of every line in train.bo / train.en
+#   meta.json     corpus paths and sizes
+# The build streams over the corpus and sorts the postings in bounded runs merged from disk, so memory does not grow
+# with the corpus. Loading memory-maps the files. Fuzzy candidates share the most (rarest) bigrams with the query and
+# are scored by syllable edit distance, score = 1 - distance / max(length), 1.0 for an exact match.
+'''
+
+import argparse
+import array
+import bisect
+import collections
+import heapq
+import itertools
+import json
+import mmap
+import os
+import re
+import sys
+import tempfile
+import time
+import unicodedata
+import zlib
+
+from bo_translate.streaming import stream_translation
+
+
+FORMAT = 'bo-translation-memory-1'
+
+LINE_MASK = (1 << 32) - 1
+
+SEPARATORS = re.compile(r'[\s་༌།༎༑༔]+')    # whitespace, tsek, non-breaking tsek, shad, double shad, rin chen spungs shad, gter tsheg
+
+
+def syllables(text):
+    return [syllable for syllable in SEPARATORS.split(unicodedata.normalize('NFC', text)) if syllable]
+
+
+def sentence_hash(sylls):
+    return zlib.crc32('་'.join(sylls).encode('utf-8'))
+
+
+def gram_hashes(sylls):
+    '''crc32 of each distinct syllable bigram, or of the syllable for one-syllable sentences. '''
+    if len(sylls) == 1:
+        return {zlib.crc32(sylls[0].encode('utf-8'))}
+    return {zlib.crc32(f'{a}་{b}'.encode('utf-8')) for a, b in zip(sylls, sylls[1:])}
+
+
+def edit_distance(a, b):
+    '''Levenshtein distance between two syllable lists. '''
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, x in enumerate(a, 1):
+        current = [i]
+        for j, y in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (x != y)))
+        previous = current
+    return previous[-1]
+
+
+def similarity(a, b):
+    if not a and not b:
+        return 1.0
+    return 1 - edit_distance(a, b) / max(len(a), len(b))
+
+
+# --------------------------
+#### Building
+# --------------------------
+
+class ExternalSorter:
+    '''Sort a stream of uint64 with at most run_size of them in memory, spilling sorted runs to `directory`. '''
+    def __init__(self, directory, run_size):
+        self.directory = directory
+        self.run_size = run_size
+        self.buffer = array.array('Q')
+        self.runs = []
+
+
+    def add(self, value):
+        self.buffer.append(value)
+        if len(self.buffer) >= self.run_size:
+            self.spill()
+
+
+    def spill(self):
+        run = tempfile.TemporaryFile(dir = self.directory)
+        array.array('Q', sorted(self.buffer)).tofile(run)
+        run.seek(0)
+        self.runs.append(run)
+        self.buffer = array.array('Q')
+
+
+    @staticmethod
+    def read_run(run, block = 1 << 16):
+        while True:
+            values = array.array('Q')
+            values.frombytes(run.read(8 * block))
+            if not values:
+                return
+            yield from values
+
+
+    def write(self, path, block = 1 << 16):
+        '''Write all values, sorted, to `path`. Return how many. '''
+        if self.buffer or not self.runs:
+            self.spill()
+        count = 0
+        out = array.array('Q')
+        with open(path, 'wb') as f:
+            for value in heapq.merge(*(self.read_run(run) for run in self.runs)):
+                out.append(value)
+                if len(out) == block:
+                    out.tofile(f)
+                    count += len(out)
+                    out = array.array('Q')
+            out.tofile(f)
+            count += len(out)
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        return count
+
+
+def build_index(bo_path, en_path, output, run_size = 4_000_000, log_every = 1_000_000):
+    '''Stream over the parallel corpus once and write the index directory `output`. Return the number of lines. '''
+    os.makedirs(output, exist_ok = True)
+    exact = ExternalSorter(output, run_size)
+    grams = ExternalSorter(output, run_size)
+    start = time.perf_counter()
+    lines = 0
+    with open(bo_path, 'rb') as bo, open(en_path, 'rb') as en, \
+         open(os.path.join(output, 'bo.offsets'), 'wb') as bo_offsets, open(os.path.join(output, 'en.offsets'), 'wb') as en_offsets:
+        offsets = [array.array('Q', [0]), array.array('Q', [0])]
+        positions = [0, 0]
+        for bo_line, en_line in itertools.zip_longest(bo, en):
+            if bo_line is None or en_line is None:    # zip() would drop the extra line of the longer file without a word
+                raise ValueError(f'{bo_path} and {en_path} have different numbers of lines')
+            sylls = syllables(bo_line.decode('utf-8'))
+            if sylls:
+                exact.add(sentence_hash(sylls) << 32 | lines)
+                for gram in gram_hashes(sylls):
+                    grams.add(gram << 32 | lines)
+            for k, line in enumerate((bo_line, en_line)):
+                positions[k] += len(line)
+                offsets[k].append(positions[k])
+            lines += 1
+            if len(offsets[0]) >= 1 << 16:
+                offsets[0].tofile(bo_offsets)
+                offsets[1].tofile(en_offsets)
+                offsets = [array.array('Q'), array.array('Q')]
+            if log_every and lines % log_every == 0:
+                print(f'{lines} lines indexed, {lines / (time.perf_counter() - start):.0f} lines/s', file = sys.stderr, flush = True)
+        offsets[0].tofile(bo_offsets)
+        offsets[1].tofile(en_offsets)
+
+    exact.write(os.path.join(output, 'exact.bin'))
+    postings = grams.write(os.path.join(output, 'grams.bin'))
+    with open(os.path.join(output, 'meta.json'), 'w') as f:
+        json.dump(dict(
+            format = FORMAT, lines = lines, postings = postings,
+            bo = os.path.abspath(bo_path), bo_size = os.path.getsize(bo_path),
+            en = os.path.abspath(en_path), en_size = os.path.getsize(en_path),
+        ), f, indent = 2)
+    return lines
+
+
+# --------------------------
+#### Lookup
+# --------------------------
+
+def map_file(path, typecode = None):
+    '''Read-only mmap of a file, as a memoryview of uint64 if typecode is 'Q'. Empty files map to an empty sequence. '''
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ()
+        mapped = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    return memoryview(mapped).cast(typecode) if typecode else mapped
+
+
+class TranslationMemory:
+    '''Memory-mapped translation memory index, see build_index(). '''
+    def __init__(self, directory, max_postings = 20000, candidates = 32):
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta.get('format') != FORMAT:
+            raise ValueError(f'{directory} is not a translation memory index')
+        for side in ('bo', 'en'):
+            if os.path.getsize(self.meta[side]) != self.meta[f'{side}_size']:
+                raise ValueError(f'{self.meta[side]} changed since the index was built, rebuild {directory}')
+        self.exact = map_file(os.path.join(directory, 'exact.bin'), 'Q')
+        self.grams = map_file(os.path.join(directory, 'grams.bin'), 'Q')
+        self.offsets = {side: map_file(os.path.join(directory, f'{side}.offsets'), 'Q') for side in ('bo', 'en')}
+        self.text = {side: map_file(self.meta[side]) for side in ('bo', 'en')}
+        self.max_postings = max_postings    # bigrams in more lines than this are only used if the query has no rarer ones
+        self.candidates = candidates        # lines scored by edit distance per query
+
+
+    def __len__(self):
+        return self.meta['lines']
+
+
+    def line(self, side, i):
+        return bytes(self.text[side][self.offsets[side][i] : self.offsets[side][i + 1]]).decode('utf-8').rstrip('\r\n')
+
+
+    @staticmethod
+    def postings(table, key):
+        '''The (key << 32 | line) entries of a sorted table with this 32-bit key, as a slice. '''
+        return table[bisect.bisect_left(table, key << 32) : bisect.bisect_left(table, (key + 1) << 32)]
+
+
+    def lookup(self, text, threshold = 1.0):
+        '''
+        Best match of `text` in train.bo with similarity >= threshold, as (score, line number, train.en line),
+        or None. Exact matches are found by hash; threshold < 1 also searches the bigram index.
+        '''
+        sylls = syllables(text)
+        if not sylls:
+            return None
+        for entry in self.postings(self.exact, sentence_hash(sylls)):
+            i = entry & LINE_MASK
+            if syllables(self.line('bo', i)) == sylls:
+                return 1.0, i, self.line('en', i)
+        if threshold >= 1:
+            return None
+
+        lists = sorted((self.postings(self.grams, gram) for gram in gram_hashes(sylls)), key = len)
+        usable = [entries for entries in lists if len(entries) <= self.max_postings] or lists[:2]
+        shared = collections.Counter()
+        for entries in usable:
+            shared.update(entry & LINE_MASK for entry in entries)
+
+        best = None
+        for i, _ in shared.most_common(self.candidates):
+            candidate = syllables(self.line('bo', i))
+            if 1 - abs(len(candidate) - len(sylls)) / max(len(candidate), len(sylls)) < threshold:
+                continue    # the length difference alone rules it out
+            score = similarity(sylls, candidate)
+            if score >= threshold and (best is None or (score, -i) > (best[0], -best[1])):
+                best = (score, i)
+        return None if best is None else (round(best[0], 4), best[1], self.line('en', best[1]))
+
+
+class MemoryTranslator:
+    '''
+    Answer sentences found in the translation memory (similarity >= threshold) with the corpus translation and pass
+    the rest to `translator`. Same translate() API as the Translators.
+    '''
+    def __init__(self, translator, memory, threshold = 1.0):
+        self.translator = translator
+        self.memory = memory
+        self.threshold = threshold
+        self.stats = collections.Counter()
+
+
+    def source_lengths(self, texts):
+        return self.translator.source_lengths(texts)
+
+
+    def translate(self, texts, **options):
+        return self.translate_detailed(texts, **options)[0]
+
+
+    def translate_detailed(self, texts, **options):
+        '''Like the wrapped translator's. Translation memory hits are never truncated. '''
+        translations = [None] * len(texts)
+        truncated = [False] * len(texts)
+        for k, text in enumerate(texts):
+            match = self.memory.lookup(text, self.threshold)
+            if match is not None:
+                translations[k] = match[2]
+                self.stats['exact_hits' if match[0] == 1.0 else 'fuzzy_hits'] += 1
+        todo = [k for k, translation in enumerate(translations) if translation is None]
+        self.stats['sentences'] += len(texts)
+        self.stats['misses'] += len(todo)
+        if todo:
+            for k, translation, was_cut in zip(todo, *self.translator.translate_detailed([texts[k] for k in todo], **options)):
+                translations[k] = translation
+                truncated[k] = was_cut
+        return translations, truncated
+
+
+    def translate_stream(self, text, **options):
+        '''Yield a translation memory hit at once, or stream the wrapped translator's translation. '''
+        self.stats['sentences'] += 1
+        match = self.memory.lookup(text, self.threshold)
+        if match is None:
+            self.stats['misses'] += 1
+            return (yield from stream_translation(self.translator, text, options))
+        self.stats['exact_hits' if match[0] == 1.0 else 'fuzzy_hits'] += 1
+        if match[2]:
+            yield match[2]
+        return False
+
+
+    def metrics(self):
+        sentences = self.stats['sentences']
+        metrics = dict(
+            memory_sentences = sentences,
+            memory_exact_hits = self.stats['exact_hits'],
+            memory_fuzzy_hits = self.stats['fuzzy_hits'],
+            memory_misses = self.stats['misses'],
+            memory_hit_rate = round((sentences - self.stats['misses']) / sentences, 4) if sentences else None,
+        )
+        if hasattr(self.translator, 'metrics'):
+            metrics.update(self.translator.metrics())
+        return metrics
+
+
+def add_memory_arguments(parser):
+    parser.add_argument('--memory-index', default = None, help = 'translation memory built by `python -m bo_translate.translation_memory build`')
+    parser.add_argument('--memory-threshold', type = float, default = 1.0, help = 'lowest similarity answered from the translation memory, 1.0 = exact only')
+
+
+def memory_from_arguments(translator, args):
+    '''Put the translation memory given on the command line, if any, in front of `translator`. '''
+    if args.memory_index is None:
+        return translator
+    return MemoryTranslator(translator, TranslationMemory(args.memory_index), args.memory_threshold)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog = 'python -m bo_translate.translation_memory', description = 'translation memory over the parallel corpus')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    build = commands.add_parser('build', help = 'index a parallel corpus')
+    build.add_argument('bo', help = 'Tibetan side, e.g. data/train.bo')
+    build.add_argument('en', help = 'English side, e.g. data/train.en')
+    build.add_argument('--output', default = 'tm_index')
+    build.add_argument('--run-size', type = int, default = 4_000_000, help = 'postings sorted in memory at a time')
+    query = commands.add_parser('query', help = 'look up Tibetan sentences from stdin, print score, line and translation (tab separated)')
+    query.add_argument('index')
+    query.add_argument('--threshold', type = float, default = 0.8)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == 'build':
+        lines = build_index(args.bo, args.en, args.output, args.run_size)
+        print(f'Indexed {lines} lines into {args.output} in {time.perf_counter() - start:.1f}s', file = sys.stderr)
+        return
+
+    memory = TranslationMemory(args.index)
+    print(f'Loaded {len(memory)} lines in {1000 * (time.perf_counter() - start):.1f} ms', file = sys.stderr)
+    seconds = []
+    for line in sys.stdin:
+        start = time.perf_counter()
+        match = memory.lookup(line, args.threshold)
+        seconds.append(time.perf_counter() - start)
+        print('\t'.join(['-', '-', ''] if match is None else map(str, match)), flush = True)
+    if seconds:
+        print(f'{len(seconds)} lookups, mean {1000 * sum(seconds) / len(seconds):.2f} ms, max {1000 * max(seconds):.2f} ms', file = sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -298,12 +298,13 @@ if __name__ == '__main__':
 # In[ ]:
 
 
-spm.SentencePieceTrainer.train(
-        input='../data/boTokenData.txt', 
-        model_prefix='bo', 
-        vocab_size=32000)
-# sp = spm.SentencePieceProcessor(model_file='train.model')
-# print(sp.encode(['ངའི་མིང་ལ་བསྟན་སྒྲོལ་མ་ཟེར་'], out_type=str))
+if __name__ == '__main__':
+    spm.SentencePieceTrainer.train(
+            input='../data/boTokenData.txt', 
+            model_prefix='bo', 
+            vocab_size=32000)
+    # sp = spm.SentencePieceProcessor(model_file='train.model')
+    # print(sp.encode(['ངའི་མིང་ལ་བསྟན་སྒྲོལ་མ་ཟེར་'], out_type=str))
 
 
 # *English*
@@ -311,10 +312,11 @@ spm.SentencePieceTrainer.train(
 # In[7]:
 
 
-spm.SentencePieceTrainer.train(
-        input='../data/enTokenData.txt', 
-        model_prefix='en', 
-        vocab_size=25000)
+if __name__ == '__main__':
+    spm.SentencePieceTrainer.train(
+            input='../data/enTokenData.txt', 
+            model_prefix='en', 
+            vocab_size=25000)
 
 
 # **Segmentation**
@@ -322,22 +324,24 @@ spm.SentencePieceTrainer.train(
 # In[8]:
 
 
-sp = spm.SentencePieceProcessor(model_file='bo.model')
-print(sp.encode(['ངའི་མིང་ལ་བསྟན་སྒྲོལ་མ་ཟེར་'], out_type=str))
-print(sp.encode(['ངའི་མིང་ལ་བསྟན་སྒྲོལ་མ་ཟེར་', 'བཀ྄ྲ་ཤིས་བདེ་ལེགས།'], out_type=int))
-print(sp.decode([4149, 306, 6, 245, 4660, 748]))
-print(sp.decode(['▁ངའི་', 'མིང་', 'ལ་', 'བསྟན་', 'སྒྲོལ་མ་', 'ཟེར་']))
-sp.get_piece_size()
+if __name__ == '__main__':
+    sp = spm.SentencePieceProcessor(model_file='bo.model')
+    print(sp.encode(['ངའི་མིང་ལ་བསྟན་སྒྲོལ་མ་ཟེར་'], out_type=str))
+    print(sp.encode(['ངའི་མིང་ལ་བསྟན་སྒྲོལ་མ་ཟེར་', 'བཀ྄ྲ་ཤིས་བདེ་ལེགས།'], out_type=int))
+    print(sp.decode([4149, 306, 6, 245, 4660, 748]))
+    print(sp.decode(['▁ངའི་', 'མིང་', 'ལ་', 'བསྟན་', 'སྒྲོལ་མ་', 'ཟེར་']))
+    sp.get_piece_size()
 
 
 # In[9]:
 
 
-sp = spm.SentencePieceProcessor(model_file='en.model')
-print(sp.encode(["My name isn't Tenzin Dolma Gyalpo"], out_type=str))
-print(sp.encode(['My name is Tenzin Dolma Gyalpo', 'Hello'], out_type=int))
-print(sp.decode([[8803, 180, 12, 5519, 15171, 17894], [887, 21491]]))
-sp.get_piece_size()
+if __name__ == '__main__':
+    sp = spm.SentencePieceProcessor(model_file='en.model')
+    print(sp.encode(["My name isn't Tenzin Dolma Gyalpo"], out_type=str))
+    print(sp.encode(['My name is Tenzin Dolma Gyalpo', 'Hello'], out_type=int))
+    print(sp.decode([[8803, 180, 12, 5519, 15171, 17894], [887, 21491]]))
+    sp.get_piece_size()
 
 
 # **Tokenizing training data**
@@ -347,14 +351,15 @@ sp.get_piece_size()
 # In[16]:
 
 
-sp = spm.SentencePieceProcessor(model_file='bo.model')
-doc = load_doc("../data/train.bo")
-sentences = to_sentences(doc)
-bo_token = sp.encode(sentences, out_type=str)
-save_clean_sentences_binary(bo_token, "../data-bin/data.tokenized.bo-en/train.bo-en.bo.bin")
-# spot check
-for i in range(5):
-    print(bo_token[i])
+if __name__ == '__main__':
+    sp = spm.SentencePieceProcessor(model_file='bo.model')
+    doc = load_doc("../data/train.bo")
+    sentences = to_sentences(doc)
+    bo_token = sp.encode(sentences, out_type=str)
+    save_clean_sentences_binary(bo_token, "../data-bin/data.tokenized.bo-en/train.bo-en.bo.bin")
+    # spot check
+    for i in range(5):
+        print(bo_token[i])
 
 
 # *English*
@@ -362,17 +367,15 @@ for i in range(5):
 # In[12]:
 
 
-sp = spm.SentencePieceProcessor(model_file='en.model')
-doc = load_doc("../data/train.en")
-sentences = to_sentences(doc)
-en_token = sp.encode(sentences, out_type=str)
-save_clean_sentences_binary(en_token, "../data-bin/data.tokenized.bo-en/train.bo-en.en.bin")
-# spot check
-for i in range(5):
-    print(en_token[i])
+if __name__ == '__main__':
+    sp = spm.SentencePieceProcessor(model_file='en.model')
+    doc = load_doc("../data/train.en")
+    sentences = to_sentences(doc)
+    en_token = sp.encode(sentences, out_type=str)
+    save_clean_sentences_binary(en_token, "../data-bin/data.tokenized.bo-en/train.bo-en.en.bin")
+    # spot check
+    for i in range(5):
+        print(en_token[i])
 
 
 # In[ ]:
-
-
-